@@ -0,0 +1,54 @@
+import collections
+
+
+def new_plan():
+    """
+    Returns an empty plan of calibration applications.
+
+    Output:
+    plan = Number of applications requested and the calibration to apply to each (field, SPW). (Dictionary)
+    """
+    return {'requests': 0, 'units': collections.OrderedDict()}
+
+def request(plan,field,spws,gaintable,gainfield):
+    """
+    Adds the application of calibration tables to some SPWs of a field.
+    A later request for the same field and SPW replaces the earlier one, as a later applycal call would overwrite its corrected data.
+
+    Input:
+    plan = The plan (from new_plan). (Dictionary)
+    field = Name of the field. (String)
+    spws = SPW IDs to calibrate. (List of Integers)
+    gaintable = The calibration tables to apply. (List of Strings)
+    gainfield = The field whose solutions are used for each table ('' for all). (List of Strings)
+    """
+    plan['requests'] += 1
+    for spw in spws:
+        plan['units'][(str(field),int(spw))] = (tuple(gaintable),tuple(gainfield))
+
+def calls(plan):
+    """
+    Merges the requested applications into the fewest applycal calls: the fields and SPWs that receive the same tables
+    (with the same solution fields) share a call, and each field and SPW is only calibrated once.
+    No two calls select the same data, so their order does not matter.
+
+    Input:
+    plan = The plan (from new_plan). (Dictionary)
+
+    Output:
+    calls = The field and SPW selections and the gaintable and gainfield parameters of each call. (List of Dictionaries)
+    """
+    groups = collections.OrderedDict()
+    for (field,spw),cal in plan['units'].items():
+        field_spws = groups.setdefault(cal,collections.OrderedDict())
+        field_spws.setdefault(field,[]).append(spw)
+    merged = []
+    for (gaintable,gainfield),field_spws in groups.items():
+        # Fields calibrated in the same SPWs can be selected together
+        by_spws = collections.OrderedDict()
+        for field,spws in field_spws.items():
+            by_spws.setdefault(tuple(sorted(spws)),[]).append(field)
+        for spws,fields in by_spws.items():
+            merged.append({'field': ','.join(fields), 'spw': ','.join([str(spw) for spw in spws]),
+                           'gaintable': list(gaintable), 'gainfield': list(gainfield)})
+    return merged
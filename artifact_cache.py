@@ -0,0 +1,421 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+
+# Content-addressed store of the products of the pipeline steps, used by hi_segmented_pipeline.py.
+# Each entry is keyed by a hash of everything the step depends on (the checksums of the archive files, its parameters,
+# the pipeline code and the key of the products it starts from), so the same entry is found by any run with the same inputs.
+# Layout of the store:
+#   objects/<key>/files/...   the products, with the same paths as in the execution directory
+#   objects/<key>/entry.json  the step, products, parameters written by the step, size and use of the entry
+#   aliases/<key>             the key of an entry that is also valid for this key
+#   checksums.json            checksums of the archive files, so each file is only read once
+#   stats.json                number of hits and misses
+#   lock                      serialises changes to the shared files and evictions
+
+# Linux ioctl that makes a copy-on-write clone of a file (reflink)
+FICLONE = 0x40049409
+
+# Placeholder for the project name in the paths of the products, so entries can be restored by other projects
+project_tag = '{project}'
+
+
+def lock(root):
+    """
+    Takes the lock of the store (released when the returned file is closed).
+
+    Input:
+    root = Path of the store. (String)
+
+    Output:
+    lock_file = The open lock file. (File)
+    """
+    lock_file = open(os.path.join(root, 'lock'), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def read_json(path, default):
+    """
+    Reads a JSON file, returning a default if it does not exist or is incomplete.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, value):
+    """
+    Replaces a JSON file in one go.
+    """
+    tmp_file = '{0}.tmp{1}'.format(path, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, path)
+
+
+def init_store(root):
+    """
+    Creates the directories of the store if needed.
+    """
+    for name in ['objects', 'aliases']:
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+
+
+def hash_value(value):
+    """
+    Returns the key (SHA-1) of a JSON serialisable value.
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_checksum(path, root):
+    """
+    Returns the SHA-1 of the contents of a file. The checksums are remembered in the store (by path, size and modification time),
+    so an unchanged archive file is only read once.
+
+    Input:
+    path = Path of the file. (String)
+    root = Path of the store. (String)
+
+    Output:
+    checksum = SHA-1 of the contents. (String)
+    """
+    path = os.path.abspath(path)
+    path_stat = os.stat(path)
+    memo_key = '{0}:{1}:{2}'.format(path, path_stat.st_size, path_stat.st_mtime_ns)
+    memo_file = os.path.join(root, 'checksums.json')
+    checksum = read_json(memo_file, {}).get(memo_key)
+    if checksum is not None:
+        return checksum
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha1.update(block)
+    checksum = sha1.hexdigest()
+    with lock(root):
+        memo = read_json(memo_file, {})
+        memo[memo_key] = checksum
+        write_json(memo_file, memo)
+    return checksum
+
+
+def tree_checksum(path, root):
+    """
+    Returns a checksum of the names and contents of all the files in a directory (or of a single file).
+
+    Input:
+    path = Path of the directory. (String)
+    root = Path of the store. (String)
+    """
+    if os.path.isfile(path):
+        return file_checksum(path, root)
+    checksums = []
+    for dirpath, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(dirpath, name)
+            checksums.append([os.path.relpath(file_path, path), file_checksum(file_path, root)])
+    return hash_value(checksums)
+
+
+def copy_file(src, dst, mutable):
+    """
+    Copies a file into or out of the store without duplicating its data where possible: a reflink (copy-on-write clone)
+    if the file system supports it, otherwise a hard link for products that are never modified in place,
+    and a full copy for those that are (measurement sets).
+
+    Input:
+    src = Path of the file to copy. (String)
+    dst = Path of the copy. (String)
+    mutable = Whether later steps may modify the file in place. (Boolean)
+
+    Output:
+    method = 'reflink', 'hardlink' or 'copy'. (String)
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except OSError:
+            method = None
+    if method is not None:
+        shutil.copystat(src, dst)
+        return method
+    if not mutable:
+        os.remove(dst)
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def copy_product(src, dst, mutable):
+    """
+    Copies a product (a file or a directory, e.g. a table) with copy_file. CASA table lock files are not copied.
+
+    Output:
+    methods = Number of files copied with each method. (Dictionary)
+    """
+    methods = {}
+    if os.path.isfile(src):
+        method = copy_file(src, dst, mutable)
+        methods[method] = 1
+        return methods
+    for dirpath, dirs, files in os.walk(src):
+        dst_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(dst_dir, exist_ok=True)
+        for name in files:
+            if name == 'table.lock':
+                continue
+            method = copy_file(os.path.join(dirpath, name), os.path.join(dst_dir, name), mutable)
+            methods[method] = methods.get(method, 0)+1
+    return methods
+
+
+def remove_product(path):
+    """
+    Removes a product (a file, a directory or a symbolic link) from the execution directory.
+    """
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def product_size(path):
+    """
+    Returns the size (in bytes) of a product, as stored (without CASA table lock files).
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for dirpath, dirs, files in os.walk(path):
+        for name in files:
+            if name != 'table.lock':
+                size += os.path.getsize(os.path.join(dirpath, name))
+    return size
+
+
+def resolve(root, key):
+    """
+    Follows the alias of a key, if there is one.
+    """
+    alias_file = os.path.join(root, 'aliases', key)
+    if os.path.exists(alias_file):
+        with open(alias_file, 'r') as f:
+            return f.read().strip()
+    return key
+
+
+def count(root, outcome):
+    """
+    Adds a hit or a miss to the statistics of the store.
+    """
+    with lock(root):
+        stats_file = os.path.join(root, 'stats.json')
+        stats = read_json(stats_file, {'hits': 0, 'misses': 0})
+        stats[outcome] = stats.get(outcome, 0)+1
+        write_json(stats_file, stats)
+
+
+def lookup(root, key):
+    """
+    Finds the entry of a key in the store and marks it as used (for the LRU eviction).
+
+    Input:
+    root = Path of the store. (String)
+    key = Key of the step's inputs. (String)
+
+    Output:
+    entry = The entry, or None if it is not in the store. (Dictionary)
+    """
+    init_store(root)
+    with lock(root):
+        entry_dir = os.path.join(root, 'objects', resolve(root, key))
+        entry = read_json(os.path.join(entry_dir, 'entry.json'), None)
+        if entry is not None:
+            entry['last_used'] = time.time()
+            entry['hits'] = entry.get('hits', 0)+1
+            write_json(os.path.join(entry_dir, 'entry.json'), entry)
+            entry['dir'] = entry_dir
+    count(root, 'misses' if entry is None else 'hits')
+    return entry
+
+
+def restore(entry, project):
+    """
+    Restores the products of an entry into the execution directory, replacing any existing copies.
+
+    Input:
+    entry = The entry (from lookup). (Dictionary)
+    project = Project name, substituted for the placeholder in the paths of the products. (String)
+
+    Output:
+    methods = Number of files restored with each method. (Dictionary)
+    """
+    methods = {}
+    for product in entry['products']:
+        path = product['path'].replace(project_tag, project)
+        remove_product(path)
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        copied = copy_product(os.path.join(entry['dir'], 'files', product['path']), path, product['mutable'])
+        for method in copied:
+            methods[method] = methods.get(method, 0)+copied[method]
+    return methods
+
+
+def save(root, key, products, project, info, aliases=[]):
+    """
+    Stores the products of a step that has just completed.
+
+    Input:
+    root = Path of the store. (String)
+    key = Key of the step's inputs. (String)
+    products = Paths of the products in the execution directory and whether later steps modify them in place. (List of Tuples)
+    project = Project name, replaced by a placeholder in the paths of the products. (String)
+    info = Other information to keep in the entry (e.g. the step, and parameters it wrote). (Dictionary)
+    aliases = Other keys for which the entry is valid. (List of Strings)
+
+    Output:
+    size = Size of the entry (in bytes). (Integer)
+    """
+    init_store(root)
+    tmp_dir = os.path.join(root, 'objects', 'tmp.{0}.{1}'.format(key, os.getpid()))
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    entry = dict(info)
+    entry['key'] = key
+    entry['products'] = []
+    entry['size'] = 0
+    for path, mutable in products:
+        stored_path = path
+        if path.startswith(project):
+            stored_path = project_tag+path[len(project):]
+        dst = os.path.join(tmp_dir, 'files', stored_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        copy_product(path, dst, mutable)
+        entry['products'].append({'path': stored_path, 'mutable': mutable})
+        entry['size'] += product_size(path)
+    entry['created'] = entry['last_used'] = time.time()
+    entry['hits'] = 0
+    write_json(os.path.join(tmp_dir, 'entry.json'), entry)
+    with lock(root):
+        entry_dir = os.path.join(root, 'objects', key)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(tmp_dir, entry_dir)
+        for alias in aliases:
+            if alias != key:
+                with open(os.path.join(root, 'aliases', alias), 'w') as f:
+                    f.write(key+'\n')
+    return entry['size']
+
+
+def entries(root):
+    """
+    Returns the entries in the store.
+
+    Output:
+    entries = The entries, with the path of their directory. (List of Dictionaries)
+    """
+    found = []
+    objects_dir = os.path.join(root, 'objects')
+    if not os.path.isdir(objects_dir):
+        return found
+    for name in os.listdir(objects_dir):
+        entry = read_json(os.path.join(objects_dir, name, 'entry.json'), None)
+        if entry is not None and not name.startswith('tmp.'):
+            entry['dir'] = os.path.join(objects_dir, name)
+            found.append(entry)
+    return found
+
+
+def evict(root, max_size, keep=[]):
+    """
+    Removes the least recently used entries until the store is no larger than a limit.
+    Sizes are those of the products, files shared with the execution directory (links and reflinks) are counted in full.
+
+    Input:
+    root = Path of the store. (String)
+    max_size = Maximum size of the store (in bytes). (Integer)
+    keep = Keys of entries that must not be removed (e.g. the one just stored). (List of Strings)
+
+    Output:
+    evicted = Keys of the removed entries. (List of Strings)
+    """
+    evicted = []
+    with lock(root):
+        current = sorted(entries(root), key=lambda entry: entry.get('last_used', 0))
+        total = sum(entry['size'] for entry in current)
+        for entry in current:
+            if total <= max_size:
+                break
+            if entry['key'] in keep:
+                continue
+            shutil.rmtree(entry['dir'])
+            total -= entry['size']
+            evicted.append(entry['key'])
+        aliases_dir = os.path.join(root, 'aliases')
+        if len(evicted) > 0 and os.path.isdir(aliases_dir):
+            for alias in os.listdir(aliases_dir):
+                if resolve(root, alias) in evicted:
+                    os.remove(os.path.join(aliases_dir, alias))
+    return evicted
+
+
+def entries_by_step(current):
+    """
+    Groups entries by the step that made them.
+    """
+    steps = {}
+    for entry in current:
+        steps.setdefault(entry.get('step', 'unknown'), []).append(entry)
+    return steps
+
+
+def stats(root, max_size=None):
+    """
+    Returns a report of the contents and use of the store.
+
+    Input:
+    root = Path of the store. (String)
+    max_size = Size limit of the store (in bytes), if any. (Integer)
+
+    Output:
+    report = Lines of the report. (List of Strings)
+    """
+    current = entries(root)
+    usage = read_json(os.path.join(root, 'stats.json'), {'hits': 0, 'misses': 0})
+    total = sum(entry['size'] for entry in current)
+    gb = 1024.**3
+    report = ['Artifact cache: {}'.format(os.path.abspath(root))]
+    limit = ''
+    if max_size is not None:
+        limit = ' (limit {:.2f} GB)'.format(max_size/gb)
+    report.append('Entries: {0}, size: {1:.2f} GB{2}'.format(len(current), total/gb, limit))
+    lookups = usage.get('hits', 0)+usage.get('misses', 0)
+    rate = 0.
+    if lookups > 0:
+        rate = 100.*usage.get('hits', 0)/lookups
+    report.append('Lookups: {0}, hits: {1}, misses: {2} (hit rate {3:.1f}%)'.format(lookups, usage.get('hits', 0), usage.get('misses', 0), rate))
+    steps = entries_by_step(current)
+    for step in sorted(steps):
+        step_entries = steps[step]
+        report.append('  {0}: {1} entries, {2:.2f} GB, {3} hits'.format(step, len(step_entries), sum(entry['size'] for entry in step_entries)/gb,
+                                                                     sum(entry.get('hits', 0) for entry in step_entries)))
+    if len(current) > 0:
+        oldest = min(current, key=lambda entry: entry.get('last_used', 0))
+        report.append('Least recently used: {0} ({1}, last used {2})'.format(oldest['key'][:12], oldest.get('step'),
+                                                                          time.strftime('%Y-%m-%d %H:%M', time.localtime(oldest.get('last_used', 0)))))
+    return report
+
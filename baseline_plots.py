@@ -1,8 +1,115 @@
-import sys
+import os, sys, glob
+import imp
+imp.load_source('ms_metadata','ms_metadata.py')
+import ms_metadata as mm
+imp.load_source('plot_queue','plot_queue.py')
+import plot_queue as pq
+imp.load_source('vis_cache','vis_cache.py')
+import vis_cache as vc
+imp.load_source('vis_plots','vis_plots.py')
+import vis_plots as vp
+import logging
 
-vis = sys.argv[3]
-fields = sys.argv[4]
-chanavg = sys.argv[5]
+# Usage: casa -c baseline_plots.py <vis> <fields> [chanavg] [nproc=N] [gridrows=N] [gridcols=N]
+# The baselines are split into pages of gridrows x gridcols, which are drawn by up to nproc processes at once (default 4).
+# Without chanavg the pages are drawn from the visibility cache (amplitudes averaged over all channels, in bins of vis_cache.time_bin seconds),
+# otherwise each page is a plotms call with the given channel averaging.
+# The page of each baseline is listed in plots/baseline_plots/baseline_plot_index.txt.
 
-command = "plotms(vis='{0}', gridrows=2, gridcols=2, xaxis='time', yaxis='amp', field='{1}', avgchannel='{2}', iteraxis='baseline', exprange='all', xselfscale=True, yselfscale=True, plotfile='plots/baseline_plots/baseline_plot.png', coloraxis='scan', showgui=False)".format(vis,fields,chanavg)
-exec(command)
+def ms_baselines(meta):
+    """
+    Returns the names of the antennas of each baseline of an MS (ignoring flagged antennas), in antenna order.
+
+    Input:
+    meta = The metadata of the MS. (Dictionary)
+
+    Output:
+    baselines = (antenna1, antenna2) names of each baseline. (List of Tuples)
+    """
+    names = set(baseline[0] for baseline in meta['baselines'])
+    ants = meta['antennas']
+    baselines = []
+    for i in range(len(ants)):
+        for j in range(i+1,len(ants)):
+            if '{0}-{1}'.format(ants[i],ants[j]) in names:
+                baselines.append((ants[i],ants[j]))
+    return baselines
+
+def plotms_pages(vis,fields,chanavg,baselines,plot_root,gridrows,gridcols,nproc,logger):
+    """
+    Plots each page of baselines with plotms, running the pages in parallel CASA processes (see plot_queue.py).
+
+    Input:
+    vis = Path to the MS. (String)
+    fields = Fields to plot. (String)
+    chanavg = Number of channels to average. (String)
+    baselines = (antenna1, antenna2) names of each baseline. (List of Tuples)
+    plot_root = Root of the PNG files to write, the page number is appended. (String)
+    gridrows, gridcols = Number of rows and columns of baselines on each page. (Integers)
+    nproc = Maximum number of processes to use. (Integer)
+
+    Output:
+    pages = The files written and the names of the baselines on each page. (List of Tuples)
+    """
+    per_page = gridrows*gridcols
+    pq.start_plot_queue(nproc if nproc > 1 else 0,logger)
+    pages = []
+    for page in range(0,len(baselines),per_page):
+        page_baselines = baselines[page:page+per_page]
+        plot_file = '{0}_{1}.png'.format(plot_root,page//per_page)
+        pq.queue_plot('plotms',dict(vis=vis, gridrows=gridrows, gridcols=gridcols, xaxis='time', yaxis='amp', field=fields, avgchannel=chanavg,
+                                    antenna=';'.join('{0}&{1}'.format(ant1,ant2) for ant1,ant2 in page_baselines),
+                                    iteraxis='baseline', exprange='all', xselfscale=True, yselfscale=True, plotfile=plot_file,
+                                    coloraxis='scan', showgui=False, overwrite=True),[vis],logger,globals())
+        pages.append((plot_file,['{0}-{1}'.format(ant1,ant2) for ant1,ant2 in page_baselines]))
+    pq.wait_for_plots(logger)
+    # plotms adds the iteration to the name of the file
+    written = []
+    for plot_file,names in pages:
+        files = sorted(glob.glob(plot_file)+glob.glob(os.path.splitext(plot_file)[0]+'_*.png'))
+        if len(files) > 0:
+            written.append((files[0],names))
+    return written
+
+def write_page_index(pages,index_file,logger):
+    """
+    Writes the page of each baseline to a text file.
+
+    Input:
+    pages = The file and the names of the baselines on each page. (List of Tuples)
+    index_file = Path of the file to write. (String)
+    """
+    out_file = open(index_file,'w')
+    for plot_file,names in pages:
+        for name in names:
+            out_file.write('{0} {1}\n'.format(name,os.path.basename(plot_file)))
+    out_file.close()
+    logger.info('Baseline page index written to: {}'.format(index_file))
+
+logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(message)s')
+logger = logging.getLogger('baseline_plots')
+args = [arg for arg in sys.argv[3:] if '=' not in arg]
+options = dict(arg.split('=',1) for arg in sys.argv[3:] if '=' in arg)
+vis = args[0]
+fields = args[1]
+nproc = int(options.get('nproc',4))
+gridrows = int(options.get('gridrows',2))
+gridcols = int(options.get('gridcols',2))
+plot_dir = 'plots/baseline_plots/'
+plot_root = plot_dir+'baseline_plot'
+if not os.path.exists(plot_dir):
+    os.makedirs(plot_dir)
+meta = mm.get_metadata(vis,msmd,tb,logger)
+
+if len(args) > 2:
+    pages = plotms_pages(vis,fields,args[2],ms_baselines(meta),plot_root,gridrows,gridcols,nproc,logger)
+else:
+    field_list = [field.strip() for field in fields.split(',') if field.strip() != '']
+    field_list = [meta['fields'][int(field)] if field.isdigit() else field for field in field_list]
+    if len(field_list) == 0:
+        field_list = None
+    cache = vc.build_cache(vis,'DATA',meta,tb,logger,field_list)
+    entries = [entry for key,entry in vc.entries_for(vis,'DATA',cache,field_list)]
+    pages = vp.plot_baselines(entries,plot_root,'{0} ({1})'.format(vis,fields),gridrows,gridcols,nproc)
+logger.info('Wrote {} baseline plot page(s) to {}.'.format(len(pages),plot_dir))
+write_page_index(pages,plot_root+'_index.txt',logger)
@@ -0,0 +1,104 @@
+import os, sys, time, json, socket, logging, traceback
+
+# Long-lived CASA process that executes pipeline scripts sent by hi_segmented_pipeline.py.
+# Started as: casa --nologger --nogui -c casa_worker.py <socket path>
+# Each request is a single line of JSON: {"script": "clean_image.py", "args": ["target=HCG16", "PROJECTID_params.cfg"]}
+# and the reply is a single line of JSON: {"status": 0, "casalog": "casa-clean_image-20190101-120000-12345.log"}
+
+def close_tools():
+    """
+    Makes sure the CASA tools shared between jobs are not left attached to a data set.
+    """
+    for tool_name,method in [('tb','close'),('msmd','done'),('ia','close')]:
+        if tool_name in casa_namespace:
+            try:
+                getattr(casa_namespace[tool_name],method)()
+            except Exception:
+                pass
+
+def run_job(job):
+    """
+    Executes a pipeline script in a fresh copy of the CASA namespace (tasks and tools already loaded).
+
+    Input:
+    job = The script to execute and its command line arguments. (Dictionary)
+
+    Output:
+    status = Exit status of the script, 0 for success. (Integer)
+    logfile = The casalog file that the script wrote to. (String)
+    """
+    script = job['script']
+    # Jobs of the same script can start in the same second in different workers, so the pid keeps their casalogs apart
+    logfile = 'casa-{0}-{1}-{2}.log'.format(os.path.splitext(os.path.basename(script))[0],time.strftime('%Y%m%d-%H%M%S'),os.getpid())
+    casalog.setlogfile(os.path.abspath(logfile))
+    sys.argv = [script]+list(job['args'])
+    namespace = dict(casa_namespace)
+    namespace['__name__'] = '__main__'
+    namespace['__file__'] = script
+    status = 0
+    try:
+        exec(compile(open(script).read(),script,'exec'),namespace)
+    except SystemExit as err:
+        if err.code is None:
+            status = 0
+        elif isinstance(err.code,int):
+            status = err.code
+        else:
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        # cf.get_logger adds new handlers every time a script starts
+        logger = logging.getLogger('logger')
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+        close_tools()
+        sys.stdout.flush()
+    return status,logfile
+
+def serve(socket_path):
+    """
+    Waits for jobs on a local socket and runs them one at a time until asked to shut down.
+
+    Input:
+    socket_path = Path of the Unix socket to listen on. (String)
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    print('CASA worker {0} listening on {1}'.format(os.getpid(),socket_path))
+    try:
+        while True:
+            conn,addr = server.accept()
+            stream = conn.makefile('rw')
+            try:
+                line = stream.readline()
+                if not line:
+                    continue
+                job = json.loads(line)
+                if job.get('command') == 'shutdown':
+                    stream.write(json.dumps({'status': 0})+'\n')
+                    stream.flush()
+                    break
+                print('Starting job: {0} {1}'.format(job['script'],' '.join(job['args'])))
+                start = time.time()
+                status,logfile = run_job(job)
+                print('Finished job: {0} (status {1}, {2:.0f} s)'.format(job['script'],status,time.time()-start))
+                stream.write(json.dumps({'status': status, 'casalog': logfile})+'\n')
+                stream.flush()
+            finally:
+                stream.close()
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# Snapshot of the CASA session (tasks, tools, casalog) that every job starts from
+casa_namespace = dict(globals())
+serve(sys.argv[-1])
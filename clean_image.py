@@ -1,60 +1,14 @@
-import imp, numpy, glob, shutil
+import imp, os, numpy, glob, shutil
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
+imp.load_source('ms_metadata','ms_metadata.py')
+import ms_metadata as mm
+imp.load_source('noise','noise.py')
+import noise
+imp.load_source('masking','masking.py')
+import masking
 
-def noise_est(config,logger):
-    """
-    Makes an estimate of the theortically expected noise level for each science target.
-    
-    Input:
-    config = The parameters read from the configuration file. (Ordered dictionary)
-    
-    Output:
-    noise = Estimate of the theortical noise in Jy/beam. (List of Floats)
-    """
-    logger.info('Starting making noise estimation.')
-    targets = config['calibration']['target_names'][:]
-    calib = config['calibration']
-    if calib['mosaic']:
-        targets = list(set(calib['target_names']))
-    cln_param = config['clean']
-    src_dir = config['global']['src_dir']+'/'
-    noise = []
-    for target in targets:
-        msmd.open(src_dir+target+'.split.contsub')
-        N = msmd.nantennas()
-        t_int = msmd.effexposuretime()['value']
-        t_unit = msmd.effexposuretime()['unit']
-        if t_unit != 's' and 'sec' not in t_unit:
-            logger.warning('Integration time units are not in seconds. Estimated noise may be incorrect.')
-        ch_wid = numpy.mean(msmd.chanwidths(0))
-        #Note: The above line may cause issues if different spectral windows
-        #have very difference frequency resolutions
-        corr_eff = cln_param['corr_eff']
-        SEFD = cln_param['sefd']
-        N_pol = 2.
-        f_smo = 1.
-        if config_raw.has_option('importdata','hanning'):
-            if config['importdata']['hanning']:
-                if not config['importdata']['mstransform']:
-                    f_smo = 8./3.
-                else:
-                    if not config_raw.has_option('importdata','chanavg'):
-                        f_smo = 8./3.
-                    else:
-                        Nchan = float(config['importdata']['chanavg'])
-                        if Nchan > 1.:
-                            f_smo = Nchan/((Nchan-2.) + 2.*(9./16.) + 2.*(1./16.))
-                        else:
-                            f_smo = 8./3.
-        noise.append(SEFD/(corr_eff*numpy.sqrt(f_smo*N_pol*N*(N-1.)*t_int*ch_wid)))
-        logger.info('Effective integration time for {0}: {1} {2}'.format(target,int(t_int),msmd.effexposuretime()['unit']))
-        logger.info('Expected rms noise for {0}: {1} Jy/beam'.format(target,SEFD/(corr_eff*numpy.sqrt(f_smo*N_pol*N*(N-1.)*t_int*ch_wid))))
-        msmd.close()
-    logger.info('Completed making noise estimation.')
-    return noise
-
-def image(config,config_raw,config_file,logger):
+def image(config,config_raw,config_file,logger,selection=None):
     """
     Generates a clean (continuum subtracted) image of each science target.
     Checks that the CLEANing scales and line emission channels are set (may prompt user if in interactive mode).
@@ -65,8 +19,9 @@ def image(config,config_raw,config_file,logger):
     config = The parameters read from the configuration file. (Ordered dictionary)
     config_raw = The instance of the parser.
     config_file = Path to configuration file. (String)
+    selection = Names of the targets to process, None for all. (List of Strings)
     """
-    noises = noise_est(config,logger)
+    noises = noise.noise_est(config,config_raw,logger,ia,msmd,tb,selection)
     cln_param = config['clean']
     if config_raw.has_option('clean','noise'):
         noises = cln_param['noise'][:]
@@ -164,6 +119,8 @@ def image(config,config_raw,config_file,logger):
         scales = None
     for i in range(len(targets)):
         target = targets[i]
+        if not cf.target_selected(target,selection):
+            continue
         field = fields[i]
         if numpy.all(cln_param['multiscale']):
             ms_clean = True
@@ -242,14 +199,13 @@ def image(config,config_raw,config_file,logger):
             pix_per_beam = rest_beam['major']['value']/pix_size
             scales = cln_param['beam_scales']
             scales = list(numpy.array(numpy.array(scales)*pix_per_beam,dtype='int'))
-            B_min = au.getBaselineLengths('{0}{1}.split.contsub'.format(src_dir,target), sort=True)[0][1]
-            msmd.open('{0}{1}.split.contsub'.format(src_dir,target))
-            spws = msmd.spwsforfield(field)
+            meta = mm.get_metadata('{0}{1}.split.contsub'.format(src_dir,target),msmd,tb,logger)
+            B_min = meta['baselines'][0][1]
+            spws = mm.spws_for_field(meta,field)
             f_min = None
             for spw in spws:
-                if f_min == None or f_min > min(msmd.chanfreqs(spw=spw,unit='Hz')):
-                    f_min = min(msmd.chanfreqs(spw=spw,unit='Hz'))
-            msmd.close()
+                if f_min == None or f_min > min(meta['chan_freqs'][spw]):
+                    f_min = min(meta['chan_freqs'][spw])
             max_scale = 180.*3600.*299792458./(1.2*numpy.pi*f_min*B_min)
             logger.info('The maximum recoverable scale for {0} is {1} arcsec.'.format(target,int(max_scale)))
             if 'arcsec' not in cln_param['pix_size'][i]:
@@ -267,6 +223,18 @@ def image(config,config_raw,config_file,logger):
             mask = 'auto-multithresh'
         else:
             mask = 'pb'
+        user_mask = ''
+        if config_raw.has_option('clean','mask_engine') and cln_param['mask_engine'] == 'smooth_clip':
+            if os.path.isdir(img_dir+target+'.dirty.image'):
+                mask_params = {}
+                for key,name in [('mask_kernels_xy','kernels_xy'),('mask_kernels_z','kernels_z'),('mask_thresh','thresh')]:
+                    if config_raw.has_option('clean',key):
+                        mask_params[name] = cln_param[key]
+                # The dirty cube covers all the channels, the clean cube only line_ch, so the mask is regridded onto the clean grid below
+                masking.smooth_clip_mask(img_dir+target+'.dirty.image',img_dir+target+'.sc.dirty.mask',ia,logger,**mask_params)
+                user_mask = img_dir+target+'.sc.mask'
+            else:
+                logger.warning('No dirty cube found for {0}. Using the {1} mask instead.'.format(target,mask))
         gridder = 'wproject'
         if calib['mosaic']:
             for target_name in targets:
@@ -274,7 +242,26 @@ def image(config,config_raw,config_file,logger):
                 fields = numpy.array(calib['targets'],dtype='str')[inx]
             field = ','.join(fields)
             gridder = 'mosaic'
-        command = "tclean(vis='{0}{1}'+'.split.contsub', field='{2}', spw='{3}', imagename='{4}{1}', cell='{5}', imsize=[{6},{6}], specmode='cube', outframe='bary', veltype='radio', restfreq='{7}', gridder='{8}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='{9}', scales={10}, restoringbeam='common', pbcor=True, weighting='briggs', robust={11}, niter=100000, gain=0.1, threshold='{12}Jy', usemask='{13}', phasecenter='{14}', sidelobethreshold={15}, noisethreshold={16}, lownoisethreshold={17}, minbeamfrac={18}, negativethreshold={19}, cyclefactor=2.0,interactive=False)".format(src_dir,target,field,cln_param['line_ch'][i],img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,algorithm,scales,cln_param['robust'],noises[i]*cln_param['thresh'],mask,cln_param['phasecenter'],cln_param['automask_sl'],cln_param['automask_ns'],cln_param['automask_lns'],cln_param['automask_mbf'],cln_param['automask_neg'])
+        tclean_command = "tclean(vis='{0}{1}'+'.split.contsub', field='{2}', spw='{3}', imagename='{4}{1}', cell='{5}', imsize=[{6},{6}], specmode='cube', outframe='bary', veltype='radio', restfreq='{7}', gridder='{8}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='{9}', scales={10}, restoringbeam='common', pbcor=True, weighting='briggs', robust={11}, niter={22}, gain=0.1, threshold='{12}Jy', usemask='{13}', mask='{20}', phasecenter='{14}', sidelobethreshold={15}, noisethreshold={16}, lownoisethreshold={17}, minbeamfrac={18}, negativethreshold={19}, cyclefactor=2.0,interactive=False, parallel={21}{23})"
+        tclean_params = [src_dir,target,field,cln_param['line_ch'][i],img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,algorithm,scales,cln_param['robust'],noises[i]*cln_param['thresh'],mask,cln_param['phasecenter'],cln_param['automask_sl'],cln_param['automask_ns'],cln_param['automask_lns'],cln_param['automask_mbf'],cln_param['automask_neg'],'',cf.mpi_enabled(),100000,'']
+        if user_mask != '':
+            logger.info('Making the PSF and residual of {} to define the grid of the clean cube.'.format(target))
+            tclean_params[22] = 0
+            command = tclean_command.format(*tclean_params)
+            logger.info('Executing command: '+command)
+            exec(command)
+            cf.check_casalog(config,config_raw,logger,casalog)
+            logger.info('Regridding the smooth and clip mask onto the grid of the clean cube.')
+            command = "imregrid(imagename='{0}{1}.sc.dirty.mask', template='{0}{1}.residual', output='{2}', asvelocity=True, interpolation='nearest', overwrite=True)".format(img_dir,target,user_mask)
+            logger.info('Executing command: '+command)
+            exec(command)
+            cf.check_casalog(config,config_raw,logger,casalog)
+            # Continue from the PSF and residual just made
+            tclean_params[13] = 'user'
+            tclean_params[20] = user_mask
+            tclean_params[22] = 100000
+            tclean_params[23] = ', calcres=False, calcpsf=False'
+        command = tclean_command.format(*tclean_params)
         logger.info('Executing command: '+command)
         exec(command)
         cf.check_casalog(config,config_raw,logger,casalog)
@@ -307,6 +294,16 @@ def image(config,config_raw,config_file,logger):
         logger.info('Executing command: '+command)
         exec(command)
         cf.check_casalog(config,config_raw,logger,casalog)
+        if user_mask != '':
+            logger.info('Regridding {0} to match {1} for the moment maps.'.format(user_mask,imagename))
+            command = "imregrid(imagename='{0}', template='{1}{2}', output='{0}.regrid', asvelocity=True, interpolation='nearest', overwrite=True)".format(user_mask,img_dir,imagename)
+            logger.info('Executing command: '+command)
+            exec(command)
+            cf.check_casalog(config,config_raw,logger,casalog)
+            command = "exportfits(imagename='{0}.regrid', fitsimage='{1}{2}_HI.mask.fits', velocity=True,optical=False,overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)".format(user_mask,img_dir,target)
+            logger.info('Executing command: '+command)
+            exec(command)
+            cf.check_casalog(config,config_raw,logger,casalog)
         fitsname = target+'_HI.pbcor.fits'
         logger.info('Saving primary beam corrected image cube as {}'.format(fitsname))
         if coord_chn:
@@ -333,13 +330,19 @@ logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['projec
 # Define MS file name
 msfile = '{0}.ms'.format(config['global']['project_name'])
 
+# Targets to process (all unless run as a per-target job)
+selection = cf.get_target_selection(logger)
+
 #Remove previous image files
 targets = config['calibration']['target_names']
 img_path = config['global']['img_dir']+'/'
 cf.check_casaversion(logger)
+cf.start_casalog_watchdog(config,config_raw,logger,casalog)
 logger.info('Deleting any existing clean image(s).')
 for target in targets:
-    del_list = [img_path+target+'.mask',img_path+target+'.model',img_path+target+'.pb',img_path+target+'.psf',img_path+target+'.residual',img_path+target+'.sumwt',img_path+target+'.weight']
+    if not cf.target_selected(target,selection):
+        continue
+    del_list = [img_path+target+'.mask',img_path+target+'.sc.mask',img_path+target+'.sc.dirty.mask',img_path+target+'.sc.mask.regrid',img_path+target+'.model',img_path+target+'.pb',img_path+target+'.psf',img_path+target+'.residual',img_path+target+'.sumwt',img_path+target+'.weight']
     del_list.extend(glob.glob(img_path+'{}.image*'.format(target)))
     if len(del_list) > 0:
         for file_path in del_list:
@@ -347,7 +350,7 @@ for target in targets:
                 shutil.rmtree(file_path)
             except OSError:
                 pass
-    del_list = [img_path+target+'_HI.fits',img_path+target+'_HI.pbcor.fits']
+    del_list = [img_path+target+'_HI.fits',img_path+target+'_HI.pbcor.fits',img_path+target+'_HI.mask.fits']
     for file_path in del_list:
         try:
             os.remove(file_path)
@@ -355,7 +358,7 @@ for target in targets:
             pass
             
 #Make clean image
-image(config,config_raw,config_file,logger)
+image(config,config_raw,config_file,logger,selection)
 
 #Review and backup parameters file
 cf.diff_pipeline_params(config_file,logger)
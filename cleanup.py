@@ -27,15 +27,22 @@ def cleanup(config,logger):
         cf.rmdir('./cal_tabs',logger)
         logger.info('Deleting flag tables.')
         cf.rmdir('./{}.flagversions'.format(msfile),logger)
+        cf.rmdir('./{}.flagstore'.format(msfile),logger)
         logger.info('Deleting full measurement set.')
         cf.rmdir('./{}'.format(msfile),logger) 
+        cf.rmfile('./{}.metadata.json'.format(msfile),logger)
+        cf.rmdir('./{}.viscache'.format(msfile),logger)
+        cf.rmdir('./{}.parts'.format(msfile),logger)
     if cln_lvl >= 2:       
         logger.info('Deleting dirty images.')
         del_list = glob.glob(img_dir+'*.dirty.*')
         for file_path in del_list:
-            cf.rmdir(file_path,logger)
+            if file_path.endswith('.noise.txt'):
+                cf.rmfile(file_path,logger)
+            else:
+                cf.rmdir(file_path,logger)
         logger.info('Deleting CLEANing masks.')
-        del_list = glob.glob(img_dir+'*.mask')
+        del_list = glob.glob(img_dir+'*.mask')+glob.glob(img_dir+'*.sc.mask.regrid')
         for file_path in del_list:
             cf.rmdir(file_path,logger)
         logger.info('Deleting CLEAN models.')
@@ -10,6 +10,7 @@ import ConfigParser
 from ast import literal_eval
 import glob
 import collections
+import threading
 import casadef
 
 
@@ -124,6 +125,69 @@ def rmfile(pathdir,logger):
             logger.debug('Could not delete: {0}'.format(pathdir))
             pass
         
+#Target selection
+def get_target_selection(logger):
+    '''
+    Reads the (optional) targets passed on the command line as 'target=NAME' before the configuration file.
+
+    Output:
+    selection = Names of the targets to be processed or None if all targets should be processed. (List of Strings)
+    '''
+    selection = [arg.split('=',1)[1] for arg in sys.argv[:-1] if arg.startswith('target=')]
+    if len(selection) == 0:
+        return None
+    logger.info('Only the following target(s) will be processed: {}'.format(selection))
+    return selection
+
+def target_selected(target,selection):
+    '''
+    Checks if a target should be processed.
+
+    Input:
+    target = Name of the target. (String)
+    selection = Names of the selected targets or None for all targets. (List of Strings)
+
+    Output:
+    True if the target is in the selection or there is no selection. (Boolean)
+    '''
+    return selection is None or target in selection
+
+def plot_engine(config,config_raw):
+    '''
+    Returns how the diagnostic plots of the visibilities are made: 'cache' to draw them from the visibility cache (see vis_cache.py), otherwise 'plotms'.
+
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    '''
+    if config_raw.has_option('global','plot_engine') and config['global']['plot_engine'] == 'cache':
+        return 'cache'
+    return 'plotms'
+
+def partition_axis(config,config_raw):
+    '''
+    Returns the axis ('scan' or 'spw') by which the MS is partitioned into a multi-MS after import, 'none' if it is not partitioned.
+
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    '''
+    if config_raw.has_option('importdata','partition'):
+        axis = str(config['importdata']['partition']).lower()
+        if axis in ['scan','spw']:
+            return axis
+    return 'none'
+
+def mpi_enabled():
+    '''
+    Checks if CASA was started with mpicasa (with at least one MPI server), in which case tasks can process the partitions of a multi-MS in parallel.
+    '''
+    try:
+        from mpi4casa.MPIEnvironment import MPIEnvironment
+    except ImportError:
+        return False
+    return bool(MPIEnvironment.is_mpi_enabled)
+
 #User input function
 def uinput(prompt, default=''):
     '''
@@ -200,21 +264,104 @@ def backup_pipeline_params(configfile,logger):
     logger.info('Backing up {0} to {1}.'.format(configfile,backup_file))
     shutil.copyfile(configfile,backup_file)
     
-def check_casalog(config,config_raw,logger,casalog):
+# Incremental casa log scanning
+# The casa log only grows during a pipeline step, so rather than re-reading the whole file after every task
+# the scanner remembers how far it has read and only processes the lines added since then.
+casalog_index = {}
+
+def reset_casalog_index(logfile=None):
     """
-    Checks the casa log for severe errors.
+    Forgets everything read from the casa log so that the next scan starts from the beginning of the file.
+    
+    Input:
+    logfile = Path of the casa log that will be scanned. (String)
+    """
+    casalog_index['logfile'] = logfile
+    casalog_index['inode'] = None
+    casalog_index['offset'] = 0
+    casalog_index['severe'] = []
+    casalog_index['warn'] = []
+    casalog_index['reported'] = 0
+    if 'searches' not in casalog_index or logfile is None:
+        casalog_index['searches'] = {}
+    else:
+        for search_str in casalog_index['searches'].keys():
+            casalog_index['searches'][search_str] = 0
+
+reset_casalog_index()
+
+def read_casalog_lines(logfile,start,end=None):
     """
-    current_log = open(casalog.logfile(), 'r')
-    casalog_lines = current_log.readlines()
+    Reads the complete lines of the casa log between two byte offsets.
+    
+    Input:
+    logfile = Path of the casa log. (String)
+    start = Byte offset to start reading from. (Integer)
+    end = Byte offset to stop reading at, or None to read to the end of the file. (Integer)
+    
+    Output:
+    lines = The complete lines that were read. (List of Strings)
+    offset = Byte offset just after the last complete line. (Integer)
+    """
+    current_log = open(logfile,'rb')
+    current_log.seek(start)
+    if end is None:
+        data = current_log.read()
+    else:
+        data = current_log.read(end-start)
     current_log.close()
-    sev_err = False
-    for line in casalog_lines:
+    # A line that is still being written is left for the next scan
+    last_newline = data.rfind('\n')
+    if last_newline < 0:
+        return [],start
+    return data[:last_newline].split('\n'),start+last_newline+1
+
+def scan_casalog(casalog):
+    """
+    Reads any lines added to the casa log since the last scan and updates the index of SEVERE and WARN lines and search hits.
+    
+    Input:
+    casalog = The casalog tool of the calling script.
+    
+    Output:
+    new_lines = Number of new lines read. (Integer)
+    """
+    logfile = casalog.logfile()
+    try:
+        log_stat = os.stat(logfile)
+    except OSError:
+        return 0
+    # Start again if CASA has switched to a new log or the log has been replaced or truncated
+    if (logfile != casalog_index['logfile'] or log_stat.st_ino != casalog_index['inode']
+            or log_stat.st_size < casalog_index['offset']):
+        reset_casalog_index(logfile)
+        casalog_index['inode'] = log_stat.st_ino
+    if log_stat.st_size == casalog_index['offset']:
+        return 0
+    lines,casalog_index['offset'] = read_casalog_lines(logfile,casalog_index['offset'])
+    searches = casalog_index['searches']
+    for line in lines:
         if 'SEVERE' in line:
-            if not sev_err:
-                sev_err = True
-                logger.critical('There were severe errors in the CASA log:')
+            casalog_index['severe'].append(line)
+        elif 'WARN' in line:
+            casalog_index['warn'].append(line)
+        for search_str in searches.keys():
+            if search_str in line:
+                searches[search_str] += 1
+    return len(lines)
+
+def check_casalog(config,config_raw,logger,casalog):
+    """
+    Checks the casa log for severe errors.
+    Only the severe errors written since the previous check are reported.
+    """
+    scan_casalog(casalog)
+    new_errs = casalog_index['severe'][casalog_index['reported']:]
+    casalog_index['reported'] = len(casalog_index['severe'])
+    if len(new_errs) > 0:
+        logger.critical('There were severe errors in the CASA log:')
+        for line in new_errs:
             logger.critical(line)
-    if sev_err:
         if config_raw.has_option('global','ignore_errs'):
             if not config['global']['ignore_errs']:
                 sys.exit(-1)
@@ -225,14 +372,86 @@ def search_casalog(search_str,config,config_raw,logger,casalog):
     """
     Searches the casa log for given string.
     """
-    current_log = open(casalog.logfile(), 'r')
-    casalog_lines = current_log.readlines()
-    current_log.close()
-    found = False
-    for line in casalog_lines:
-        if search_str in line:
-            found = True
-    return found
+    scan_casalog(casalog)
+    searches = casalog_index['searches']
+    if search_str not in searches:
+        # First time this string is searched for, so check the part of the log that has already been read
+        hits = 0
+        if casalog_index['offset'] > 0:
+            lines,offset = read_casalog_lines(casalog_index['logfile'],0,casalog_index['offset'])
+            for line in lines:
+                if search_str in line:
+                    hits += 1
+        searches[search_str] = hits
+    return searches[search_str] > 0
+        
+def watch_casalog(config,config_raw,logger,casalog,logfile,poll_interval):
+    """
+    Follows the casa log while a pipeline step runs, aborting on severe errors and reporting stalled tasks.
+    Stops when the calling process switches to a different casa log.
+    
+    Input:
+    logfile = Path of the casa log to follow. (String)
+    poll_interval = Time between reads of the casa log in seconds. (Float)
+    """
+    ignore_errs = config_raw.has_option('global','ignore_errs') and config['global']['ignore_errs']
+    stall_timeout = None
+    if config_raw.has_option('global','stall_timeout'):
+        stall_timeout = config['global']['stall_timeout']
+    try:
+        offset = os.path.getsize(logfile)
+    except OSError:
+        offset = 0
+    task = None
+    task_start = time.time()
+    last_output = time.time()
+    stalled = False
+    while casalog.logfile() == logfile:
+        time.sleep(poll_interval)
+        try:
+            if os.path.getsize(logfile) < offset:
+                offset = 0
+            lines,offset = read_casalog_lines(logfile,offset)
+        except (OSError,IOError):
+            continue
+        now = time.time()
+        if len(lines) > 0:
+            if stalled:
+                logger.warning('CASA task {0} has resumed writing to the log after {1:.0f} s.'.format(task,now-last_output))
+                stalled = False
+            last_output = now
+        for line in lines:
+            if 'Begin Task:' in line:
+                task = line.split('Begin Task:')[1].strip(' #\r')
+                task_start = now
+            elif 'End Task:' in line:
+                task = None
+            elif 'SEVERE' in line and task is not None and not ignore_errs:
+                logger.critical('Severe error in the CASA log during {0} after {1:.0f} s, aborting:'.format(task,now-task_start))
+                logger.critical(line)
+                for handler in logger.handlers:
+                    handler.flush()
+                os._exit(-1)
+        if task is not None and stall_timeout is not None and not stalled and now-last_output > stall_timeout:
+            logger.warning('CASA task {0} has not written to the log for {1:.0f} s ({2:.0f} s since it started).'.format(task,now-last_output,now-task_start))
+            stalled = True
+
+def start_casalog_watchdog(config,config_raw,logger,casalog,poll_interval=1.0):
+    """
+    Starts a background thread that watches the casa log while CASA tasks run (see watch_casalog).
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    logger = Logger of the pipeline step.
+    casalog = The casalog tool of the calling script.
+    poll_interval = Time between reads of the casa log in seconds. (Float)
+    """
+    logfile = casalog.logfile()
+    watchdog = threading.Thread(target=watch_casalog,args=(config,config_raw,logger,casalog,logfile,poll_interval),name='casalog_watchdog')
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
         
 def check_casaversion(logger):
     """
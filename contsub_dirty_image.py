@@ -1,8 +1,14 @@
-import imp, glob, shutil, numpy
+import imp, os, glob, shutil, numpy
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
+imp.load_source('ms_metadata','ms_metadata.py')
+import ms_metadata as mm
+imp.load_source('vis_cache','vis_cache.py')
+import vis_cache as vc
+imp.load_source('vis_plots','vis_plots.py')
+import vis_plots as vp
 
-def contsub(msfile,config,config_raw,config_file,logger):
+def contsub(msfile,config,config_raw,config_file,logger,selection=None):
     """
     Subtracts the continuum from each of the science target MSs.
     If the no line free range is set then the user is queried (in interactive mode) and the configuration file updated.
@@ -12,6 +18,7 @@ def contsub(msfile,config,config_raw,config_file,logger):
     config = The parameters read from the configuration file. (Ordered dictionary)
     config_raw = The instance of the parser.
     config_file = Path to configuration file. (String)
+    selection = Names of the targets to process, None for all. (List of Strings)
     """
     logger.info('Starting continuum subtraction.')
     contsub = config['continuum_subtraction']
@@ -96,6 +103,8 @@ def contsub(msfile,config,config_raw,config_file,logger):
     logger.info('For the targets: {}.'.format(targets))
     for i in range(len(targets)):
         target = targets[i]
+        if not cf.target_selected(target,selection):
+            continue
         field = fields[i]
         if calib['mosaic']:
             for target_name in targets:
@@ -122,12 +131,13 @@ def contsub(msfile,config,config_raw,config_file,logger):
     
 
 
-def plot_spec(config,logger,contsub=False):
+def plot_spec(config,logger,contsub=False,selection=None):
     """
     For each SPW and each science target amplitude vs channel and amplitude vs velocity are plotted.
     
     Input:
     config = The parameters read from the configuration file. (Ordered dictionary)
+    selection = Names of the targets to process, None for all. (List of Strings)
     """
     logger.info('Starting plotting amplitude spectrum.')
     plots_obs_dir = './plots/'
@@ -137,7 +147,10 @@ def plot_spec(config,logger,contsub=False):
     if calib['mosaic']:
         targets = list(set(calib['target_names']))
     src_dir = config['global']['src_dir']+'/'
+    use_cache = cf.plot_engine(config,config_raw) == 'cache'
     for target in targets:
+        if not cf.target_selected(target,selection):
+            continue
         if contsub:
             MS_list = glob.glob('{0}{1}.split.contsub'.format(src_dir,target))
         else:
@@ -147,6 +160,27 @@ def plot_spec(config,logger,contsub=False):
                 plot_file = plots_obs_dir+'{0}_contsub_amp_chn.png'.format(target)
             else:
                 plot_file = plots_obs_dir+'{0}_amp_chn.png'.format(target)
+            if use_cache:
+                column = vc.data_column(MS,tb)
+                cache = vc.build_cache(MS,column,mm.get_metadata(MS,msmd,tb,logger),tb,logger)
+                for key,entry in vc.entries_for(MS,column,cache):
+                    obs,field,spw = key
+                    if len(cache['entries']) > 1:
+                        spw_file = plot_file.replace('.png','_ob{0}_spw{1}.png'.format(obs,spw))
+                    else:
+                        spw_file = plot_file
+                    logger.info('Plotting amplitude vs channel to {}'.format(spw_file))
+                    vp.plot_spectrum([entry],spw_file,'{0} ob{1} spw{2}'.format(target,obs,spw))
+                    if not contsub:
+                        # plotms plots the velocities in the barycentric frame
+                        ms.open(MS)
+                        bary_freqs = ms.cvelfreqs(spwids=[spw],mode='channel',outframe='BARY')
+                        ms.close()
+                        spw_file = spw_file.replace('_amp_chn','_amp_vel')
+                        logger.info('Plotting amplitude vs velocity to {}'.format(spw_file))
+                        vp.plot_spectrum([entry],spw_file,'{0} ob{1} spw{2} (barycentric)'.format(target,obs,spw),
+                                         rest_freq=qa.convert(qa.quantity(config['global']['rest_freq']),'Hz')['value'],freqs=bary_freqs)
+                continue
             logger.info('Plotting amplitude vs channel to {}'.format(plot_file))
             plotms(vis=MS, xaxis='chan', yaxis='amp',
                    ydatacolumn='corrected', plotfile=plot_file,
@@ -160,7 +194,7 @@ def plot_spec(config,logger,contsub=False):
                        freqframe='BARY', restfreq=str(config['global']['rest_freq']), veldef='OPTICAL')
     logger.info('Completed plotting amplitude spectrum.')
             
-def dirty_image(config,config_raw,config_file,logger):
+def dirty_image(config,config_raw,config_file,logger,selection=None):
     """
     Generates a dirty (continuum subtracted) image of each science target.
     Checks that the pixel size, image size, and line emission channels are set (will prompt user if in interactive mode).
@@ -169,6 +203,7 @@ def dirty_image(config,config_raw,config_file,logger):
     config = The parameters read from the configuration file. (Ordered dictionary)
     config_raw = The instance of the parser.
     config_file = Path to configuration file. (String)
+    selection = Names of the targets to process, None for all. (List of Strings)
     """
     logger.info('Starting making dirty image.')
     calib = config['calibration']
@@ -191,10 +226,15 @@ def dirty_image(config,config_raw,config_file,logger):
     cf.makedir('./'+img_dir,logger)
     logger.info('Removing any existing dirty images.')
     for target in targets:
+        if not cf.target_selected(target,selection):
+            continue
         del_list = glob.glob(img_dir+'{}.dirty*'.format(target))
         for file_path in del_list:
             logger.info('Deleting: '+file_path)
-            shutil.rmtree(file_path)
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            else:
+                os.remove(file_path)
     logger.info('Checking clean parameters for dirty image.')
     reset_cln = False
     if len(cln_param['pix_size']) == 0 or len(cln_param['pix_size']) != len(targets):
@@ -308,6 +348,8 @@ def dirty_image(config,config_raw,config_file,logger):
     logger.info('For the targets: {}.'.format(targets))
     for i in range(len(targets)):
         target = targets[i]
+        if not cf.target_selected(target,selection):
+            continue
         field = fields[i]
         gridder = 'wproject'
         if calib['mosaic']:
@@ -317,7 +359,7 @@ def dirty_image(config,config_raw,config_file,logger):
             field = ','.join(fields)
             gridder = 'mosaic'
         logger.info('Making dirty image of {} (line only).'.format(target))
-        command = "tclean(vis='{0}{1}'+'.split.contsub', field='{2}', imagename='{3}{1}'+'.dirty', cell='{4}', imsize=[{5},{5}], specmode='cube', outframe='bary', veltype='radio', restfreq='{6}', gridder='{7}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='hogbom', weighting='briggs', robust={8}, restoringbeam='common', niter=0, phasecenter='{9}', interactive=False)".format(src_dir,target,field,img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,cln_param['robust'],cln_param['phasecenter'])
+        command = "tclean(vis='{0}{1}'+'.split.contsub', field='{2}', imagename='{3}{1}'+'.dirty', cell='{4}', imsize=[{5},{5}], specmode='cube', outframe='bary', veltype='radio', restfreq='{6}', gridder='{7}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='hogbom', weighting='briggs', robust={8}, restoringbeam='common', niter=0, phasecenter='{9}', interactive=False, parallel={10})".format(src_dir,target,field,img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,cln_param['robust'],cln_param['phasecenter'],cf.mpi_enabled())
         logger.info('Executing command: '+command)
         exec(command)
         cf.check_casalog(config,config_raw,logger,casalog)
@@ -337,23 +379,32 @@ logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['projec
 # Define MS file name
 msfile = '{0}.ms'.format(config['global']['project_name'])
 
+# Targets to process (all unless run as a per-target job)
+selection = cf.get_target_selection(logger)
+
 #Contsub
 cf.check_casaversion(logger)
-plot_spec(config,logger)
-contsub(msfile,config,config_raw,config_file,logger)
-plot_spec(config,logger,contsub=True)
+cf.start_casalog_watchdog(config,config_raw,logger,casalog)
+plot_spec(config,logger,selection=selection)
+contsub(msfile,config,config_raw,config_file,logger,selection)
+plot_spec(config,logger,contsub=True,selection=selection)
 
 #Remove previous dirty images
 targets = config['calibration']['target_names']
 for target in targets:
+    if not cf.target_selected(target,selection):
+        continue
     del_list = glob.glob(config['global']['img_dir']+'/'+'{}.dirty.*'.format(target))
     if len(del_list) > 0:
         logger.info('Deleting existing dirty image(s): {}'.format(del_list))
         for file_path in del_list:
-            shutil.rmtree(file_path)
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            else:
+                os.remove(file_path)
     
 #Make dirty image
-dirty_image(config,config_raw,config_file,logger)
+dirty_image(config,config_raw,config_file,logger,selection)
 
 #Review and backup parameters file
 cf.diff_pipeline_params(config_file,logger)
@@ -0,0 +1,272 @@
+import os
+import numbers
+import collections
+import numpy
+
+
+def image_mtime(imagename):
+    """
+    Returns the latest modification time of the files making up an image (CASA image directory or FITS file).
+
+    Input:
+    imagename = Path to the image. (String)
+
+    Output:
+    Modification time. (Float)
+    """
+    if not os.path.isdir(imagename):
+        return os.path.getmtime(imagename)
+    mtime = os.path.getmtime(imagename)
+    for root, dirs, files in os.walk(imagename):
+        for name in files:
+            mtime = max(mtime,os.path.getmtime(os.path.join(root,name)))
+    return mtime
+
+def chunk_channels(nx,ny,max_bytes=2**26):
+    """
+    Returns the number of channels of a cube that can be read at once without exceeding a memory limit.
+
+    Input:
+    nx, ny = Spatial dimensions of the cube. (Integers)
+    max_bytes = Maximum size of a chunk in bytes. (Integer)
+
+    Output:
+    Number of channels per chunk. (Integer)
+    """
+    return max(1,int(max_bytes/(nx*ny*8)))
+
+def casa_image_info(ia):
+    """
+    Returns the shape and the spectral and Stokes axes of the image the ia tool is attached to.
+
+    Input:
+    ia = An ia tool with an image open.
+
+    Output:
+    info = Keys 'shape', 'spec_axis' and 'stokes_axis' (None if there is no Stokes axis). (Dictionary)
+    """
+    coords = ia.coordsys()
+    spec_axis = coords.findcoordinate('spectral')['pixel'][0]
+    stokes = coords.findcoordinate('stokes')
+    coords.done()
+    info = {'shape': list(ia.shape()), 'spec_axis': spec_axis, 'stokes_axis': None}
+    if stokes['return']:
+        info['stokes_axis'] = stokes['pixel'][0]
+    return info
+
+def get_casa_channels(ia,info,start,end):
+    """
+    Reads a range of channels of a CASA image cube (only the first Stokes plane). Masked pixels are returned as NaN.
+
+    Input:
+    ia = An ia tool with the image open.
+    info = The output of casa_image_info. (Dictionary)
+    start = First channel. (Integer)
+    end = Channel after the last channel. (Integer)
+
+    Output:
+    data = The channels with the shape (channels, y, x). (Array)
+    """
+    shape = info['shape']
+    blc = [0]*len(shape)
+    trc = [n-1 for n in shape]
+    blc[info['spec_axis']] = start
+    trc[info['spec_axis']] = end-1
+    if info['stokes_axis'] is not None:
+        trc[info['stokes_axis']] = 0
+    data = ia.getchunk(blc=blc,trc=trc,dropdeg=False)
+    mask = ia.getchunk(blc=blc,trc=trc,dropdeg=False,getmask=True)
+    data = numpy.where(mask,data,numpy.nan).astype('float64')
+    # Reorder to (spectral, y, x) dropping any other degenerate axes
+    data = numpy.moveaxis(data,info['spec_axis'],0)
+    data = data.reshape(data.shape[0],shape[0],shape[1])
+    return numpy.transpose(data,(0,2,1))
+
+def put_casa_channels(ia,info,start,data):
+    """
+    Writes a range of channels to a CASA image cube (only the first Stokes plane).
+
+    Input:
+    ia = An ia tool with the image open.
+    info = The output of casa_image_info. (Dictionary)
+    start = First channel. (Integer)
+    data = The channels with the shape (channels, y, x). (Array)
+    """
+    shape = list(info['shape'])
+    shape[info['spec_axis']] = data.shape[0]
+    if info['stokes_axis'] is not None:
+        shape[info['stokes_axis']] = 1
+    blc = [0]*len(shape)
+    blc[info['spec_axis']] = start
+    pixels = numpy.transpose(data,(0,2,1))
+    pixels = pixels.reshape([data.shape[0]]+[shape[i] for i in range(len(shape)) if i != info['spec_axis']])
+    ia.putchunk(pixels=numpy.moveaxis(pixels,0,info['spec_axis']),blc=blc)
+
+def casa_image_chunks(imagename,ia,max_bytes=2**26):
+    """
+    Reads a CASA image cube in chunks of channels (only the first Stokes plane).
+    Masked pixels are returned as NaN.
+
+    Input:
+    imagename = Path to the CASA image. (String)
+    ia = The ia tool of the calling script.
+    max_bytes = Maximum size of a chunk in bytes. (Integer)
+
+    Output:
+    Generator of (first channel, data) where data has the shape (channels, y, x). (Tuple of Integer and Array)
+    """
+    ia.open(imagename)
+    try:
+        info = casa_image_info(ia)
+        nchan = info['shape'][info['spec_axis']]
+        step = chunk_channels(info['shape'][0],info['shape'][1],max_bytes)
+        for start in range(0,nchan,step):
+            yield start,get_casa_channels(ia,info,start,min(nchan,start+step))
+    finally:
+        ia.close()
+
+# Numpy types of the FITS BITPIX values (FITS data are big-endian)
+fits_dtypes = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+def parse_fits_value(value):
+    """
+    Converts the value field of a FITS header card to a Python type.
+    """
+    value = value.strip()
+    if value.startswith("'"):
+        end = value.find("'",1)
+        while end != -1 and value[end+1:end+2] == "'":
+            end = value.find("'",end+2)
+        return value[1:end].replace("''","'").rstrip()
+    value = value.split('/')[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D','E'))
+    except ValueError:
+        return value
+
+def read_fits_header(fitsfile):
+    """
+    Reads the primary header of a FITS file.
+
+    Input:
+    fitsfile = Path to the FITS file. (String)
+
+    Output:
+    header = The keywords and values of the header, in order. (Ordered dictionary)
+    offset = Position of the start of the data in bytes. (Integer)
+    """
+    header = collections.OrderedDict()
+    fits = open(fitsfile,'rb')
+    try:
+        nblocks = 0
+        done = False
+        while not done:
+            block = fits.read(2880)
+            if len(block) < 2880:
+                raise IOError('{} is not a valid FITS file.'.format(fitsfile))
+            nblocks += 1
+            block = block.decode('ascii')
+            for i in range(0,2880,80):
+                card = block[i:i+80]
+                key = card[:8].strip()
+                if key == 'END':
+                    done = True
+                    break
+                if card[8:10] != '= ' or key in header:
+                    continue
+                header[key] = parse_fits_value(card[10:])
+    finally:
+        fits.close()
+    return header,nblocks*2880
+
+def read_fits_cube(fitsfile):
+    """
+    Memory maps the data of a FITS image. Degenerate axes beyond the third are dropped (first plane only).
+
+    Input:
+    fitsfile = Path to the FITS file. (String)
+
+    Output:
+    header = The keywords and values of the header. (Ordered dictionary)
+    data = The memory mapped data with the shape (NAXIS3, NAXIS2, NAXIS1). (Array)
+    """
+    header,offset = read_fits_header(fitsfile)
+    shape = tuple(header['NAXIS{}'.format(i)] for i in range(header['NAXIS'],0,-1))
+    data = numpy.memmap(fitsfile,dtype=fits_dtypes[header['BITPIX']],mode='r',offset=offset,shape=shape)
+    while data.ndim > 3:
+        data = data[0]
+    while data.ndim < 3:
+        data = data[numpy.newaxis]
+    return header,data
+
+def fits_chunks(data,header,max_bytes=2**26):
+    """
+    Reads a memory mapped FITS cube in chunks of channels, applying any scaling and blanking.
+
+    Input:
+    data = The memory mapped data with the shape (channels, y, x). (Array)
+    header = The keywords and values of the header. (Ordered dictionary)
+    max_bytes = Maximum size of a chunk in bytes. (Integer)
+
+    Output:
+    Generator of (first channel, data) where data has the shape (channels, y, x). (Tuple of Integer and Array)
+    """
+    step = chunk_channels(data.shape[2],data.shape[1],max_bytes)
+    for start in range(0,data.shape[0],step):
+        chunk = numpy.array(data[start:start+step],dtype='float64')
+        if header['BITPIX'] > 0 and 'BLANK' in header:
+            chunk[data[start:start+step] == header['BLANK']] = numpy.nan
+        chunk = chunk*header.get('BSCALE',1.)+header.get('BZERO',0.)
+        yield start,chunk
+
+def format_fits_card(key,value,comment=''):
+    """
+    Formats a FITS header card (80 characters).
+    """
+    if isinstance(value,bool):
+        value = '{:>20}'.format('T' if value else 'F')
+    elif isinstance(value,numbers.Integral):
+        value = '{:>20d}'.format(value)
+    elif isinstance(value,numbers.Real):
+        value = '{:>20}'.format(repr(float(value)).upper())
+    else:
+        value = "'{:<8}'".format(str(value).replace("'","''"))
+    card = '{0:<8}= {1}'.format(key,value)
+    if comment:
+        card += ' / '+comment
+    return '{:<80}'.format(card[:80])
+
+def write_fits_image(fitsfile,data,header):
+    """
+    Writes a 2D image (big-endian 32 bit floats) to a FITS file, replacing any existing file.
+
+    Input:
+    fitsfile = Path to the FITS file. (String)
+    data = The image with the shape (y, x). (Array)
+    header = Additional keywords and values to write (WCS, beam, units etc.). (Ordered dictionary)
+    """
+    cards = [format_fits_card('SIMPLE',True),format_fits_card('BITPIX',-32),format_fits_card('NAXIS',2),
+             format_fits_card('NAXIS1',data.shape[1]),format_fits_card('NAXIS2',data.shape[0])]
+    for key,value in header.items():
+        if key in ['SIMPLE','BITPIX','NAXIS','NAXIS1','NAXIS2','EXTEND','END']:
+            continue
+        cards.append(format_fits_card(key,value))
+    cards.append('{:<80}'.format('END'))
+    text = ''.join(cards)
+    text += ' '*(-len(text) % 2880)
+    raw = numpy.ascontiguousarray(data,dtype='>f4').tostring()
+    tmp_file = fitsfile+'.tmp{}'.format(os.getpid())
+    fits = open(tmp_file,'wb')
+    fits.write(text.encode('ascii'))
+    fits.write(raw)
+    fits.write(b'\0'*(-len(raw) % 2880))
+    fits.close()
+    os.rename(tmp_file,fitsfile)
@@ -1,8 +1,8 @@
-import imp, glob, numpy
+import imp, glob, numpy, shutil
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
 
-def dirty_cont_image(config,config_raw,config_file,logger):
+def dirty_cont_image(config,config_raw,config_file,logger,selection=None):
     """
     Generates a dirty image of each science target including the continuum emission.
     Checks that the pixel size and image size are set (will prompt user if in interactive mode).
@@ -11,6 +11,7 @@ def dirty_cont_image(config,config_raw,config_file,logger):
     config = The parameters read from the configuration file. (Ordered dictionary)
     config_raw = The instance of the parser.
     config_file = Path to configuration file. (String)
+    selection = Names of the targets to process, None for all. (List of Strings)
     """
     logger.info('Starting making dirty continuum image.')
     calib = config['calibration']
@@ -31,7 +32,12 @@ def dirty_cont_image(config,config_raw,config_file,logger):
     img_dir = config['global']['img_dir']+'/'
     cf.makedir('/.'+img_dir,logger)
     logger.info('Removing any existing dirty continuum images.')
-    del_list = glob.glob(img_dir+'*cont.dirty*')
+    if selection is None:
+        del_list = glob.glob(img_dir+'*cont.dirty*')
+    else:
+        del_list = []
+        for target in selection:
+            del_list.extend(glob.glob(img_dir+'{}.cont.dirty*'.format(target)))
     for file_path in del_list:
         logger.info('Deleting: '+file_path)
         shutil.rmtree(file_path)
@@ -111,6 +117,8 @@ def dirty_cont_image(config,config_raw,config_file,logger):
     logger.info('For the targets: {}.'.format(targets))
     for i in range(len(targets)):
         target = targets[i]
+        if not cf.target_selected(target,selection):
+            continue
         field = fields[i]
         gridder = 'wproject'
         if calib['mosaic']:
@@ -120,7 +128,7 @@ def dirty_cont_image(config,config_raw,config_file,logger):
             field = ','.join(fields)
             gridder = 'mosaic'
         logger.info('Making dirty image of {} (inc. continuum).'.format(target))
-        command = "tclean(vis='{0}{1}.split', field='{2}', imagename='{3}{1}.cont.dirty', cell='{4}', imsize=[{5},{5}], specmode='cube', outframe='bary', veltype='radio', restfreq='{6}', gridder='{7}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='hogbom', weighting='briggs', robust={8}, niter=0, phasecenter='{9}', interactive=False)".format(src_dir,target,field,img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,cln_param['robust'],cln_param['phasecenter'])
+        command = "tclean(vis='{0}{1}.split', field='{2}', imagename='{3}{1}.cont.dirty', cell='{4}', imsize=[{5},{5}], specmode='cube', outframe='bary', veltype='radio', restfreq='{6}', gridder='{7}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='hogbom', weighting='briggs', robust={8}, niter=0, phasecenter='{9}', interactive=False, parallel={10})".format(src_dir,target,field,img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,cln_param['robust'],cln_param['phasecenter'],cf.mpi_enabled())
         logger.info('Executing command: '+command)
         exec(command)  
         cf.check_casalog(config,config_raw,logger,casalog)
@@ -139,10 +147,15 @@ logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['projec
 # Define MS file name
 msfile = '{0}.ms'.format(config['global']['project_name'])
 
+# Targets to process (all unless run as a per-target job)
+selection = cf.get_target_selection(logger)
+
 #Make dirty continuum image
 cf.check_casaversion(logger)
-cf.rmdir(config['global']['img_dir'],logger)
-dirty_cont_image(config,config_raw,config_file,logger)
+cf.start_casalog_watchdog(config,config_raw,logger,casalog)
+if selection is None:
+    cf.rmdir(config['global']['img_dir'],logger)
+dirty_cont_image(config,config_raw,config_file,logger,selection)
 
 #Review and backup parameters file
 cf.diff_pipeline_params(config_file,logger)
@@ -1,11 +1,32 @@
-import imp, numpy, os
+import imp, numpy, os, shutil, functools
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
+imp.load_source('ms_metadata','ms_metadata.py')
+import ms_metadata as mm
+imp.load_source('flag_stats','flag_stats.py')
+import flag_stats as fs
+imp.load_source('flag_versions','flag_versions.py')
+import flag_versions as fv
+imp.load_source('sum_threshold','sum_threshold.py')
+import sum_threshold as st
+imp.load_source('plot_queue','plot_queue.py')
+import plot_queue as pq
+imp.load_source('vis_cache','vis_cache.py')
+import vis_cache as vc
+imp.load_source('vis_plots','vis_plots.py')
+import vis_plots as vp
+imp.load_source('applycal_plan','applycal_plan.py')
+import applycal_plan as ap
+imp.load_source('task_graph','task_graph.py')
+import task_graph as tg
 
 
 def manual_flags(config, config_raw, logger):
     """
-    Apply manual flags from the file 'manual_flags.list'.
+    Reads the manual flags from the file 'manual_flags.list' (they are applied by batch_flags).
+    
+    Output:
+    commands = Name and flagdata list mode commands of the manual flags (empty if there are none). (List of Tuples)
     """
     logger.info('Starting manual flagging.')
     if interactive:
@@ -14,66 +35,100 @@ def manual_flags(config, config_raw, logger):
         resp = str(raw_input('Do you want to proceed (y/n): '))
         while resp.lower() not in ['yes','ye','y']:
             resp = str(raw_input('Do you want to proceed (y/n): '))
-    logger.info('Applying flags from manual_flags.list')
+    logger.info('Reading flags from manual_flags.list')
+    commands = []
     try:
         flag_file = open('manual_flags.list', 'r')
-        lines = flag_file.readlines()
+        lines = [line.strip() for line in flag_file.readlines() if line.strip() != '']
         if lines == []:
             logger.warning("The file is empty. Continuing without manual flagging.")
         else:
-            command = "flagdata(vis='{}', mode='list', action='apply', inpfile={})".format(msfile,lines)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
-            logger.info('Completed manual flagging.')
+            commands.append(('manual',lines))
         flag_file.close()
     except IOError:
-        logger.warning("'manual_flags.list' does not exist. Continuing without manual flagging.")        
+        logger.warning("'manual_flags.list' does not exist. Continuing without manual flagging.")
+    return commands
 
 def base_flags(msfile, config, config_raw, logger):
     """ 
-    Sets basic initial data flags.
+    Returns the basic initial data flags (shadowing, zero amplitudes and the start of each scan).
     
     Input:
     msfile = Path to the MS. (String)
     config = The parameters read from the configuration file. (Ordered dictionary)
+    
+    Output:
+    commands = Name and flagdata list mode commands of each type of flag. (List of Tuples)
     """
-    logger.info('Starting basic flagging.')
     flag = config['flagging']
     tol = flag['shadow_tol'] 
     quack_int = flag['quack_int']
     logger.info('Flagging antennae with more than {} m of shadowing.'.format(tol))
-    command = "flagdata(vis='{0}', mode='shadow', tolerance={1}, flagbackup=False)".format(msfile,tol)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
     logger.info('Flagging zero amplitude data.')
-    command = "flagdata(vis='{}', mode='clip', clipzeros=True, flagbackup=False)".format(msfile)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
     logger.info('Flagging first {} s of every scan.'.format(quack_int))
-    command = "flagdata(vis='{0}', mode='quack', quackinterval={1}, quackmode='beg', flagbackup=False)".format(msfile,quack_int)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed basic flagging.')
+    return [('shadow',["mode='shadow' tolerance={}".format(tol)]),
+            ('clipzeros',["mode='clip' clipzeros=True"]),
+            ('quack',["mode='quack' quackinterval={} quackmode='beg'".format(quack_int)])]
 
 def tfcrop(msfile, config, config_raw, logger):
     """
-    Runs CASA's TFcrop flagging algorithm.
+    Returns the command to run CASA's TFcrop flagging algorithm.
     
     Input:
     msfile = Path to the MS. (String)
     config = The parameters read from the configuration file. (Ordered dictionary)
+    
+    Output:
+    commands = Name and flagdata list mode command of TFCrop. (List of Tuples)
     """
     flag = config['flagging']
-    logger.info('Starting running TFCrop.')
-    command = "flagdata(vis='{0}', mode='tfcrop', action='apply', display='', timecutoff={1}, freqcutoff={2}, flagbackup=False)".format(msfile,flag['timecutoff'],flag['freqcutoff'])
-    logger.info('Executing command: '+command)
-    exec(command)
+    logger.info('Running TFCrop with time and frequency cutoffs of {0} and {1}.'.format(flag['timecutoff'],flag['freqcutoff']))
+    return [('tfcrop',["mode='tfcrop' timecutoff={0} freqcutoff={1}".format(flag['timecutoff'],flag['freqcutoff'])])]
+
+def batch_flags(msfile, commands, name, config, config_raw, logger):
+    """
+    Applies several sets of flagging commands with a single flagdata call in list mode, so the MS is only read and written once.
+    A summary agent after each set counts the flags, and the number of visibilities flagged by each set is written to the log
+    and to the 'summary' directory.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    commands = Name and flagdata list mode commands of each set, in the order they are applied. (List of Tuples)
+    name = Name of the flag version the commands make (for the summary file). (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    """
+    if len(commands) == 0:
+        logger.info('No flagging commands to apply.')
+        return
+    logger.info('Applying {0} sets of flags in one pass: {1}.'.format(len(commands),', '.join([cmd_name for cmd_name,lines in commands])))
+    inpfile = ["mode='summary' name='before'"]
+    for cmd_name,lines in commands:
+        inpfile.extend(lines)
+        inpfile.append("mode='summary' name='{}'".format(cmd_name))
+    command = "flagdata(vis='{0}', mode='list', action='apply', inpfile={1}, flagbackup=False)".format(msfile,inpfile)
+    logger.info('Executing command: batch_summary = '+command)
+    exec('batch_summary = '+command)
     cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed running TFCrop.')
+    # The summaries are returned as report0, report1, ... in the order of the commands
+    reports = []
+    if isinstance(batch_summary,dict):
+        reports = [batch_summary['report{}'.format(i)] for i in range(len(batch_summary)) if 'report{}'.format(i) in batch_summary]
+    if len(reports) != len(commands)+1:
+        logger.warning('flagdata did not return a summary for each set of flags, the flags added by each are not known.')
+        return
+    sum_dir = './summary/'
+    cf.makedir(sum_dir,logger)
+    out_file = sum_dir+'{0}.{1}flags.commands'.format(msfile,name)
+    logger.info('Writing the flags added by each set of commands to: {}'.format(out_file))
+    batch_file = open(out_file,'w')
+    total = float(reports[0]['total'])
+    for i in range(len(commands)):
+        added = reports[i+1]['flagged']-reports[i]['flagged']
+        line = '{0}: {1:.0f} visibilities flagged ({2:.2f}% of the data), {3:.2f}% flagged in total'.format(commands[i][0],added,100.*added/total,100.*reports[i+1]['flagged']/total)
+        logger.info(line)
+        batch_file.write(line+'\n')
+    batch_file.close()
+    logger.info('Completed applying the batched flags.')
 
 def rflag(msfile, config, config_raw, logger):
     """
@@ -92,6 +147,25 @@ def rflag(msfile, config, config_raw, logger):
     cf.check_casalog(config,config_raw,logger,casalog)
     logger.info('Completed running rflag.')
 
+def sumthreshold(msfile, config, config_raw, logger):
+    """
+    Runs the SumThreshold flagging algorithm (see sum_threshold.py) on the uncalibrated data.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    """
+    flag = config['flagging']
+    thresh = 6.0
+    if config_raw.has_option('flagging','st_thresh'):
+        thresh = flag['st_thresh']
+    nproc = 1
+    if config_raw.has_option('flagging','nproc'):
+        nproc = flag['nproc']
+    logger.info('Starting running SumThreshold with a threshold of {}.'.format(thresh))
+    st.flag_ms(msfile,'DATA',thresh,nproc,tb,logger)
+    logger.info('Completed running SumThreshold.')
+
 def extend_flags(msfile, config, config_raw,  logger):
     """
     Extends existing flags.
@@ -114,6 +188,7 @@ def extend_flags(msfile, config, config_raw,  logger):
 def flag_sum(msfile,name,logger):
     """
     Writes a summary of the current flags to file.
+    The flag statistics are also saved (as .npz) so that they can be compared between flag versions without reading the MS again.
     
     Input:
     msfile = Path to the MS. (String)
@@ -123,22 +198,45 @@ def flag_sum(msfile,name,logger):
     cf.makedir(sum_dir,logger)
     out_file = sum_dir+'{0}.{1}flags.summary'.format(msfile,name)
     logger.info('Starting writing flag summary to: {}.'.format(out_file))
-    flag_info = flagdata(vis=msfile, mode='summary')
-    out_file = open(out_file, 'w')
-    out_file.write('Total flagged data: {:.2%}\n\n'.format(flag_info['flagged']/flag_info['total']))
-    logger.info('Total flagged data: {:.2%}'.format(flag_info['flagged']/flag_info['total']))
-    out_file.write('Flagging per spectral window\n')
-    for spw in flag_info['spw'].keys():
-        out_file.write('SPW {0}: {1:.2%}\n'.format(spw,flag_info['spw'][spw]['flagged']/flag_info['spw'][spw]['total']))
-    out_file.write('\nFlagging per field\n')
-    for field in flag_info['field'].keys():
-        out_file.write('{0}: {1:.2%}\n'.format(field,flag_info['field'][field]['flagged']/flag_info['field'][field]['total']))
-    out_file.write('\nFlagging per antenna\n')
-    for ant in flag_info['antenna'].keys():
-        out_file.write('{0}: {1:.2%}\n'.format(ant,flag_info['antenna'][ant]['flagged']/flag_info['antenna'][ant]['total']))
-    out_file.close()
+    stats = fs.flag_stats(msfile,mm.get_metadata(msfile,msmd,tb,logger),tb,logger)
+    fs.save_flag_stats(stats,sum_dir+'{0}.{1}flags.npz'.format(msfile,name),logger)
+    fs.write_flag_summary(stats,out_file,logger)
     logger.info('Completed writing flag summary.')
+
+def flag_diff(msfile,old_name,new_name,logger):
+    """
+    Writes the change in the flags between two flag versions from their saved flag statistics.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    old_name = Name of the earlier flag version. (String)
+    new_name = Name of the later flag version. (String)
+    """
+    sum_dir = './summary/'
+    out_file = sum_dir+'{0}.{1}-{2}flags.diff'.format(msfile,old_name,new_name)
+    logger.info('Writing change in flags from {0} to {1} to: {2}.'.format(old_name,new_name,out_file))
+    old = fs.load_flag_stats(sum_dir+'{0}.{1}flags.npz'.format(msfile,old_name))
+    new = fs.load_flag_stats(sum_dir+'{0}.{1}flags.npz'.format(msfile,new_name))
+    fs.write_flag_diff(old,new,old_name,new_name,out_file,logger)
+    
+def compact_flags():
+    """
+    Checks if flag versions are kept in the compact flag store (see flag_versions.py) rather than with flagmanager.
+    """
+    return config_raw.has_option('flagging','flag_store') and config['flagging']['flag_store']
+
+def flag_version_exists(msfile,name):
+    """
+    Checks if the named flag version has been saved.
     
+    Input:
+    msfile = Path to the MS. (String)
+    name = Root of filename for the flag version. (String) 
+    """
+    if compact_flags() and fv.has_version(msfile,name):
+        return True
+    return os.path.isdir(msfile+'.flagversions/flags.'+name)
+
 def restore_flags(msfile,name,logger):
     """
     Restored the flag version corresponding to the named file.
@@ -148,10 +246,16 @@ def restore_flags(msfile,name,logger):
     name = Root of filename for the flag version. (String) 
     """
     logger.info('Restoring flag version from: {}.'.format(name))
+    if compact_flags() and fv.has_version(msfile,name):
+        fv.restore_version(msfile,name,tb,logger)
+        return
     command = "flagmanager(vis='{0}', mode='restore', versionname='{1}')".format(msfile,name)
     logger.info('Executing command: '+command)
     exec(command)
     logger.info('Completed restoring flag version.')
+    if compact_flags():
+        # Version saved by flagmanager in an earlier run, keep it in the flag store from now on
+        fv.save_version(msfile,name,tb,logger)
     
 def save_flags(msfile,name,logger):
     """
@@ -162,6 +266,9 @@ def save_flags(msfile,name,logger):
     name = Root of filename for the flag version. (String) 
     """
     logger.info('Saving flag version as: {}.'.format(name))
+    if compact_flags():
+        fv.save_version(msfile,name,tb,logger)
+        return
     command = "flagmanager(vis='{0}', mode='save', versionname='{1}')".format(msfile,name)
     logger.info('Executing command: '+command)
     exec(command)
@@ -176,6 +283,9 @@ def rm_flags(msfile,name,logger):
     name = Root of filename for the flag version. (String) 
     """
     logger.info('Removing flag version: {}.'.format(name))
+    if compact_flags():
+        fv.remove_version(msfile,name,logger)
+        return
     command = "flagmanager(vis='{0}', mode='delete', versionname='{1}')".format(msfile,name)
     logger.info('Executing command: '+command)
     exec(command)
@@ -201,25 +311,39 @@ def plot_flags(msfile,name,logger):
     fields.extend(calib['phasecal'])
     fields = list(set(fields))
     
-    msmd.open(msfile)
-    nobs = msmd.nobservations()
+    meta = mm.get_metadata(msfile,msmd,tb,logger)
+    nobs = meta['nobs']
+    # The flag statistics written by flag_sum identify the flags being plotted
+    stats_file = './summary/{0}.{1}flags.npz'.format(msfile,name)
+    use_cache = cf.plot_engine(config,config_raw) == 'cache'
+    if use_cache:
+        vc.build_cache(msfile,'DATA',meta,tb,logger,fields)
     
     for field in fields:
         for i in range(nobs):
-            spw_IDs = list(msmd.spwsforfield(field))
+            spw_IDs = mm.spws_for_field(meta,field)
             for spw in spw_IDs:
                 logger.info('Making flags plots for {}.'.format(field))
                 plot_file = plot_name+'_'+field
+                if use_cache:
+                    entry = vc.load_entry(msfile,'DATA',i,field,spw)
+                    if entry is None:
+                        continue
+                    title = '{0} ob{1} spw{2} ({3} flags)'.format(field,i,spw,name)
+                    logger.info('Plotting amplitude vs frequency to {}'.format(plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw)))
+                    vp.plot_flags_freq(entry,plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw),title)
+                    logger.info('Plotting amplitude vs time to {}'.format(plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw)))
+                    vp.plot_flags_time(entry,plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw),title)
+                    continue
                 logger.info('Plotting amplitude vs frequency to {}'.format(plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw)))
-                plotms(vis=msfile, xaxis='freq', yaxis='amp', field=field, plotfile=plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw),
-                       customflaggedsymbol=True, spw=str(spw), observation=str(i),
-                       averagedata=True, avgtime='60', expformat='png', overwrite=True, showgui=False)
+                pq.queue_plot('plotms',dict(vis=msfile, xaxis='freq', yaxis='amp', field=field, plotfile=plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw),
+                              customflaggedsymbol=True, spw=str(spw), observation=str(i),
+                              averagedata=True, avgtime='60', expformat='png', overwrite=True, showgui=False),[stats_file],logger,globals())
                 logger.info('Plotting amplitude vs time to {}'.format(plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw)))
-                plotms(vis=msfile, xaxis='time', yaxis='amp', field=field, plotfile=plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw),
-                       customflaggedsymbol=True, spw=str(spw), observation=str(i),
-                       averagedata=True, avgchannel='5', expformat='png', overwrite=True, showgui=False)
-    msmd.close()
-    logger.info('Completed flags plots ')
+                pq.queue_plot('plotms',dict(vis=msfile, xaxis='time', yaxis='amp', field=field, plotfile=plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw),
+                              customflaggedsymbol=True, spw=str(spw), observation=str(i),
+                              averagedata=True, avgchannel='5', expformat='png', overwrite=True, showgui=False),[stats_file],logger,globals())
+    logger.info('Completed requesting flags plots.')
 
 def select_refant(msfile,config,config_raw,config_file,logger):
     """
@@ -233,9 +357,7 @@ def select_refant(msfile,config,config_raw,config_file,logger):
     """
     logger.info('Starting reference antenna selection.')
     calib = config['calibration']
-    tb.open(msfile+'/ANTENNA')
-    ant_names = tb.getcol('NAME')
-    tb.close()
+    ant_names = mm.get_metadata(msfile,msmd,tb,logger)['antennas']
     if calib['refant'] not in ant_names:
         logger.warning('No valid reference antenna set. Requesting user input.')
         first = True
@@ -267,17 +389,14 @@ def set_fields(msfile,config,config_raw,config_file,logger):
     """
     logger.info('Starting set field purposes.')
     calib = config['calibration']
-    tb.open(msfile+'/FIELD')
-    field_names = tb.getcol('NAME')
-    tb.close()
-    tb.open('{}/SPECTRAL_WINDOW'.format(msfile))
-    spw_names = tb.getcol('NAME')
+    meta = mm.get_metadata(msfile,msmd,tb,logger)
+    field_names = meta['fields']
+    spw_names = meta['spw_names']
     if not config['importdata']['jvla']:
-        spw_IDs = tb.getcol('DOPPLER_ID')
+        spw_IDs = meta['spw_doppler_ids']
     else:
-        spw_IDs = tb.getcol('FREQ_GROUP')
+        spw_IDs = meta['spw_freq_groups']
     nspw = len(spw_IDs)
-    tb.close()
     std_flux_mods = ['3C48_L.im', '3C138_L.im', '3C286_L.im', '3C147_L.im']
     std_flux_names = {'0134+329': '3C48_L.im', '0137+331': '3C48_L.im', '3C48': '3C48_L.im', 'J0137+3309': '3C48_L.im',
                       '0518+165': '3C138_L.im', '0521+166': '3C138_L.im', '3C138': '3C138_L.im', 'J0521+1638': '3C138_L.im',
@@ -390,14 +509,12 @@ def set_fields(msfile,config,config_raw,config_file,logger):
     
                 
     if len(calib['targets']) != nspw:
-        msmd.open(msfile)
         spw_IDs = []
         for target in calib['targets']:
-            spw_IDs.extend(list(msmd.spwsforfield(target)))
+            spw_IDs.extend(mm.spws_for_field(meta,target))
         spw_IDs = list(set(list(spw_IDs)))
-        spw_names = msmd.namesforspws(spw_IDs)
+        spw_names = mm.names_for_spws(meta,spw_IDs)
         nspw = len(spw_IDs)
-        msmd.close()
         
     flux_cal_names_bad = False
     for i in range(len(calib['fluxcal'])):
@@ -695,14 +812,21 @@ def set_fields(msfile,config,config_raw,config_file,logger):
 
    
     
-def calibration(msfile, config, config_raw, logger):
+def calibration(msfile, config, config_raw, logger, reuse=None, plots=True):
     """
     Runs the basic calibration steps on each SPW based on the intents described in the configuration file.
     Applies the calibration to all science target fields.
+    The products that do not depend on the flags (antenna position and gain curve tables, flux calibrator models) can be
+    reused from a previous pass, so that only the solutions that depend on the flags are made again after more flagging.
     
     Input:
     msfile = Path to the MS. (String)
     config = The parameters read from the configuration file. (Ordered dictionary)
+    reuse = The flag independent products returned by a previous pass, None to make them. (Dictionary)
+    plots = Whether to plot the data and solutions (not needed if a later pass will replace them). (Boolean)
+    
+    Output:
+    flag_free = The flag independent products of this pass. (Dictionary)
     """
     logger.info('Starting calibration.')
     plots_obs_dir = './plots/'
@@ -714,20 +838,17 @@ def calibration(msfile, config, config_raw, logger):
     calib = config['calibration']
     std_flux_mods = ['3C48_L.im', '3C138_L.im', '3C286_L.im', '3C147_L.im']
     
-    msmd.open(msfile)
-    nobs = msmd.nobservations()
+    meta = mm.get_metadata(msfile,msmd,tb,logger)
+    nobs = meta['nobs']
     spw_IDs = []
     for target in calib['targets']:
-        spw_IDs.extend(list(msmd.spwsforfield(target)))
+        spw_IDs.extend(mm.spws_for_field(meta,target))
     spw_IDs = list(set(list(spw_IDs)))
-    spw_names = msmd.namesforspws(spw_IDs)
+    spw_names = mm.names_for_spws(meta,spw_IDs)
     nspw = len(spw_IDs)
-    msmd.close()
     
     for i in range(nspw):
-        msmd.open(msfile)
-        spw_fields = msmd.fieldsforspw(spw_IDs[i], asnames=True)
-        msmd.close()
+        spw_fields = mm.fields_for_spw(meta,spw_IDs[i])
         cals_in_spw = list(set(spw_fields).intersection(calib['phasecal']))
         targets_in_spw = list(set(spw_fields).intersection(calib['targets']))
         if len(cals_in_spw) == 0:
@@ -735,8 +856,16 @@ def calibration(msfile, config, config_raw, logger):
         if len(targets_in_spw) == 0:
             logger.warning('No targets in SPW {}.'.format(spw_IDs[i]))
             
+    if reuse is None:
+        reuse = {}
+    flag_free = {}
+    
     aptab = None
-    if config['importdata']['jvla']:
+    if 'aptab' in reuse and (reuse['aptab'] is None or os.path.isdir(reuse['aptab'])):
+        aptab = reuse['aptab']
+        flag_free['aptab'] = aptab
+        logger.info('Reusing the antenna position offsets of the previous pass ({}), they do not depend on the flags.'.format(aptab))
+    elif config['importdata']['jvla']:
         aptab = cal_tabs+'antpos.cal'
         logger.info('Looking up antenna position offsets ({}).'.format(aptab))
         command = "gencal(vis='{0}', caltable='{1}', caltype='antpos', antenna='')".format(msfile,aptab)
@@ -747,15 +876,26 @@ def calibration(msfile, config, config_raw, logger):
             aptab = None
             logger.info('No antenna position offsets were found.')
             logger.info('Ignoring this step for the remainder of calibration.')
+        flag_free['aptab'] = aptab
+    else:
+        flag_free['aptab'] = None
     
     gctab = cal_tabs+'gaincurve.cal'
-    logger.info('Calibrating gain vs elevation ({}).'.format(gctab))
-    command = "gencal(vis='{0}', caltable='{1}', caltype='gceff')".format(msfile,gctab)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    if reuse.get('gctab') == gctab and os.path.isdir(gctab):
+        logger.info('Reusing the gain vs elevation table of the previous pass ({}), it does not depend on the flags.'.format(gctab))
+    else:
+        logger.info('Calibrating gain vs elevation ({}).'.format(gctab))
+        command = "gencal(vis='{0}', caltable='{1}', caltype='gceff')".format(msfile,gctab)
+        logger.info('Executing command: '+command)
+        exec(command)
+        cf.check_casalog(config,config_raw,logger,casalog)
+    flag_free['gctab'] = gctab
     
     prev_set = {}
+    if reuse.get('fluxmods') == [calib['fluxcal'],calib['fluxmod'],calib['man_mod']]:
+        logger.info('Reusing the flux calibrator models set in the previous pass ({}), they do not depend on the flags.'.format(','.join(set(calib['fluxcal']))))
+        prev_set = dict([(fluxcal,calib['fluxcal'].index(fluxcal)) for fluxcal in calib['fluxcal']])
+    flag_free['fluxmods'] = [calib['fluxcal'],calib['fluxmod'],calib['man_mod']]
     for i in range(len(calib['fluxcal'])):
         if calib['fluxcal'][i] not in prev_set.keys():
             prev_set[calib['fluxcal'][i]] = i
@@ -780,112 +920,123 @@ def calibration(msfile, config, config_raw, logger):
             logger.warning('The flux model for {0} has already been set as {1}, but it does not match the current model ({2}).'.format(calib['fluxcal'][i],calib['fluxmod'][prev_set[calib['fluxcal'][i]]],calib['fluxmod'][i]))
             logger.warning('The former will not be replaced. Check the flux model assignments in the parameters file.')
             
-    plot_file = plots_obs_dir+'bpphaseint.png'
-    logger.info('Plotting bandpass phase vs. time for reference antenna to: {}'.format(plot_file))
-    plotms(vis=msfile, plotfile=plot_file, xaxis='channel', yaxis='phase', field=calib['bandcal'][i], spw = ','.join(numpy.array(spw_IDs,dtype='str')),
-           correlation='RR,LL', avgtime='1E10', antenna=calib['refant'], coloraxis='antenna2', expformat='png', 
-           overwrite=True, showlegend=False, showgui=False, iteraxis='spw')
-    
-    dltab = cal_tabs+'delays.cal'
-    logger.info('Calibrating delays for bandpass calibrators {0} ({1}).'.format(calib['bandcal'],dltab))
-    if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', gaintype='K', gaintable=['{4}','{5}'], spw='{6}')".format(msfile,','.join(calib['bandcal']),dltab,calib['refant'],aptab,gctab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', gaintype='K', gaintable=['{4}'], spw='{5}')".format(msfile,','.join(calib['bandcal']),dltab,calib['refant'],gctab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    
-    bptab = cal_tabs+'bpphase.gcal'
-    logger.info('Make bandpass calibrator phase solutions for {0} ({1}).'.format(calib['bandcal'],bptab))
-    if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}',  caltable='{2}', refant='{3}', calmode='p', solint='int', combine='', minsnr=2.0, gaintable=['{4}','{5}','{6}'], spw='{7}')".format(msfile,','.join(calib['bandcal']),bptab,calib['refant'],aptab,gctab,dltab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}',  caltable='{2}', refant='{3}', calmode='p', solint='int', combine='', minsnr=2.0, gaintable=['{4}','{5}'], spw='{6}')".format(msfile,','.join(calib['bandcal']),bptab,calib['refant'],gctab,dltab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    
-    for i in range(nobs):
-        plot_file = plots_obs_dir+'bpphasesol_ob{}.png'.format(i)
-        logger.info('Plotting bandpass phase solutions to: {}'.format(plot_file))
-        plotms(vis=bptab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
-               plotrange=[0,0,-180,180], expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-               iteraxis='antenna', coloraxis='spw', spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
-    
-    bstab = cal_tabs+'bandpass.bcal'
-    logger.info('Determining bandpass solution(s) ({}).'.format(bstab))
+    spw_sel = ','.join(numpy.array(spw_IDs,dtype='str'))
+    pre_tab = []
+    pre_field = []
     if aptab is not None:
-        command = "bandpass(vis='{0}', caltable='{1}', field='{2}', refant='{3}', solint='inf', solnorm=True, gaintable=['{4}', '{5}', '{6}', '{7}'], spw='{8}')".format(msfile,bstab,','.join(calib['bandcal']),calib['refant'],aptab,gctab, dltab, bptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "bandpass(vis='{0}', caltable='{1}', field='{2}', refant='{3}', solint='inf', solnorm=True, gaintable=['{4}', '{5}', '{6}'], spw='{7}')".format(msfile,bstab,','.join(calib['bandcal']),calib['refant'],gctab, dltab, bptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+        pre_tab = [aptab]
+        pre_field = ['']
     
-    plot_file = plots_obs_dir+'bandpasssol_.png'
-    logger.info('Plotting bandpass amplitude solutions to: {}'.format(plot_file))
-    plotms(vis=bstab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='chan', yaxis='amp',
-           expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-           iteraxis='antenna', coloraxis='spw', spw=','.join(numpy.array(spw_IDs,dtype='str')))
+    # The solves and the plots of their solutions form a dependency graph (see task_graph.py),
+    # so independent solves (e.g. the integration and scan phases) run at the same time in the CASA processes of the plot queue
+    graph = tg.new_graph()
+    if plots:
+        plot_file = plots_obs_dir+'bpphaseint.png'
+        logger.info('Plotting bandpass phase vs. time for reference antenna to: {}'.format(plot_file))
+        tg.add_node(graph,'bpphaseint_plot','plotms',dict(vis=msfile, plotfile=plot_file, xaxis='channel', yaxis='phase', field=calib['bandcal'][i], spw=spw_sel,
+                    correlation='RR,LL', avgtime='1E10', antenna=calib['refant'], coloraxis='antenna2', expformat='png', 
+                    overwrite=True, showlegend=False, showgui=False, iteraxis='spw'),kind='plot',inputs=[msfile])
     
     calfields = []
     calfields.extend(calib['fluxcal'])
     calfields.extend(calib['bandcal'])
     calfields.extend(calib['phasecal'])
     calfields = list(set(calfields))
-    calfields = ','.join(calfields)
     
+    dltab = cal_tabs+'delays.cal'
+    bptab = cal_tabs+'bpphase.gcal'
+    bstab = cal_tabs+'bandpass.bcal'
     iptab = cal_tabs+'intphase.gcal'
-    logger.info('Determining integration phase solutions ({}).'.format(iptab))
-    if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='int', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}'],spw='{8}')".format(msfile,calfields,iptab,calib['refant'],aptab,gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='int', minsnr=2.0, gaintable=['{4}', '{5}', '{6}'],spw='{7}')".format(msfile,calfields,iptab,calib['refant'],gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    
     sptab = cal_tabs+'scanphase.gcal'
-    logger.info('Determining scan phase solutions ({}).'.format(sptab))
-    if aptab is not None:
-        command = command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}'],spw='{8}')".format(msfile,calfields,sptab,calib['refant'],aptab,gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}'],spw='{7}')".format(msfile,calfields,sptab,calib['refant'],gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    
     amtab = cal_tabs+'amp.gcal'
-    logger.info('Determining amplitude solutions ({}).'.format(amtab))
-    if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='ap', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}', '{8}'],spw='{9}')".format(msfile,calfields,amtab,calib['refant'],aptab,gctab, dltab, bstab, iptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='ap', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}'],spw='{8}')".format(msfile,calfields,amtab,calib['refant'],gctab, dltab, bstab, iptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    groups = solve_groups(meta,calib,spw_IDs,calfields,config,config_raw,logger)
+    for group in groups:
+        # Each group has its own chain of tables, which are merged once all the groups are solved
+        tabs = {}
+        node = {}
+        for solve,table in [('delays',dltab),('bpphase',bptab),('bandpass',bstab),('intphase',iptab),('scanphase',sptab),('amp',amtab)]:
+            tabs[solve] = table
+            node[solve] = solve
+            if group['name'] is not None:
+                cf.makedir(cal_tabs+'groups/'+group['name'],logger)
+                tabs[solve] = cal_tabs+'groups/{0}/{1}'.format(group['name'],os.path.basename(table))
+                node[solve] = '{0}_{1}'.format(solve,group['name'])
+            group[solve] = (node[solve],tabs[solve])
+        sel = dict(spw=','.join(numpy.array(group['spws'],dtype='str')))
+        if group['observation'] != '':
+            sel['observation'] = group['observation']
+        
+        logger.info('Calibrating delays for bandpass calibrators {0} ({1}).'.format(group['bandcal'],tabs['delays']))
+        tg.add_node(graph,node['delays'],'gaincal',dict(vis=msfile, field=','.join(group['bandcal']), caltable=tabs['delays'], refant=calib['refant'], gaintype='K',
+                    gaintable=pre_tab+[gctab], **sel))
+        
+        logger.info('Make bandpass calibrator phase solutions for {0} ({1}).'.format(group['bandcal'],tabs['bpphase']))
+        tg.add_node(graph,node['bpphase'],'gaincal',dict(vis=msfile, field=','.join(group['bandcal']), caltable=tabs['bpphase'], refant=calib['refant'], calmode='p',
+                    solint='int', combine='', minsnr=2.0, gaintable=pre_tab+[gctab, tabs['delays']], **sel),deps=[node['delays']])
+        
+        logger.info('Determining bandpass solution(s) ({}).'.format(tabs['bandpass']))
+        tg.add_node(graph,node['bandpass'],'bandpass',dict(vis=msfile, caltable=tabs['bandpass'], field=','.join(group['bandcal']), refant=calib['refant'], solint='inf',
+                    solnorm=True, gaintable=pre_tab+[gctab, tabs['delays'], tabs['bpphase']], **sel),deps=[node['bpphase']])
+        
+        logger.info('Determining integration phase solutions ({}).'.format(tabs['intphase']))
+        tg.add_node(graph,node['intphase'],'gaincal',dict(vis=msfile, field=','.join(group['calfields']), caltable=tabs['intphase'], refant=calib['refant'], calmode='p',
+                    solint='int', minsnr=2.0, gaintable=pre_tab+[gctab, tabs['delays'], tabs['bandpass']], **sel),deps=[node['bandpass']])
+        
+        logger.info('Determining scan phase solutions ({}).'.format(tabs['scanphase']))
+        tg.add_node(graph,node['scanphase'],'gaincal',dict(vis=msfile, field=','.join(group['calfields']), caltable=tabs['scanphase'], refant=calib['refant'], calmode='p',
+                    solint='inf', minsnr=2.0, gaintable=pre_tab+[gctab, tabs['delays'], tabs['bandpass']], **sel),deps=[node['bandpass']])
+        
+        logger.info('Determining amplitude solutions ({}).'.format(tabs['amp']))
+        tg.add_node(graph,node['amp'],'gaincal',dict(vis=msfile, field=','.join(group['calfields']), caltable=tabs['amp'], refant=calib['refant'], calmode='ap',
+                    solint='inf', minsnr=2.0, gaintable=pre_tab+[gctab, tabs['delays'], tabs['bandpass'], tabs['intphase']], **sel),deps=[node['intphase']])
+    if groups[0]['name'] is not None:
+        for solve,table in [('delays',dltab),('bpphase',bptab),('bandpass',bstab),('intphase',iptab),('scanphase',sptab),('amp',amtab)]:
+            logger.info('Merging the {0} tables of the groups into {1}.'.format(solve,table))
+            tg.add_node(graph,solve,'merge_caltables',dict(tables=[group[solve][1] for group in groups], caltable=table),
+                        deps=[group[solve][0] for group in groups],local=True)
+    
+    if plots:
+        for i in range(nobs):
+            plot_file = plots_obs_dir+'bpphasesol_ob{}.png'.format(i)
+            logger.info('Plotting bandpass phase solutions to: {}'.format(plot_file))
+            tg.add_node(graph,'bpphasesol_ob{}_plot'.format(i),'plotms',dict(vis=bptab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
+                        plotrange=[0,0,-180,180], expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                        iteraxis='antenna', coloraxis='spw', spw=spw_sel, observation=str(i)),deps=['bpphase'],kind='plot',inputs=[bptab])
+        
+        plot_file = plots_obs_dir+'bandpasssol_.png'
+        logger.info('Plotting bandpass amplitude solutions to: {}'.format(plot_file))
+        tg.add_node(graph,'bandpasssol_plot','plotms',dict(vis=bstab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='chan', yaxis='amp',
+                    expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                    iteraxis='antenna', coloraxis='spw', spw=spw_sel),deps=['bandpass'],kind='plot',inputs=[bstab])
     
-    for i in range(nobs):
-        plot_file = plots_obs_dir+'phasesol_ob{}.png'.format(i)
-        logger.info('Plotting phase solutions to: {}'.format(plot_file))
-        plotms(vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
-               expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-               iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,-20,20], spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
+        for i in range(nobs):
+            plot_file = plots_obs_dir+'phasesol_ob{}.png'.format(i)
+            logger.info('Plotting phase solutions to: {}'.format(plot_file))
+            tg.add_node(graph,'phasesol_ob{}_plot'.format(i),'plotms',dict(vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
+                        expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                        iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,-20,20], spw=spw_sel, observation=str(i)),deps=['amp'],kind='plot',inputs=[amtab])
 
-        plot_file = plots_obs_dir+'ampsol_ob{}.png'.format(i)
-        logger.info('Plotting amplitude solutions to: {}'.format(plot_file))
-        plotms(vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='amp',
-               expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-               iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,0,2], spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
+            plot_file = plots_obs_dir+'ampsol_ob{}.png'.format(i)
+            logger.info('Plotting amplitude solutions to: {}'.format(plot_file))
+            tg.add_node(graph,'ampsol_ob{}_plot'.format(i),'plotms',dict(vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='amp',
+                        expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                        iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,0,2], spw=spw_sel, observation=str(i)),deps=['amp'],kind='plot',inputs=[amtab])
     
-    if len(calfields.split(',')) > len(list(set(calib['fluxcal']))):
+    fluxscale = len(calfields) > len(list(set(calib['fluxcal'])))
+    if fluxscale:
         fxtab = cal_tabs+'fluxsol.cal'
         logger.info('Applying flux scale to calibrators ({}).'.format(fxtab))
-        command = "fluxscale(vis='{0}', caltable='{1}', fluxtable='{2}', reference='{3}', incremental=True)".format(msfile,amtab,fxtab,','.join(calib['fluxcal']))
-        logger.info('Executing command: flux_info = '+command)
-        exec('flux_info = '+command)
-
+        # Run in this process, as its return value (the fluxes) is needed
+        tg.add_node(graph,'fluxscale','fluxscale',dict(vis=msfile, caltable=amtab, fluxtable=fxtab, reference=','.join(calib['fluxcal']), incremental=True),
+                    deps=['amp'],local=True)
+    
+    failed = tg.run_graph(graph,logger,globals(),functools.partial(cf.check_casalog,config,config_raw,logger,casalog))
+    if len(failed) > 0:
+        logger.critical('Calibration solves failed: {}'.format(', '.join(failed)))
+        sys.exit(-1)
+    
+    if fluxscale:
+        flux_info = graph['results']['fluxscale']
         out_filename = sum_dir+'{0}.flux.summary'.format(msfile)
         logger.info('Writing calibrator fluxes summary to: {}.'.format(out_filename))
         for i in range(nspw):
@@ -900,89 +1051,170 @@ def calibration(msfile, config, config_raw, logger):
                     out_file.write('\n')
             out_file.close()
     
+    # applycal also flags data without solutions, so the queued plots of the flags and data must be made first
+    pq.wait_for_plots(logger)
+    # Each calibrated field and SPW is only written by one applycal call (see applycal_plan.py)
+    plan = ap.new_plan()
     logger.info('Apply all calibrations to bandpass and flux calibrators.')
     for i in range(len(calib['bandcal'])):
-        logger.info('Applying calibration to: {}'.format(calib['bandcal'][i]))
-        if calib['bandcal'][i] == calib['fluxcal'][i]:
-            if aptab is not None:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],aptab, gctab, dltab, bstab, iptab, amtab)
-            else:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}'], gainfield=['', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],gctab, dltab, bstab, iptab, amtab)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
+        bandcal = calib['bandcal'][i]
+        if bandcal == calib['fluxcal'][i]:
+            ap.request(plan,bandcal,mm.spws_for_field(meta,bandcal),pre_tab+[gctab, dltab, bstab, iptab, amtab],pre_field+['', bandcal, bandcal, bandcal, bandcal])
         else:
-            if aptab is not None:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{1}', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab)
-            else:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{1}', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],gctab, dltab, bstab, iptab, amtab, fxtab)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
-            
-            logger.info('Applying calibration to: {}'.format(calib['fluxcal'][i]))
-            if aptab is not None:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{9}', '{9}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['fluxcal'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab, calib['bandcal'][i])
-            else:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{8}', '{8}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['fluxcal'][i],gctab, dltab, bstab, iptab, amtab, fxtab, calib['bandcal'][i])
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
-            
-    plot_file = plots_obs_dir+'corr_phase.png'
-    logger.info('Plotting corrected phases for {0} to: {1}'.format(calib['bandcal'],plot_file))
-    plotms(vis=msfile, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='phase', ydatacolumn='corrected', correlation='RR,LL', 
-           avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
-           overwrite=True, showlegend=False, showgui=False)
-
-    plot_file = plots_obs_dir+'corr_amp.png'
-    logger.info('Plotting corrected amplitudes for {0} to: {1}'.format(calib['bandcal'],plot_file))
-    plotms(vis=msfile, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='amp', ydatacolumn='corrected', correlation='RR,LL', 
-           avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
-           overwrite=True, showlegend=False, showgui=False)
+            ap.request(plan,bandcal,mm.spws_for_field(meta,bandcal),pre_tab+[gctab, dltab, bstab, iptab, amtab, fxtab],pre_field+['', bandcal, bandcal, bandcal, bandcal, bandcal])
+            fluxcal = calib['fluxcal'][i]
+            ap.request(plan,fluxcal,mm.spws_for_field(meta,fluxcal),pre_tab+[gctab, dltab, bstab, iptab, amtab, fxtab],pre_field+['', bandcal, bandcal, fluxcal, fluxcal, fluxcal])
     
     logger.info('Apply all calibrations to phase calibrators and targets.')
     for i in range(len(calib['targets'])):
-        msmd.open(msfile)
-        spws = msmd.spwsforfield(calib['targets'][i])
-        msmd.close()
+        spws = mm.spws_for_field(meta,calib['targets'][i])
         inx = []
         for spw in spws:
             inx.append(spw_IDs.index(spw))
         bandcals = list(numpy.array(calib['bandcal'],dtype='str')[inx])
-        spws = list(numpy.array(spw_IDs,dtype='str')[inx])
+        spws = list(numpy.array(spw_IDs)[inx])
         unique_bandcals = list(set(bandcals))
         for bandcal in unique_bandcals:
-            inx = [j for j,x in enumerate(bandcals) if x == bandcal]
-            if not calib['phasecal'][i] in calib['fluxcal']:
-                logger.info('Applying calibration to: {}'.format(calib['phasecal'][i]))
-                if aptab is not None:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{9}', '{9}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['phasecal'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab, bandcal)
-                else:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{8}', '{8}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['phasecal'][i],gctab, dltab, bstab, iptab, amtab, fxtab, bandcal)
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
-                logger.info('Applying calibration to: {}'.format(calib['targets'][i]))
-                if aptab is not None:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{9}', '{9}', '{10}', '{10}', '{10}'], calwt=False)".format(msfile,calib['targets'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab, bandcal, calib['phasecal'][i])
-                else:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{8}', '{8}', '{9}', '{9}', '{9}'], calwt=False)".format(msfile,calib['targets'][i],gctab, dltab, bstab, iptab, amtab, fxtab, bandcal, calib['phasecal'][i])
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
+            # Each bandpass calibrator is applied to the SPWs it calibrates
+            bandcal_spws = [spws[j] for j,x in enumerate(bandcals) if x == bandcal]
+            phasecal = calib['phasecal'][i]
+            if not phasecal in calib['fluxcal']:
+                ap.request(plan,phasecal,bandcal_spws,pre_tab+[gctab, dltab, bstab, iptab, amtab, fxtab],pre_field+['', bandcal, bandcal, phasecal, phasecal, phasecal])
+                ap.request(plan,calib['targets'][i],bandcal_spws,pre_tab+[gctab, dltab, bstab, iptab, amtab, fxtab],pre_field+['', bandcal, bandcal, phasecal, phasecal, phasecal])
             else:
-                logger.info('Applying calibration to: {}'.format(calib['targets'][i]))
-                if aptab is not None:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '', '{8}', '{8}', '{9}', '{9}'], calwt=False)".format(msfile,calib['targets'][i],aptab, gctab, dltab, bstab, iptab, amtab, bandcal, calib['phasecal'][i])
-                else:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}'], gainfield=['', '{7}', '{7}', '{8}', '{8}'], calwt=False)".format(msfile,calib['targets'][i],gctab, dltab, bstab, iptab, amtab, bandcal, calib['phasecal'][i])
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
+                ap.request(plan,calib['targets'][i],bandcal_spws,pre_tab+[gctab, dltab, bstab, iptab, amtab],pre_field+['', bandcal, bandcal, phasecal, phasecal])
+    apply_plan(msfile,plan,config,config_raw,logger)
+    
+    if not plots:
+        logger.info('The calibrated data and solutions will be plotted after the next calibration pass.')
+    elif cf.plot_engine(config,config_raw) == 'cache':
+        cache = vc.build_cache(msfile,'CORRECTED_DATA',meta,tb,logger,calib['bandcal'])
+        for spw in spw_IDs:
+            entries = [entry for key,entry in vc.entries_for(msfile,'CORRECTED_DATA',cache,calib['bandcal'],[spw])]
+            if len(entries) == 0:
+                continue
+            for yaxis,plot_root in [('phase','corr_phase'),('amp','corr_amp')]:
+                plot_file = plots_obs_dir+'{0}_Spw{1}.png'.format(plot_root,spw)
+                logger.info('Plotting corrected {0} for {1} to: {2}'.format(yaxis,calib['bandcal'],plot_file))
+                vp.plot_antenna_spectra(entries,plot_file,'{0} spw{1}: corrected {2}, baselines to {3}'.format(','.join(calib['bandcal']),spw,yaxis,calib['refant']),
+                                        calib['refant'],yaxis=yaxis,corrs=['RR','LL'])
+    else:
+        plot_file = plots_obs_dir+'corr_phase.png'
+        logger.info('Plotting corrected phases for {0} to: {1}'.format(calib['bandcal'],plot_file))
+        pq.queue_plot('plotms',dict(vis=msfile, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='phase', ydatacolumn='corrected', correlation='RR,LL', 
+                      avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
+                      overwrite=True, showlegend=False, showgui=False),[msfile],logger,globals())
+
+        plot_file = plots_obs_dir+'corr_amp.png'
+        logger.info('Plotting corrected amplitudes for {0} to: {1}'.format(calib['bandcal'],plot_file))
+        pq.queue_plot('plotms',dict(vis=msfile, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='amp', ydatacolumn='corrected', correlation='RR,LL', 
+                      avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
+                      overwrite=True, showlegend=False, showgui=False),[msfile],logger,globals())
+    
+    # The target fields only share rows with the bandpass calibrator plots, but later steps change the flags of all fields
+    pq.wait_for_plots(logger)
     logger.info('Completed calibration.')
+    return flag_free
+
+
+def solve_groups(meta,calib,spw_IDs,calfields,config,config_raw,logger):
+    """
+    Splits the calibration solves into groups of observations or SPWs (the 'solve_groups' parameter), each with its own chain
+    of solves that can run in parallel with the others.
+    
+    Input:
+    meta = The metadata of the MS. (Dictionary)
+    calib = The calibration parameters. (Ordered dictionary)
+    spw_IDs = The SPWs to calibrate. (List of Integers)
+    calfields = All the calibrator fields. (List of Strings)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    
+    Output:
+    groups = Name, SPWs, observation selection, bandpass calibrators and calibrators of each group.
+             A single group without a name if the solves are not split. (List of Dictionaries)
+    """
+    combined = [{'name': None, 'spws': spw_IDs, 'observation': '', 'bandcal': calib['bandcal'], 'calfields': calfields}]
+    mode = 'none'
+    if config_raw.has_option('calibration','solve_groups'):
+        mode = str(config['calibration']['solve_groups']).lower()
+    if mode not in ['obs','spw']:
+        return combined
+    groups = []
+    if mode == 'obs':
+        for obs in range(meta['nobs']):
+            scans = [scan for scan in meta['scans'] if scan['obs'] == obs]
+            spws = sorted(set([spw for scan in scans for spw in scan['spws'] if spw in spw_IDs]))
+            fields = set([field for scan in scans for field in scan['fields']])
+            groups.append({'name': 'obs{}'.format(obs), 'spws': spws, 'observation': str(obs), 'fields': fields})
+    else:
+        for spw in spw_IDs:
+            groups.append({'name': 'spw{}'.format(spw), 'spws': [spw], 'observation': '', 'fields': set(mm.fields_for_spw(meta,spw))})
+    groups = [group for group in groups if len(group['spws']) > 0]
+    for group in groups:
+        group['bandcal'] = sorted(set([field for field in calib['bandcal'] if field in group['fields']]))
+        group['calfields'] = [field for field in calfields if field in group['fields']]
+        if len(group['bandcal']) == 0:
+            logger.warning('There is no bandpass calibrator in {}, the solves will not be split into groups.'.format(group['name']))
+            return combined
+    if len(groups) < 2:
+        return combined
+    logger.info('The solves will be made separately for {0} groups: {1}.'.format(len(groups),', '.join([group['name'] for group in groups])))
+    return groups
+
+def merge_caltables(tables,caltable):
+    """
+    Merges the calibration tables solved for separate groups of observations or SPWs into one table,
+    so that the merged table can be applied (and plotted) like one solved for all the data at once.
+    
+    Input:
+    tables = The tables of the groups (made from the same MS). (List of Strings)
+    caltable = Path of the merged table. (String)
+    
+    Output:
+    True once the table is written (the return value of a graph node). (Boolean)
+    """
+    if os.path.exists(caltable):
+        shutil.rmtree(caltable)
+    tb.open(tables[0])
+    tb.copy(caltable,deep=True,valuecopy=True,returnobject=False)
+    tb.close()
+    # The subtables (antennas, fields, SPWs, observations) are copied from the MS, so they are the same for every group
+    for table in tables[1:]:
+        tb.open(table)
+        tb.copyrows(caltable)
+        tb.close()
+    return True
+
+def apply_plan(msfile,plan,config,config_raw,logger):
+    """
+    Applies the calibration with the fewest applycal calls that carry out a plan (see applycal_plan.py).
+    
+    Input:
+    msfile = Path to the MS. (String)
+    plan = The requested calibration applications. (Dictionary)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    calls = ap.calls(plan)
+    for call in calls:
+        logger.info('Applying calibration to: {0} (SPWs {1})'.format(call['field'],call['spw']))
+        command = "applycal(vis='{0}', field='{1}', spw='{2}', gaintable={3}, gainfield={4}, calwt=False)".format(msfile,call['field'],call['spw'],call['gaintable'],call['gainfield'])
+        logger.info('Executing command: '+command)
+        exec(command)
+        cf.check_casalog(config,config_raw,logger,casalog)
+    logger.info('{0} calibration applications were made with {1} applycal calls ({2} passes over the MS saved).'.format(plan['requests'],len(calls),plan['requests']-len(calls)))
 
 
+def split_summary(split_ms,listobs_file,logger):
+    """
+    Writes a listobs-style summary of a split MS from its metadata snapshot (rather than running listobs).
+    
+    Input:
+    split_ms = Path to the split MS. (String)
+    listobs_file = Path of the summary file. (String)
+    """
+    mm.write_summary(split_ms,mm.get_metadata(split_ms,msmd,tb,logger),listobs_file,logger)
 
 def split_fields(msfile,config,config_raw,config_file,logger):
     """
@@ -1006,6 +1238,9 @@ def split_fields(msfile,config,config_raw,config_file,logger):
         configfile = open(config_file,'w')
         config_raw.write(configfile)
         configfile.close()
+    meta = mm.get_metadata(msfile,msmd,tb,logger)
+    # The split MS stay partitioned like the MS, except when SPWs are combined from an MS partitioned by SPW
+    keepmms = cf.partition_axis(config,config_raw) != 'spw'
     if calib['mosaic']:
         logger.info('The parameters file indicates that this data set is a mosaic.')
         unique_names = list(set(calib['target_names']))
@@ -1013,39 +1248,35 @@ def split_fields(msfile,config,config_raw,config_file,logger):
             logger.info('All observations of {} will now be split off into a separate MS.'.format(target_name))
             inx = [i for i in range(len(calib['target_names'])) if target_name in calib['target_names'][i]]
             fields = numpy.array(calib['targets'],dtype='str')[inx]
-            msmd.open(msfile)
             spws = []
             for field in fields:
-                spws.extend(msmd.spwsforfield(field))
-            msmd.close()
+                spws.extend(mm.spws_for_field(meta,field))
             spws = list(set(spws))
-            command = "mstransform(vis='{0}', outputvis='{2}{1}.split', field='{3}', spw='{4}', combinespws=True)".format(msfile,target_name,src_dir,','.join(numpy.array(fields,dtype='str')),','.join(numpy.array(spws,dtype='str')))
+            command = "mstransform(vis='{0}', outputvis='{2}{1}.split', field='{3}', spw='{4}', combinespws=True, keepmms={5})".format(msfile,target_name,src_dir,','.join(numpy.array(fields,dtype='str')),','.join(numpy.array(spws,dtype='str')),keepmms)
             logger.info('Executing command: '+command)
             exec(command)
             cf.check_casalog(config,config_raw,logger,casalog)
             listobs_file = sum_dir+target_name+'.listobs.summary'
             cf.rmfile(listobs_file,logger)
             logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-            listobs(vis=src_dir+target_name+'.split', listfile=listobs_file)
+            split_summary(src_dir+target_name+'.split',listobs_file,logger)
     else:
         new_target_names = calib['target_names'][:]
         for i in range(len(calib['targets'])):
             field = calib['targets'][i]
             target_name = calib['target_names'][i]
-            msmd.open(msfile)
-            spws = msmd.spwsforfield(field)
+            spws = mm.spws_for_field(meta,field)
             nchans = []
             maxfreqs = []
             minfreqs = []
             chan_wids = []
             for spw in spws:
-                nchans.append(msmd.nchan(spw))
-                freqs = msmd.chanfreqs(spw)
-                wids = msmd.chanwidths(spw)
+                nchans.append(len(meta['chan_freqs'][spw]))
+                freqs = meta['chan_freqs'][spw]
+                wids = meta['chan_widths'][spw]
                 maxfreqs.append(numpy.round(max(freqs)/1.E6,4))
                 minfreqs.append(numpy.round(min(freqs)/1.E6,4))
                 chan_wids.append(numpy.round(numpy.mean(wids)/1.E3,3))
-            msmd.close()
             if len(spws) > 1:
                 if config_raw.has_option('calibration','man_comb_spws'):
                     combine_spws = dict(calib['man_comb_spws'])[field]
@@ -1109,14 +1340,14 @@ def split_fields(msfile,config,config_raw,config_file,logger):
                         combine_list = [key]
                         combine_list.extend(combine_spws[key])
                         logger.info('SPWs {0} will now be combined for {1}.'.format(combine_list,target_name))
-                        command = "mstransform(vis='{0}', outputvis='{2}{1}.split', field='{3}', spw='{4}', combinespws=True)".format(msfile,target_name,src_dir,field,','.join(numpy.array(list(set(combine_list)),dtype='str')))
+                        command = "mstransform(vis='{0}', outputvis='{2}{1}.split', field='{3}', spw='{4}', combinespws=True, keepmms={5})".format(msfile,target_name,src_dir,field,','.join(numpy.array(list(set(combine_list)),dtype='str')),keepmms)
                         logger.info('Executing command: '+command)
                         exec(command)
                         cf.check_casalog(config,config_raw,logger,casalog)
                         listobs_file = sum_dir+target_name+'.listobs.summary'
                         cf.rmfile(listobs_file,logger)
                         logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                        listobs(vis=src_dir+target_name+'.split', listfile=listobs_file)
+                        split_summary(src_dir+target_name+'.split',listobs_file,logger)
                     else:
                         for key in combine_spws.keys():
                             combine_list = [key]
@@ -1124,14 +1355,14 @@ def split_fields(msfile,config,config_raw,config_file,logger):
                             logger.info('SPWs {0} will now be combined for {1}.'.format(combine_list,target_name))
                             inx = new_target_names.index(target_name)
                             new_target_names.remove(target_name)
-                            command = "mstransform(vis='{0}', outputvis='{2}{1}.spw{5}.split', field='{3}', spw='{4}', combinespws=True)".format(msfile,target_name,src_dir,field,','.join(numpy.array(list(set(combine_list)),dtype='str')),'+'.join(numpy.array(list(set(combine_list)),dtype='str')))
+                            command = "mstransform(vis='{0}', outputvis='{2}{1}.spw{5}.split', field='{3}', spw='{4}', combinespws=True, keepmms={6})".format(msfile,target_name,src_dir,field,','.join(numpy.array(list(set(combine_list)),dtype='str')),'+'.join(numpy.array(list(set(combine_list)),dtype='str')),keepmms)
                             logger.info('Executing command: '+command)
                             exec(command)
                             cf.check_casalog(config,config_raw,logger,casalog)
                             listobs_file = sum_dir+target_name+'.spw{}.listobs.summary'.format('+'.join(numpy.array(set(combine_list),dtype='str')))
                             cf.rmfile(listobs_file,logger)
                             logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                            listobs(vis=src_dir+target_name+'.spw{}.split'.format('+'.join(numpy.array(list(set(combine_list)),dtype='str'))), listfile=listobs_file)
+                            split_summary(src_dir+target_name+'.spw{}.split'.format('+'.join(numpy.array(list(set(combine_list)),dtype='str'))),listobs_file,logger)
                             new_target_names.insert(inx,target_name+'.spw{}'.format('+'.join(numpy.array(list(set(combine_list)),dtype='str'))))
                             inx += 1
                 if separate:
@@ -1156,7 +1387,7 @@ def split_fields(msfile,config,config_raw,config_file,logger):
                             listobs_file = sum_dir+target_name+'.spw{}.listobs.summary'.format(spw)
                             cf.rmfile(listobs_file,logger)
                             logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                            listobs(vis=src_dir+target_name+'.spw{}.split'.format(spw), listfile=listobs_file)
+                            split_summary(src_dir+target_name+'.spw{}.split'.format(spw),listobs_file,logger)
                             new_target_names.insert(inx+j,target_name+'.spw{}'.format(spw))
             else:
                 logger.info('Splitting {0} into separate file: {1}.'.format(field, target_name+'.split'))
@@ -1167,7 +1398,7 @@ def split_fields(msfile,config,config_raw,config_file,logger):
                 listobs_file = sum_dir+target_name+'.listobs.summary'
                 cf.rmfile(listobs_file,logger)
                 logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                listobs(vis=src_dir+target_name+'.split', listfile=listobs_file)
+                split_summary(src_dir+target_name+'.split',listobs_file,logger)
         if new_target_names != calib['target_names']:
             logger.info('Updating config file to set target names with separate SPWs.')
             logger.info('Replacing old target names ({})'.format(calib['target_names']))
@@ -1193,49 +1424,83 @@ msfile = '{0}.ms'.format(config['global']['project_name'])
 
 #Flag, set intents, calibrate, flag more, calibrate again, then split fields
 cf.check_casaversion(logger)
+cf.start_casalog_watchdog(config,config_raw,logger,casalog)
+plot_workers = 0
+if config_raw.has_option('global','plot_workers'):
+    plot_workers = config['global']['plot_workers']
+pq.start_plot_queue(plot_workers,logger)
 flag_version = 'Original'
-if  os.path.isdir(msfile+'.flagversions/flags.Original'):
+if flag_version_exists(msfile,flag_version):
     restore_flags(msfile,flag_version,logger)
 else:
     save_flags(msfile,flag_version,logger)
-manual_flags(config,config_raw,logger)
-base_flags(msfile,config,config_raw,logger)
-if config_raw.has_option('flagging','no_tfcrop'):
+flag_engine = 'casa'
+if config_raw.has_option('flagging','engine'):
+    flag_engine = config['flagging']['engine']
+flag_version = 'initial'
+commands = manual_flags(config,config_raw,logger)
+commands.extend(base_flags(msfile,config,config_raw,logger))
+if flag_engine == 'sumthreshold':
+    logger.info('TFCrop and rflag are replaced by SumThreshold.')
+elif config_raw.has_option('flagging','no_tfcrop'):
     if not config['flagging']['no_tfcrop']:
-        tfcrop(msfile,config,config_raw,logger)
+        commands.extend(tfcrop(msfile,config,config_raw,logger))
 else:
-    tfcrop(msfile,config,config_raw,logger)
-flag_version = 'initial'
+    commands.extend(tfcrop(msfile,config,config_raw,logger))
+batch_flags(msfile,commands,flag_version,config,config_raw,logger)
 rm_flags(msfile,flag_version,logger)
 save_flags(msfile,flag_version,logger)
 flag_sum(msfile,flag_version,logger)
 select_refant(msfile,config,config_raw,config_file,logger)
 set_fields(msfile,config,config_raw,config_file,logger)
 plot_flags(msfile,flag_version,logger)
-calibration(msfile,config,config_raw,logger)
 skip_rflag = False
 if config_raw.has_option('flagging','no_rflag'):
     if config['flagging']['no_rflag']:
         skip_rflag = True
+if flag_engine == 'sumthreshold':
+    # SumThreshold flags the uncalibrated data, so the calibration is only made once
+    skip_rflag = True
+    # SumThreshold writes the FLAG column directly, so the queued plots of the initial flags must be made first
+    pq.wait_for_plots(logger)
+    sumthreshold(msfile,config,config_raw,logger)
+    flag_version = 'sumthreshold'
+    rm_flags(msfile,flag_version,logger)
+    save_flags(msfile,flag_version,logger)
+    flag_sum(msfile,flag_version,logger)
+    flag_diff(msfile,'initial',flag_version,logger)
+    extend_flags(msfile,config,config_raw,logger)
+    flag_version = 'extended'
+    rm_flags(msfile,flag_version,logger)
+    save_flags(msfile,flag_version,logger)
+    flag_sum(msfile,flag_version,logger)
+    flag_diff(msfile,'sumthreshold',flag_version,logger)
+# The second pass (after rflag) only remakes the solutions that depend on the flags, and replaces the plots of the first
+flag_free = calibration(msfile,config,config_raw,logger,plots=skip_rflag)
 if not skip_rflag:
     rflag(msfile,config,config_raw,logger)
     flag_version = 'rflag'
     rm_flags(msfile,flag_version,logger)
     save_flags(msfile,flag_version,logger)
     flag_sum(msfile,flag_version,logger)
+    flag_diff(msfile,'initial',flag_version,logger)
     extend_flags(msfile,config,config_raw,logger)
     flag_version = 'extended'
     rm_flags(msfile,flag_version,logger)
     save_flags(msfile,flag_version,logger)
     flag_sum(msfile,flag_version,logger)
-    calibration(msfile,config,config_raw,logger)
+    flag_diff(msfile,'rflag',flag_version,logger)
+    calibration(msfile,config,config_raw,logger,reuse=flag_free)
+prev_version = flag_version
 flag_version = 'final'
 rm_flags(msfile,flag_version,logger)
 save_flags(msfile,flag_version,logger)
 flag_sum(msfile,flag_version,logger)
+flag_diff(msfile,prev_version,flag_version,logger)
 plot_flags(msfile,flag_version,logger)
 cf.rmdir(config['global']['src_dir'],logger)
 split_fields(msfile,config,config_raw,config_file,logger)
+pq.wait_for_plots(logger)
 
 #Review and backup parameters file
 cf.diff_pipeline_params(config_file,logger)
@@ -0,0 +1,177 @@
+import numpy
+
+
+# Width of the time bins of the flag statistics in seconds
+time_bin = 600.
+
+# Approximate size in bytes of the chunks of the FLAG column read at once
+chunk_bytes = 2**26
+
+# Axes along which the flag statistics are accumulated
+stat_axes = ['antenna','spw','field','scan','time']
+
+
+def flag_stats(msfile,meta,tb,logger):
+    """
+    Counts the flagged and total visibilities of an MS per antenna, baseline, SPW, field, scan and time bin.
+    The FLAG column is read once, in chunks of rows of each data description.
+
+    Input:
+    msfile = Path to the MS. (String)
+    meta = The metadata of the MS (see ms_metadata.py). (Dictionary)
+    tb = The tb tool of the calling script.
+
+    Output:
+    stats = Arrays of flagged ('<axis>_flagged') and total ('<axis>_total') counts, and the labels of each axis. (Dictionary)
+    """
+    logger.info('Reading the flags of {}.'.format(msfile))
+    nant = len(meta['antennas'])
+    scans = numpy.array(sorted(set(scan['scan'] for scan in meta['scans'])),dtype=int)
+    t_start = min(time_range[0] for time_range in meta['obs_time_ranges'])
+    t_end = max(time_range[1] for time_range in meta['obs_time_ranges'])
+    ntime = int((t_end-t_start)//time_bin)+1
+    stats = {'antenna_names': numpy.array(meta['antennas']),
+             'spw_ids': numpy.arange(meta['nspw']),
+             'field_names': numpy.array(meta['fields']),
+             'scan_numbers': scans,
+             'time_starts': t_start+time_bin*numpy.arange(ntime)}
+    sizes = {'antenna': nant, 'spw': meta['nspw'], 'field': len(meta['fields']), 'scan': len(scans), 'time': ntime}
+    for axis in stat_axes:
+        stats[axis+'_flagged'] = numpy.zeros(sizes[axis])
+        stats[axis+'_total'] = numpy.zeros(sizes[axis])
+    stats['baseline_flagged'] = numpy.zeros((nant,nant))
+    stats['baseline_total'] = numpy.zeros((nant,nant))
+    tb.open(msfile+'/DATA_DESCRIPTION')
+    ddid_spws = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    tb.open(msfile)
+    try:
+        for ddid in range(len(ddid_spws)):
+            spw = ddid_spws[ddid]
+            sub = tb.query('DATA_DESC_ID=={}'.format(ddid))
+            try:
+                nrows = sub.nrows()
+                if nrows == 0:
+                    continue
+                npol,nchan = sub.getcell('FLAG',0).shape
+                step = max(1,int(chunk_bytes//(npol*nchan)))
+                for start in range(0,nrows,step):
+                    nrow = min(step,nrows-start)
+                    flagged = numpy.sum(sub.getcol('FLAG',startrow=start,nrow=nrow),axis=(0,1)).astype('float64')
+                    total = numpy.full(nrow,float(npol*nchan))
+                    ant1 = sub.getcol('ANTENNA1',startrow=start,nrow=nrow)
+                    ant2 = sub.getcol('ANTENNA2',startrow=start,nrow=nrow)
+                    index = {'field': sub.getcol('FIELD_ID',startrow=start,nrow=nrow),
+                             'scan': numpy.searchsorted(scans,sub.getcol('SCAN_NUMBER',startrow=start,nrow=nrow)),
+                             'time': numpy.clip(((sub.getcol('TIME',startrow=start,nrow=nrow)-t_start)//time_bin).astype(int),0,ntime-1)}
+                    for counts,name in [(flagged,'_flagged'),(total,'_total')]:
+                        # Each baseline counts towards both of its antennas (as in flagdata summaries)
+                        stats['antenna'+name] += numpy.bincount(ant1,weights=counts,minlength=nant)+numpy.bincount(ant2,weights=counts,minlength=nant)
+                        stats['baseline'+name] += numpy.bincount(ant1*nant+ant2,weights=counts,minlength=nant*nant).reshape(nant,nant)
+                        stats['spw'+name][spw] += numpy.sum(counts)
+                        for axis in ['field','scan','time']:
+                            stats[axis+name] += numpy.bincount(index[axis],weights=counts,minlength=sizes[axis])
+            finally:
+                sub.close()
+    finally:
+        tb.close()
+    return stats
+
+def save_flag_stats(stats,stats_file,logger):
+    """
+    Saves flag statistics to a .npz file.
+
+    Input:
+    stats = The output of flag_stats. (Dictionary)
+    stats_file = Path of the file to write. (String)
+    """
+    numpy.savez_compressed(stats_file,**stats)
+    logger.info('Flag statistics saved to: {}'.format(stats_file))
+
+def load_flag_stats(stats_file):
+    """
+    Reads flag statistics saved by save_flag_stats.
+
+    Input:
+    stats_file = Path of the .npz file. (String)
+
+    Output:
+    stats = The flag statistics. (Dictionary)
+    """
+    data = numpy.load(stats_file)
+    stats = dict((key,data[key]) for key in data.files)
+    data.close()
+    return stats
+
+def fraction(flagged,total):
+    """
+    Returns the flagged fraction, 0 where there is no data.
+    """
+    flagged = numpy.asarray(flagged,dtype='float64')
+    total = numpy.asarray(total,dtype='float64')
+    return numpy.where(total > 0,flagged/numpy.maximum(total,1.),0.)
+
+def write_flag_summary(stats,summary_file,logger):
+    """
+    Writes the total flagged fraction and the fractions per SPW, field and antenna to a text file (the format of the flagdata summaries).
+
+    Input:
+    stats = The flag statistics. (Dictionary)
+    summary_file = Path of the file to write. (String)
+    """
+    total = fraction(numpy.sum(stats['spw_flagged']),numpy.sum(stats['spw_total']))
+    logger.info('Total flagged data: {:.2%}'.format(float(total)))
+    out_file = open(summary_file,'w')
+    out_file.write('Total flagged data: {:.2%}\n\n'.format(float(total)))
+    out_file.write('Flagging per spectral window\n')
+    spw_frac = fraction(stats['spw_flagged'],stats['spw_total'])
+    for i in range(len(stats['spw_ids'])):
+        if stats['spw_total'][i] > 0:
+            out_file.write('SPW {0}: {1:.2%}\n'.format(stats['spw_ids'][i],spw_frac[i]))
+    out_file.write('\nFlagging per field\n')
+    field_frac = fraction(stats['field_flagged'],stats['field_total'])
+    for i in range(len(stats['field_names'])):
+        if stats['field_total'][i] > 0:
+            out_file.write('{0}: {1:.2%}\n'.format(stats['field_names'][i],field_frac[i]))
+    out_file.write('\nFlagging per antenna\n')
+    ant_frac = fraction(stats['antenna_flagged'],stats['antenna_total'])
+    for i in range(len(stats['antenna_names'])):
+        if stats['antenna_total'][i] > 0:
+            out_file.write('{0}: {1:.2%}\n'.format(stats['antenna_names'][i],ant_frac[i]))
+    out_file.close()
+
+def write_flag_diff(old,new,old_name,new_name,diff_file,logger):
+    """
+    Writes the change in the flagged fractions between two sets of flag statistics of the same MS.
+
+    Input:
+    old, new = The flag statistics of the two flag versions. (Dictionaries)
+    old_name, new_name = Names of the flag versions. (Strings)
+    diff_file = Path of the file to write. (String)
+    """
+    lines = []
+    change = fraction(numpy.sum(new['spw_flagged']),numpy.sum(new['spw_total']))-fraction(numpy.sum(old['spw_flagged']),numpy.sum(old['spw_total']))
+    logger.info('Change in flagged data from {0} to {1}: {2:+.2%}'.format(old_name,new_name,float(change)))
+    lines.append('Change in flagged data from {0} to {1}: {2:+.2%}'.format(old_name,new_name,float(change)))
+    labels = {'spw': ['SPW {}'.format(spw) for spw in new['spw_ids']],
+              'field': new['field_names'],
+              'scan': ['Scan {}'.format(scan) for scan in new['scan_numbers']],
+              'antenna': new['antenna_names']}
+    for axis in ['spw','field','scan','antenna']:
+        lines.append('')
+        lines.append('Change per {}'.format(axis))
+        delta = fraction(new[axis+'_flagged'],new[axis+'_total'])-fraction(old[axis+'_flagged'],old[axis+'_total'])
+        for i in numpy.argsort(-delta):
+            if new[axis+'_total'][i] > 0:
+                lines.append('{0}: {1:+.2%}'.format(labels[axis][i],delta[i]))
+    delta = fraction(new['baseline_flagged'],new['baseline_total'])-fraction(old['baseline_flagged'],old['baseline_total'])
+    lines.append('')
+    lines.append('Baselines with the largest changes')
+    order = numpy.argsort(-delta,axis=None)
+    for i in order[:20]:
+        ant1,ant2 = numpy.unravel_index(i,delta.shape)
+        if new['baseline_total'][ant1,ant2] > 0 and delta[ant1,ant2] != 0.:
+            lines.append('{0}-{1}: {2:+.2%}'.format(new['antenna_names'][ant1],new['antenna_names'][ant2],delta[ant1,ant2]))
+    out_file = open(diff_file,'w')
+    out_file.write('\n'.join(lines)+'\n')
+    out_file.close()
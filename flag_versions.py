@@ -0,0 +1,284 @@
+import os
+import json
+import shutil
+import numpy
+from multiprocessing.pool import ThreadPool
+
+
+# Approximate number of flags (bytes of the unpacked FLAG column) in each chunk of rows
+chunk_flags = 2**26
+
+# Number of threads used to encode and decode chunks
+nthreads = 4
+
+
+def store_dir(msfile):
+    """
+    Returns the directory of the compact flag versions of an MS.
+    """
+    return msfile.rstrip('/')+'.flagstore'
+
+def read_index(msfile):
+    """
+    Reads the index of the flag store (the parent and layout of each version and the version last saved or restored).
+
+    Input:
+    msfile = Path to the MS. (String)
+
+    Output:
+    index = The index, empty if there is no store. (Dictionary)
+    """
+    index_file = os.path.join(store_dir(msfile),'index.json')
+    if not os.path.exists(index_file):
+        return {'versions': {}, 'current': None}
+    index = open(index_file,'r')
+    try:
+        return json.load(index)
+    finally:
+        index.close()
+
+def write_index(msfile,index):
+    """
+    Writes the index of the flag store (atomically).
+    """
+    index_file = os.path.join(store_dir(msfile),'index.json')
+    tmp_file = index_file+'.tmp{}'.format(os.getpid())
+    index_out = open(tmp_file,'w')
+    json.dump(index,index_out,indent=1)
+    index_out.close()
+    os.rename(tmp_file,index_file)
+
+def has_version(msfile,name):
+    """
+    Checks if a flag version exists in the store.
+    """
+    return name in read_index(msfile)['versions']
+
+def chunk_file(msfile,name,ddid,chunk):
+    """
+    Returns the path of one chunk of a flag version.
+    """
+    return os.path.join(store_dir(msfile),name,'d{0}_c{1}.npz'.format(ddid,chunk))
+
+def ms_layout(tb,msfile):
+    """
+    Returns the number of rows and the flag shape of each data description of an MS.
+
+    Output:
+    layout = [DATA_DESC_ID, rows, polarizations, channels] for each data description with data. (List of Lists)
+    """
+    tb.open(msfile+'/DATA_DESCRIPTION')
+    nddid = tb.nrows()
+    tb.close()
+    layout = []
+    tb.open(msfile)
+    try:
+        for ddid in range(nddid):
+            sub = tb.query('DATA_DESC_ID=={}'.format(ddid))
+            try:
+                if sub.nrows() > 0:
+                    npol,nchan = sub.getcell('FLAG',0).shape
+                    layout.append([ddid,sub.nrows(),npol,nchan])
+            finally:
+                sub.close()
+    finally:
+        tb.close()
+    return layout
+
+def chunk_rows(npol,nchan):
+    """
+    Returns the number of rows in each chunk of a data description.
+    """
+    return max(1,int(chunk_flags//(npol*nchan)))
+
+def encode_chunk(flags,flag_row,parent):
+    """
+    Bit-packs the flags of a chunk of rows and encodes them as the positions and values of the bytes that differ from the parent version.
+    The packed flags are stored in full if there is no parent or the difference is not sparse.
+
+    Input:
+    flags = FLAG column of the rows. (Boolean array)
+    flag_row = FLAG_ROW column of the rows. (Boolean array)
+    parent = The packed flags of the parent version, None for no parent. (Array)
+
+    Output:
+    packed = The packed flags. (Array)
+    arrays = The arrays to save. (Dictionary)
+    """
+    packed = numpy.packbits(flags.ravel())
+    arrays = {'row': numpy.packbits(flag_row)}
+    if parent is not None:
+        delta = numpy.bitwise_xor(packed,parent)
+        idx = numpy.flatnonzero(delta)
+        # Each changed byte costs 5 bytes (int32 position and value)
+        if 5*len(idx) < len(packed):
+            arrays['idx'] = idx.astype('int32')
+            arrays['val'] = delta[idx]
+            return packed,arrays
+    arrays['full'] = packed
+    return packed,arrays
+
+def decode_chunk(msfile,index,name,ddid,chunk):
+    """
+    Reconstructs the packed flags of a chunk of a version, applying the deltas along its chain of parents.
+
+    Output:
+    packed = The packed FLAG column. (Array)
+    row = The packed FLAG_ROW column. (Array)
+    """
+    chain = []
+    version = name
+    while True:
+        data = numpy.load(chunk_file(msfile,version,ddid,chunk))
+        arrays = dict((key,data[key]) for key in data.files)
+        data.close()
+        chain.append(arrays)
+        if 'full' in arrays:
+            break
+        version = index['versions'][version]['parent']
+    packed = chain[-1]['full'].copy()
+    for arrays in reversed(chain[:-1]):
+        packed[arrays['idx']] ^= arrays['val']
+    return packed,chain[0]['row']
+
+def version_chunks(layout):
+    """
+    Lists the chunks of rows of an MS.
+
+    Output:
+    chunks = (DATA_DESC_ID, chunk number, first row, number of rows, polarizations, channels) for each chunk. (List of Tuples)
+    """
+    chunks = []
+    for ddid,nrows,npol,nchan in layout:
+        step = chunk_rows(npol,nchan)
+        for chunk,start in enumerate(range(0,nrows,step)):
+            chunks.append((ddid,chunk,start,min(step,nrows-start),npol,nchan))
+    return chunks
+
+def save_version(msfile,name,tb,logger):
+    """
+    Saves the current flags of an MS as a version in the flag store, as a delta against the version last saved or restored.
+
+    Input:
+    msfile = Path to the MS. (String)
+    name = Name of the flag version. (String)
+    tb = The tb tool of the calling script.
+    """
+    index = read_index(msfile)
+    if name in index['versions']:
+        remove_version(msfile,name,logger)
+        index = read_index(msfile)
+    parent = index['current']
+    layout = ms_layout(tb,msfile)
+    if parent is not None and index['versions'][parent]['layout'] != layout:
+        logger.warning('The shape of {0} has changed since flag version {1} was saved. {2} will be saved in full.'.format(msfile,parent,name))
+        parent = None
+    logger.info('Saving flag version {0} in {1} (parent version: {2}).'.format(name,store_dir(msfile),parent))
+    os.makedirs(os.path.join(store_dir(msfile),name))
+    pool = ThreadPool(nthreads)
+    nbytes = 0
+    tb.open(msfile)
+    try:
+        chunks = version_chunks(layout)
+        for batch in range(0,len(chunks),nthreads):
+            # Read a batch of chunks (the table tool is only used by this thread), then encode them in parallel
+            jobs = []
+            for ddid,chunk,start,nrow,npol,nchan in chunks[batch:batch+nthreads]:
+                sub = tb.query('DATA_DESC_ID=={}'.format(ddid))
+                jobs.append((ddid,chunk,sub.getcol('FLAG',startrow=start,nrow=nrow),sub.getcol('FLAG_ROW',startrow=start,nrow=nrow)))
+                sub.close()
+            def encode(job):
+                ddid,chunk,flags,flag_row = job
+                parent_packed = None
+                if parent is not None:
+                    parent_packed = decode_chunk(msfile,index,parent,ddid,chunk)[0]
+                arrays = encode_chunk(flags,flag_row,parent_packed)[1]
+                numpy.savez(chunk_file(msfile,name,ddid,chunk),**arrays)
+                return sum(array.nbytes for array in arrays.values())
+            nbytes += sum(pool.map(encode,jobs))
+    finally:
+        tb.close()
+        pool.close()
+        pool.join()
+    index['versions'][name] = {'parent': parent, 'layout': layout}
+    index['current'] = name
+    write_index(msfile,index)
+    logger.info('Flag version {0} saved ({1:.1f} MB).'.format(name,nbytes/1.E6))
+
+def restore_version(msfile,name,tb,logger):
+    """
+    Restores a flag version from the flag store.
+
+    Input:
+    msfile = Path to the MS. (String)
+    name = Name of the flag version. (String)
+    tb = The tb tool of the calling script.
+    """
+    index = read_index(msfile)
+    layout = index['versions'][name]['layout']
+    if ms_layout(tb,msfile) != layout:
+        raise ValueError('The shape of {0} has changed since flag version {1} was saved.'.format(msfile,name))
+    logger.info('Restoring flag version {0} from {1}.'.format(name,store_dir(msfile)))
+    pool = ThreadPool(nthreads)
+    tb.open(msfile,nomodify=False)
+    try:
+        chunks = version_chunks(layout)
+        for batch in range(0,len(chunks),nthreads):
+            # Decode a batch of chunks in parallel, then write them (the table tool is only used by this thread)
+            def decode(job):
+                ddid,chunk,start,nrow,npol,nchan = job
+                packed,row = decode_chunk(msfile,index,name,ddid,chunk)
+                flags = numpy.unpackbits(packed)[:npol*nchan*nrow].reshape(npol,nchan,nrow).astype(bool)
+                return flags,numpy.unpackbits(row)[:nrow].astype(bool)
+            results = pool.map(decode,chunks[batch:batch+nthreads])
+            for job,result in zip(chunks[batch:batch+nthreads],results):
+                ddid,chunk,start,nrow,npol,nchan = job
+                sub = tb.query('DATA_DESC_ID=={}'.format(ddid))
+                sub.putcol('FLAG',result[0],startrow=start,nrow=nrow)
+                sub.putcol('FLAG_ROW',result[1],startrow=start,nrow=nrow)
+                sub.close()
+        tb.flush()
+    finally:
+        tb.close()
+        pool.close()
+        pool.join()
+    index['current'] = name
+    write_index(msfile,index)
+    logger.info('Completed restoring flag version {}.'.format(name))
+
+def remove_version(msfile,name,logger):
+    """
+    Deletes a flag version from the flag store. Versions saved as deltas against it are re-encoded against its parent.
+
+    Input:
+    msfile = Path to the MS. (String)
+    name = Name of the flag version. (String)
+    """
+    index = read_index(msfile)
+    if name not in index['versions']:
+        return
+    logger.info('Removing flag version {0} from {1}.'.format(name,store_dir(msfile)))
+    version = index['versions'][name]
+    for child in index['versions'].keys():
+        if index['versions'][child]['parent'] != name:
+            continue
+        for ddid,chunk,start,nrow,npol,nchan in version_chunks(version['layout']):
+            # The deltas are XORs so merging the child with the removed version gives the delta against its grandparent
+            data = numpy.load(chunk_file(msfile,child,ddid,chunk))
+            arrays = dict((key,data[key]) for key in data.files)
+            data.close()
+            if 'full' in arrays:
+                continue
+            packed = decode_chunk(msfile,index,child,ddid,chunk)[0]
+            parent_packed = None
+            if version['parent'] is not None:
+                parent_packed = decode_chunk(msfile,index,version['parent'],ddid,chunk)[0]
+            flags = numpy.unpackbits(packed)[:npol*nchan*nrow]
+            arrays = encode_chunk(flags,numpy.unpackbits(arrays['row'])[:nrow],parent_packed)[1]
+            numpy.savez(chunk_file(msfile,child,ddid,chunk),**arrays)
+        index['versions'][child]['parent'] = version['parent']
+    del index['versions'][name]
+    if index['current'] == name:
+        index['current'] = version['parent']
+    write_index(msfile,index)
+    shutil.rmtree(os.path.join(store_dir(msfile),name))
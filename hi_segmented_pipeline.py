@@ -12,11 +12,20 @@ import configparser
 from ast import literal_eval
 import glob
 import collections
+import hashlib
+import json
+import fcntl
+import socket
+import atexit
+import subprocess
 
 from ruffus import *
 import cgatcore.experiment as E
 from cgatcore import pipeline as P
 
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import artifact_cache as ac
+
 
 def input_validation():
     """
@@ -48,97 +57,673 @@ def backup_pipeline_params():
     shutil.copyfile(cgatcore_params['configfile'],backup_file)
 
         
-def check_pipeline_params():
+def remove_done_files(step):
     """
-    Checks if any pipeline parameters have been modified since the previous run.
+    Removes the '.done' file of a step, including any per-target '.done' files.
     """
-    configfile = cgatcore_params['configfile']
-    backup_file = 'backup.'+configfile
-    if os.access(backup_file, os.R_OK):
-        if not filecmp.cmp(backup_file,configfile):
-            print('Parameters in {} have been modified since the last execution.'.format(configfile))
-            bash_command = 'diff {0} {1} > diff_params.txt'.format(backup_file,configfile)
-            os.system(bash_command)
-            f = open('diff_params.txt','r')
-            diff = f.read()
-            f.close()
-            os.remove('diff_params.txt')
-            
-            import_data_kwds = ['project_name','data_path','jvla','mstransform','keep_','hanning', 'chanavg']
-            flag_calib_split_kwds = ['src_dir','shadow_tol','quack_int','timecutoff','freqcutoff','rthresh','refant','no_rflag','no_tfcrop',
-                                     'fluxcal','fluxmod','man_mod','bandcal','phasecal','targets','target_names','mosaic','man_comb_spws']
-            dirty_cont_image_kwds = ['rest_freq','img_dir']
-            contsub_dirty_image_kwds = ['linefree_ch','fitorder','save_cont','line_ch']
-            clean_image_kwds = ['automask','multiscale','beam_scales','sefd','corr_eff','robust','thresh','pix_size','im_size','noise','phasecenter']
-            moment_kwds = ['mom_thresh','mom_chans']
-            cleanup_kwds = ['cleanup_level']
-            
-            if any(keyword in diff for keyword in import_data_kwds):
-                for keyword in import_data_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('import_data'))
-                try:
-                    os.remove('import_data.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in flag_calib_split_kwds):
-                for keyword in flag_calib_split_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('flag_calib_split'))
-                try:
-                    os.remove('flag_calib_split.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in dirty_cont_image_kwds):
-                for keyword in dirty_cont_image_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('dirty_cont_image'))
-                try:
-                    os.remove('dirty_cont_image.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in contsub_dirty_image_kwds):
-                for keyword in contsub_dirty_image_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('contsub_dirty_image'))
-                try:
-                    os.remove('contsub_dirty_image.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in clean_image_kwds):
-                for keyword in clean_image_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('clean_image'))
-                try:
-                    os.remove('clean_image.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in moment_kwds):
-                for keyword in moment_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('moment_zero'))
-                try:
-                    os.remove('moment_zero.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in cleanup_kwds):
-                for keyword in cleanup_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('cleanup'))
+    done_files = glob.glob('{}.done'.format(step))
+    done_files.extend(glob.glob('{}.*.done'.format(step)))
+    for done_file in done_files:
+        try:
+            os.remove(done_file)
+        except FileNotFoundError:
+            pass
+
+
+def touch(outfile):
+    """
+    Creates an empty file or updates the modification time of an existing one.
+    """
+    open(outfile, 'a').close()
+    os.utime(outfile, None)
+
+
+def read_pipeline_params(configfile=None):
+    """
+    Reads the pipeline parameters file and evaluates its values (as read_config does in common_functions).
+    """
+    if configfile is None:
+        configfile = cgatcore_params['configfile']
+    config_raw = configparser.RawConfigParser()
+    config_raw.read(configfile)
+    config = collections.OrderedDict()
+    for section in config_raw.sections():
+        config[section] = collections.OrderedDict()
+        for key, value in config_raw.items(section):
+            try:
+                config[section][key] = literal_eval(value)
+            except (ValueError, SyntaxError):
+                config[section][key] = value
+    return config
+
+
+def dir_size(path):
+    """
+    Returns the total size (in bytes) of all the files within a directory.
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def imaging_targets():
+    """
+    Returns the names of the targets to be imaged, with the largest (split MS on disk) first.
+    In interactive mode the single pseudo-target 'all' is returned so that each imaging step runs as one job.
+    """
+    config = read_pipeline_params()
+    if config['global']['interactive']:
+        return ['all']
+    targets = []
+    for target in config['calibration']['target_names']:
+        if target not in targets:
+            targets.append(target)
+    src_dir = config['global']['src_dir']+'/'
+    sizes = {}
+    for target in targets:
+        sizes[target] = dir_size(src_dir+target+'.split')
+    return sorted(targets, key=lambda target: sizes[target], reverse=True)
+
+
+def uses_mpi(script):
+    """
+    Checks if a step is run with mpicasa, i.e. MPI servers are enabled, the MS is partitioned into a multi-MS
+    and the step's CASA tasks can process the partitions in parallel.
+    """
+    if mpi_workers == 0 or script not in mpi_stages:
+        return False
+    importdata = read_pipeline_params()['importdata']
+    return str(importdata.get('partition', 'none')).lower() in ['scan', 'spw']
+
+
+def casa_statement(script, outfile, target=None):
+    """
+    Constructs the command to execute a pipeline script in CASA, optionally for a single target.
+    """
+    args = cgatcore_params['configfile']
+    if target is not None and target != 'all':
+        args = 'target={0} {1}'.format(target, args)
+    casa = 'casa --nologger'
+    if uses_mpi(script):
+        # One MPI client plus the servers that process the partitions
+        casa = 'mpicasa -n {0} casa --nologger --nogui'.format(mpi_workers+1)
+    return '{0} -c {1}.py {2} && touch {3}'.format(casa, script, args, outfile)
+
+
+def worker_socket(i):
+    """
+    Returns the path of the socket used by the i-th CASA worker.
+    """
+    return os.path.abspath('casa_worker.{}.sock'.format(i))
+
+
+def start_casa_worker(i):
+    """
+    Launches a long-lived CASA process that executes the pipeline scripts it is sent (see casa_worker.py).
+    """
+    sock = worker_socket(i)
+    if os.path.exists(sock):
+        os.remove(sock)
+    worker_log = open('casa_worker.{}.out'.format(i), 'a')
+    worker_script = os.path.join(cgatcore_params['scripts'], 'casa_worker.py')
+    subprocess.Popen(['casa', '--nologger', '--nogui', '-c', worker_script, sock],
+                     stdout=worker_log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    worker_log.close()
+
+
+def start_casa_workers():
+    """
+    Starts the pool of warm CASA workers.
+    """
+    for i in range(casa_workers):
+        start_casa_worker(i)
+
+
+def stop_casa_workers():
+    """
+    Asks all of the CASA workers to shut down.
+    """
+    for i in range(casa_workers):
+        try:
+            send_casa_request(i, {'command': 'shutdown'}, startup_timeout=0)
+        except (OSError, ValueError):
+            pass
+
+
+def send_casa_request(i, request, startup_timeout=600):
+    """
+    Sends a request to the i-th CASA worker and waits for its reply.
+    A worker that is still starting up is given 'startup_timeout' seconds to create its socket.
+    """
+    sock = worker_socket(i)
+    start = time.time()
+    while not os.path.exists(sock):
+        if time.time()-start > startup_timeout:
+            raise OSError('CASA worker {} is not running.'.format(i))
+        time.sleep(1)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(sock)
+        stream = conn.makefile('rw')
+        stream.write(json.dumps(request)+'\n')
+        stream.flush()
+        reply = stream.readline()
+        stream.close()
+    finally:
+        conn.close()
+    if not reply:
+        raise OSError('CASA worker {} closed the connection before replying.'.format(i))
+    return json.loads(reply)
+
+
+def submit_casa_job(script, args):
+    """
+    Runs a pipeline script on the first free CASA worker and returns the worker's reply.
+    Workers are claimed with a lock file so that concurrent ruffus jobs never share a worker.
+    """
+    request = {'script': script+'.py', 'args': args}
+    while True:
+        for i in range(casa_workers):
+            lock = open(worker_socket(i)+'.lock', 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            try:
                 try:
-                    os.remove('cleanup.done')
-                except FileNotFoundError:
-                    pass
+                    return send_casa_request(i, request)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The worker has died, replace it and try again
+                    start_casa_worker(i)
+                    return send_casa_request(i, request)
+                except OSError:
+                    # The worker died while running the script (e.g. aborted by the casalog watchdog)
+                    start_casa_worker(i)
+                    return {'status': -1, 'casalog': 'casa_worker.{}.out'.format(i)}
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+        time.sleep(5)
+
+
+def run_casa_script(script, outfile, target=None):
+    """
+    Executes a pipeline script in CASA and creates its '.done' file if it succeeds.
+    Uses a warm CASA worker when enabled, except in interactive mode where the script needs a terminal
+    and for the steps that are run with mpicasa.
+    If the artifact cache is enabled and already holds the products of the step for the same inputs, these are restored instead.
+    """
+    cache_key = None
+    if use_artifact_cache(script, target):
+        before = read_pipeline_params()
+        cache_key = artifact_key(script, before, target)
+    restored = cache_key is not None and restore_artifacts(script, cache_key, target)
+    if restored:
+        touch(outfile)
+    elif casa_workers > 0 and not read_pipeline_params()['global']['interactive'] and not uses_mpi(script):
+        args = [cgatcore_params['configfile']]
+        if target is not None and target != 'all':
+            args.insert(0, 'target={}'.format(target))
+        reply = submit_casa_job(script, args)
+        if reply['status'] != 0:
+            raise RuntimeError('{0} failed with exit status {1} (see {2}).'.format(script, reply['status'], reply.get('casalog')))
+        touch(outfile)
     else:
-        print('No parameters backup file found.')
-        print('Skipping parameters change check.')
+        statement = casa_statement(script, outfile, target)
+        stdout, stderr = P.execute(statement)
+    if cache_key is not None and not restored:
+        store_artifacts(script, cache_key, before, target)
+    if script in stage_products:
+        write_artifact_key(script, cache_key, target)
+    if target is None:
+        stage_completed(script)
+    elif target != 'all':
+        stage_completed(script, target)
+
+
+# Products of the steps that are kept in the artifact cache (see artifact_cache.py), with whether later steps modify them in place.
+# The paths may contain wildcards, and '{project}', '{src_dir}', '{img_dir}' and '{target}' are replaced by their values.
+stage_products = collections.OrderedDict([
+    ('import_data', {'products': [('{project}.ms', True), ('{project}.ms.flagversions', True)]}),
+    ('flag_calib_split', {'products': [('{project}.ms', True), ('{project}.ms.flagversions', True), ('{project}.ms.flagstore', True),
+                                       ('cal_tabs', False), ('{src_dir}*.split', True), ('{src_dir}*.split.flagversions', True)]}),
+    ('dirty_cont_image', {'products': [('{img_dir}{target}.cont.dirty.*', False)]}),
+    ('contsub_dirty_image', {'products': [('{src_dir}{target}.split.cont*', True), ('{src_dir}{target}.spw*.split.cont*', True),
+                                          ('{img_dir}{target}.dirty.*', False)]}),
+    ('clean_image', {'products': [('{img_dir}{target}.*', False)],
+                     'exclude': ['{img_dir}{target}.cont.dirty.*', '{img_dir}{target}.dirty.*']}),
+])
+
+
+def use_artifact_cache(stage, target=None):
+    """
+    Checks if the products of a step are looked up in (and added to) the artifact cache.
+    Interactive runs never use the cache, as the parameters may be changed while the steps run.
+    """
+    if artifact_cache == '' or stage not in stage_products or target == 'all':
+        return False
+    return not read_pipeline_params()['global']['interactive']
+
+
+def artifact_file(stage, target=None):
+    """
+    Returns the name of the file where the artifact cache key of the products of a step (or of one target of a step) is stored.
+    """
+    if target is None:
+        return '{}.artifact'.format(stage)
+    return '{0}.{1}.artifact'.format(stage, target)
+
+
+def read_artifact_key(stage, target=None):
+    """
+    Reads the artifact cache key of the products of a completed step, or returns None if it is not known.
+    """
+    try:
+        with open(artifact_file(stage, target), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def write_artifact_key(stage, key, target=None):
+    """
+    Records the artifact cache key of the products of a step that has just completed (or removes it if there is none),
+    so that the steps after it can build on it.
+    """
+    filename = artifact_file(stage, target)
+    if key is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    tmp_file = '{0}.tmp{1}'.format(filename, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(key+'\n')
+    os.replace(tmp_file, filename)
+
+
+def code_hash():
+    """
+    Returns a hash of the pipeline scripts, so that the cached products are not reused after the code changes.
+    """
+    scripts = sorted(glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), '*.py')))
+    return hash_value([[os.path.basename(script), hash_file(script)] for script in scripts])
+
+
+def artifact_key(stage, config, target=None):
+    """
+    Computes the artifact cache key of the products of a step (or of one target of a step) from everything they depend on:
+    the parameters of the step (except the project name), the contents of its input directories and files, the pipeline code
+    and the key of the products of the step before it. Returns None if the key of the previous step's products is not known.
+    """
+    stages = list(stage_inputs)
+    inputs = collections.OrderedDict([('step', stage), ('target', target)])
+    index = stages.index(stage)
+    if index > 0:
+        previous = stages[index-1]
+        previous_target = None
+        if stage_inputs[previous].get('per_target', False):
+            previous_target = target
+        inputs['previous'] = read_artifact_key(previous, previous_target)
+        if inputs['previous'] is None:
+            return None
+    fingerprint = stage_fingerprint(stage, config, target)
+    fingerprint.pop('global.project_name', None)
+    # The archive files are identified by their contents rather than their location
+    for key in stage_inputs[stage].get('dirs', []):
+        section, option = key.split('.')
+        path = str(config.get(section, {}).get(option))
+        fingerprint.pop(key, None)
+        fingerprint.pop('contents of '+path, None)
+        fingerprint['contents of '+key] = ac.tree_checksum(path, artifact_cache)
+    inputs['params'] = fingerprint
+    inputs['code'] = code_hash()
+    return ac.hash_value(inputs)
+
+
+def product_paths(stage, config, target=None):
+    """
+    Returns the products of a step (or of one target of a step) that exist in the execution directory, with whether they are modified in place.
+    """
+    values = {'project': config['global']['project_name'], 'src_dir': str(config['global'].get('src_dir'))+'/',
+              'img_dir': str(config['global'].get('img_dir'))+'/', 'target': target}
+    excluded = []
+    for pattern in stage_products[stage].get('exclude', []):
+        excluded.extend(glob.glob(pattern.format(**values)))
+    products = []
+    for pattern, mutable in stage_products[stage]['products']:
+        for path in sorted(glob.glob(pattern.format(**values))):
+            if path not in excluded and path not in [product[0] for product in products]:
+                products.append((path, mutable))
+    return products
+
+
+def written_params(before, after, target=None):
+    """
+    Returns the parameters that a step wrote to the parameters file (for per-target parameters, only the entry of the target).
+    """
+    written = collections.OrderedDict()
+    for section in after:
+        for option in after[section]:
+            key = '{0}.{1}'.format(section, option)
+            if target is not None and key in per_target_keys:
+                value = target_value(after, key, target)
+                if value != target_value(before, key, target):
+                    written[key] = {'target': value}
+            elif before.get(section, {}).get(option) != after[section][option]:
+                written[key] = {'value': after[section][option]}
+    return written
+
+
+def write_params(written, target=None):
+    """
+    Writes the parameters recorded with cached products to the parameters file, as the step that made them did.
+    """
+    if len(written) == 0:
+        return
+    configfile = cgatcore_params['configfile']
+    config = read_pipeline_params()
+    config_raw = configparser.RawConfigParser()
+    config_raw.read(configfile)
+    target_names = config.get('calibration', {}).get('target_names', [])
+    for key, value in written.items():
+        section, option = key.split('.')
+        if 'target' in value:
+            new_value = value['target']
+            current = config.get(section, {}).get(option)
+            if isinstance(current, list) and target in target_names and len(current) == len(target_names):
+                current[target_names.index(target)] = value['target']
+                new_value = current
+        else:
+            new_value = value['value']
+        if not config_raw.has_section(section):
+            config_raw.add_section(section)
+        config_raw.set(section, option, str(new_value))
+    with open(configfile, 'w') as f:
+        config_raw.write(f)
+
+
+def restore_artifacts(stage, key, target=None):
+    """
+    Restores the products of a step (or of one target of a step) from the artifact cache, replacing any existing ones.
+    Returns False if they are not in the cache.
+    """
+    entry = ac.lookup(artifact_cache, key)
+    if entry is None:
+        return False
+    config = read_pipeline_params()
+    for path, mutable in product_paths(stage, config, target):
+        ac.remove_product(path)
+    methods = ac.restore(entry, config['global']['project_name'])
+    write_params(entry.get('params', {}), target)
+    name = stage if target is None else '{0} ({1})'.format(stage, target)
+    print('Restored the products of {0} from the artifact cache: {1} files.'.format(name, ', '.join('{0} {1}'.format(methods[method], method)
+                                                                                              for method in sorted(methods))))
+    return True
+
+
+def store_artifacts(stage, key, before, target=None):
+    """
+    Adds the products of a step (or of one target of a step) that has just run to the artifact cache,
+    then removes the least recently used entries if the cache is larger than its limit.
+    The entry is also found with the parameters as the step left them (e.g. with 'refant' or 'pix_size' filled in).
+    """
+    config = read_pipeline_params()
+    if stage == 'import_data' and config['importdata']['jvla']:
+        # The MS is only a link to the archive MS
+        return
+    products = product_paths(stage, config, target)
+    if len(products) == 0:
+        return
+    for path, mutable in products:
+        if os.path.isabs(path) or path.startswith('..'):
+            print('Products of {0} outside the execution directory ({1}), not added to the artifact cache.'.format(stage, path))
+            return
+    info = {'step': stage, 'target': target, 'params': written_params(before, config, target)}
+    size = ac.save(artifact_cache, key, products, config['global']['project_name'], info, [artifact_key(stage, config, target)])
+    evicted = ac.evict(artifact_cache, artifact_cache_size, keep=[key])
+    print('Added the products of {0} to the artifact cache ({1:.2f} GB), {2} old entries removed.'.format(stage, size/1024.**3, len(evicted)))
+
+
+# Parameters (section.key), directories (given by a parameter) and files that each step reads.
+# A step is re-run if any of these have changed since it last completed; the steps after it
+# are then re-run by ruffus because their input '.done' file is newer.
+stage_inputs = collections.OrderedDict([
+    ('import_data', {'keys': ['global.project_name', 'importdata.data_path', 'importdata.jvla', 'importdata.mstransform',
+                              'importdata.keep_obs', 'importdata.keep_spws', 'importdata.keep_fields', 'importdata.hanning',
+                              'importdata.chanavg', 'importdata.combine', 'importdata.partition', 'importdata.nsubms'],
+                     'dirs': ['importdata.data_path']}),
+    ('flag_calib_split', {'keys': ['global.src_dir', 'flagging.shadow_tol', 'flagging.quack_int', 'flagging.timecutoff',
+                                   'flagging.freqcutoff', 'flagging.rthresh', 'flagging.no_rflag', 'flagging.no_tfcrop',
+                                   'flagging.engine', 'flagging.st_thresh', 'flagging.flag_store',
+                                   'calibration.refant', 'calibration.fluxcal', 'calibration.fluxmod', 'calibration.man_mod',
+                                   'calibration.bandcal', 'calibration.phasecal', 'calibration.targets',
+                                   'calibration.target_names', 'calibration.mosaic', 'calibration.man_comb_spws',
+                                   'calibration.solve_groups'],
+                          'files': ['manual_flags.list']}),
+    ('dirty_cont_image', {'keys': ['global.rest_freq', 'global.img_dir', 'clean.robust', 'clean.pix_size', 'clean.im_size',
+                                   'clean.phasecenter'],
+                          'per_target': True}),
+    ('contsub_dirty_image', {'keys': ['continuum_subtraction.linefree_ch', 'continuum_subtraction.fitorder',
+                                      'continuum_subtraction.save_cont', 'clean.line_ch', 'clean.robust', 'clean.pix_size',
+                                      'clean.im_size', 'clean.phasecenter'],
+                             'per_target': True}),
+    ('clean_image', {'keys': ['clean.line_ch', 'clean.robust', 'clean.pix_size', 'clean.im_size', 'clean.phasecenter',
+                              'clean.automask', 'clean.automask_sl', 'clean.automask_ns', 'clean.automask_mbf',
+                              'clean.automask_lns', 'clean.automask_neg', 'clean.multiscale', 'clean.beam_scales',
+                              'clean.sefd', 'clean.corr_eff', 'clean.noise_method', 'clean.thresh', 'clean.noise',
+                              'clean.mask_engine', 'clean.mask_kernels_xy', 'clean.mask_kernels_z', 'clean.mask_thresh'],
+                     'per_target': True}),
+    ('moment_zero', {'keys': ['global.mom_dir', 'moment.mom_thresh', 'moment.mom_chans', 'clean.noise', 'clean.sefd',
+                              'clean.corr_eff', 'clean.noise_method', 'moment.engine', 'clean.mask_engine',
+                              'clean.mask_kernels_xy', 'clean.mask_kernels_z', 'clean.mask_thresh'],
+                     'per_target': True}),
+    ('cleanup', {'keys': ['global.cleanup_level']}),
+])
+
+# Parameters that are lists with one entry per target (in the order of 'target_names').
+# For steps that run per target, a change to one entry only re-runs that step for the corresponding target.
+per_target_keys = ['continuum_subtraction.linefree_ch', 'continuum_subtraction.fitorder', 'clean.line_ch', 'clean.pix_size',
+                   'clean.im_size', 'clean.noise', 'moment.mom_chans']
+
+
+def hash_value(value):
+    """
+    Returns a hash of a (parameter) value that does not depend on its formatting in the parameters file.
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def hash_file(path):
+    """
+    Returns a hash of the contents of a file, or None if it does not exist.
+    """
+    if not os.path.isfile(path):
+        return None
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def hash_dir_listing(path):
+    """
+    Returns a hash of the names, sizes and modification times of the entries in a directory (the contents are not read).
+    """
+    listing = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            try:
+                entry_stat = os.stat(os.path.join(path, name))
+                listing.append([name, entry_stat.st_size, int(entry_stat.st_mtime)])
+            except OSError:
+                listing.append([name, None, None])
+    return hash_value(listing)
+
+
+def target_value(config, key, target):
+    """
+    Returns the entry of a per-target parameter that applies to one target.
+    The whole value is returned if it is not a list with one entry per target (e.g. a single fit order for all targets, or a mosaic).
+    """
+    section, option = key.split('.')
+    value = config.get(section, {}).get(option)
+    target_names = config.get('calibration', {}).get('target_names', [])
+    if (isinstance(value, list) and not config.get('calibration', {}).get('mosaic', False)
+            and target in target_names and len(value) == len(target_names)):
+        return value[target_names.index(target)]
+    return value
+
+
+def stage_fingerprint(stage, config, target=None):
+    """
+    Computes a hash of each of the inputs of a step (see stage_inputs), optionally for a single target.
+    """
+    fingerprint = collections.OrderedDict()
+    for key in stage_inputs[stage].get('keys', []):
+        if target is not None and key in per_target_keys:
+            fingerprint[key] = hash_value(target_value(config, key, target))
+        else:
+            section, option = key.split('.')
+            fingerprint[key] = hash_value(config.get(section, {}).get(option))
+    for key in stage_inputs[stage].get('dirs', []):
+        section, option = key.split('.')
+        path = str(config.get(section, {}).get(option))
+        fingerprint['contents of '+path] = hash_dir_listing(path)
+    for path in stage_inputs[stage].get('files', []):
+        fingerprint[path] = hash_file(path)
+    return fingerprint
+
+
+def fingerprint_file(stage, target=None):
+    """
+    Returns the name of the file where the fingerprint of a step (or of one target of a step) is stored.
+    """
+    if target is None:
+        return '{}.fingerprint'.format(stage)
+    return '{0}.{1}.fingerprint'.format(stage, target)
+
+
+def write_fingerprint(stage, config, target=None):
+    """
+    Records the inputs used by a completed step (or one target of a step) in its fingerprint file.
+    """
+    # Per-target jobs may finish at the same time, so the file is replaced in one go
+    filename = fingerprint_file(stage, target)
+    tmp_file = '{0}.tmp{1}'.format(filename, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(stage_fingerprint(stage, config, target), f, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def read_fingerprint(stage, target=None):
+    """
+    Reads the fingerprint recorded when a step (or one target of a step) last completed, or returns None if there is none.
+    """
+    try:
+        with open(fingerprint_file(stage, target), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def done_targets(stage):
+    """
+    Returns the targets for which a per-target step has completed (from the '<step>.<target>.done' files).
+    """
+    prefix = '{}.'.format(stage)
+    targets = []
+    for done_file in glob.glob('{}.*.done'.format(stage)):
+        target = done_file[len(prefix):-len('.done')]
+        if target != 'all':
+            targets.append(target)
+    return sorted(targets)
+
+
+def stage_completed(stage, target=None):
+    """
+    Records the fingerprint of a step (or one target of a step) that has just completed.
+    The fingerprints of the completed steps before it are also updated, as the pipeline scripts
+    may write new values for their parameters to the parameters file (e.g. 'pix_size' or 'refant').
+    """
+    config = read_pipeline_params()
+    for previous in stage_inputs:
+        if previous == stage:
+            break
+        if os.path.exists('{}.done'.format(previous)):
+            write_fingerprint(previous, config)
+        if target is not None and os.path.exists('{0}.{1}.done'.format(previous, target)):
+            write_fingerprint(previous, config, target)
+    write_fingerprint(stage, config, target)
+
+
+def changed_inputs(previous, current, skip=[]):
+    """
+    Returns the inputs whose hashes differ between two fingerprints.
+    """
+    return [key for key in current if key not in skip and previous.get(key) != current[key]]
+
+
+def check_pipeline_params():
+    """
+    Checks if the inputs of any completed steps have been modified since the previous run and marks those steps as incomplete.
+    For steps that run per target, only the targets affected by the changes are marked as incomplete.
+    """
+    config = read_pipeline_params()
+    backup_config = None
+    backup_file = 'backup.'+cgatcore_params['configfile']
+    if os.access(backup_file, os.R_OK):
+        backup_config = read_pipeline_params(backup_file)
+    for stage in stage_inputs:
+        targets = []
+        if stage_inputs[stage].get('per_target', False):
+            targets = done_targets(stage)
+        if os.path.exists('{}.done'.format(stage)):
+            previous = read_fingerprint(stage)
+            recorded = previous is not None
+            if not recorded:
+                if backup_config is None:
+                    print('No fingerprint or parameters backup file found for {}.'.format(stage))
+                    print('Skipping parameters change check for this step.')
+                    write_fingerprint(stage, config)
+                    continue
+                # Runs from before fingerprints were recorded are compared against the backed up parameters
+                previous = stage_fingerprint(stage, backup_config)
+            current = stage_fingerprint(stage, config)
+            # When the step has run per target, changes to per-target parameters are checked for each target below
+            skip = []
+            if len(targets) > 0:
+                skip = per_target_keys
+            changed = changed_inputs(previous, current, skip)
+            if len(changed) > 0:
+                for key in changed:
+                    print('{0} has changed since the previous run of {1}.'.format(key, stage))
+                print('Steps from {} onwards will be marked as incomplete.'.format(stage))
+                remove_done_files(stage)
+                continue
+            elif not recorded:
+                write_fingerprint(stage, config)
+        for target in targets:
+            previous = read_fingerprint(stage, target)
+            if previous is None:
+                if backup_config is None:
+                    write_fingerprint(stage, config, target)
+                    continue
+                previous = stage_fingerprint(stage, backup_config, target)
+            changed = changed_inputs(previous, stage_fingerprint(stage, config, target))
+            if len(changed) > 0:
+                for key in changed:
+                    print('{0} has changed for {1} since the previous run of {2}.'.format(key, target, stage))
+                print('Steps from {0} onwards will be marked as incomplete for {1}.'.format(stage, target))
+                for done_file in ['{0}.{1}.done'.format(stage, target), '{}.done'.format(stage)]:
+                    if os.path.exists(done_file):
+                        os.remove(done_file)
         
 
 # Read cgat-core configuration
@@ -154,6 +739,23 @@ backup_pipeline_params()
 # Add CASA to the PATH
 os.environ["PATH"] += os.pathsep + cgatcore_params['casa']
 
+# Maximum number of per-target imaging jobs that may run at once
+imaging_workers = int(cgatcore_params.get('imaging_workers', 1))
+
+# Number of warm CASA workers (0 starts a new CASA session for every step)
+casa_workers = int(cgatcore_params.get('casa_workers', 0))
+
+# Number of MPI servers for the steps that process the partitions of a multi-MS in parallel
+# (only used if the MS is partitioned, 0 runs these steps without mpicasa)
+mpi_workers = int(cgatcore_params.get('mpi_workers', 0))
+mpi_stages = ['flag_calib_split', 'dirty_cont_image', 'contsub_dirty_image', 'clean_image']
+
+# Directory of the artifact cache, shared between runs and projects ('' disables it), and its maximum size (given in GB)
+artifact_cache = str(cgatcore_params.get('artifact_cache') or '')
+artifact_cache_size = int(float(cgatcore_params.get('artifact_cache_size', 100))*1024**3)
+if artifact_cache != '':
+    ac.init_store(artifact_cache)
+
 # deactivate cgat-core logging to stdout
 # cgat-core logs were sent to both stdout and pipeline.log
 # to-do: we want to have it enable only for pipeline.log
@@ -172,7 +774,7 @@ def dependency_check(outfile):
         if shutil.which(cmd) is None:
             raise EnvironmentError("Required dependency \"{}\" not found".format(cmd))
     
-    scripts = ['import_data','flag_calib_split','dirty_cont_image','contsub_dirty_image','clean_image','cleanup','common_functions','moment_zero']
+    scripts = ['import_data','flag_calib_split','dirty_cont_image','contsub_dirty_image','clean_image','cleanup','common_functions','moment_zero','ms_metadata','cube_io','noise','moments','masking','flag_stats','flag_versions','plot_queue','plot_worker','vis_cache','vis_plots','applycal_plan','task_graph','sum_threshold']
     for script in scripts:
         if not os.access(script+'.py', os.R_OK):
             os.symlink(cgatcore_params['scripts']+script+'.py',script+'.py')
@@ -186,44 +788,79 @@ def dependency_check(outfile):
 
 @transform(dependency_check, suffix('dependency_check.done'), 'import_data.done'.format(cgatcore_params['project']))
 def import_data(infile,outfile):
-    statement = 'casa --nologger -c import_data.py {} && touch import_data.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_casa_script('import_data', outfile)
     
 @transform(import_data, suffix('import_data.done'.format(cgatcore_params['project'])), 'flag_calib_split.done'.format(cgatcore_params['project']))
 def flag_calib_split(infile,outfile):
-    statement = 'casa --nologger -c flag_calib_split.py {} && touch flag_calib_split.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
-    
-@transform(flag_calib_split, suffix('flag_calib_split.done'.format(cgatcore_params['project'])), 'dirty_cont_image.done'.format(cgatcore_params['project']))
-def dirty_cont_image(infile,outfile):
-    statement = 'casa --nologger -c dirty_cont_image.py {} && touch dirty_cont_image.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
-    
-@transform(dirty_cont_image, suffix('dirty_cont_image.done'.format(cgatcore_params['project'])), 'contsub_dirty_image.done'.format(cgatcore_params['project']))
-def contsub_dirty_image(infile,outfile):
-    statement = 'casa --nologger -c contsub_dirty_image.py {} && touch contsub_dirty_image.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
-    
-@transform(contsub_dirty_image, suffix('contsub_dirty_image.done'.format(cgatcore_params['project'])), 'clean_image.done'.format(cgatcore_params['project']))
-def clean_image(infile,outfile):
-    statement = 'casa --nologger -c clean_image.py {} && touch clean_image.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
-
-@transform(clean_image, suffix('clean_image.done'.format(cgatcore_params['project'])), 'moment_zero.done'.format(cgatcore_params['project']))
-def moment_zero(infile,outfile):
-    statement = 'casa --nologger -c moment_zero.py {} && touch moment_zero.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_casa_script('flag_calib_split', outfile)
     
+def dirty_cont_image_jobs():
+    """
+    Generates one dirty_cont_image job per target (evaluated when the step is about to run).
+    """
+    for target in imaging_targets():
+        yield ['flag_calib_split.done', 'dirty_cont_image.{}.done'.format(target), target]
+
+# The imaging steps run as separate jobs for each target, sharing a limit on the number of concurrent jobs
+@follows(flag_calib_split)
+@jobs_limit(imaging_workers, 'imaging')
+@files(dirty_cont_image_jobs)
+def dirty_cont_image_target(infile,outfile,target):
+    run_casa_script('dirty_cont_image', outfile, target)
+
+@merge(dirty_cont_image_target, 'dirty_cont_image.done')
+def dirty_cont_image(infiles,outfile):
+    touch(outfile)
+    stage_completed('dirty_cont_image')
+
+@jobs_limit(imaging_workers, 'imaging')
+@transform(dirty_cont_image_target, regex(r'dirty_cont_image\.(.+)\.done'), r'contsub_dirty_image.\1.done', r'\1')
+def contsub_dirty_image_target(infile,outfile,target):
+    run_casa_script('contsub_dirty_image', outfile, target)
+
+@merge(contsub_dirty_image_target, 'contsub_dirty_image.done')
+def contsub_dirty_image(infiles,outfile):
+    touch(outfile)
+    stage_completed('contsub_dirty_image')
+
+@jobs_limit(imaging_workers, 'imaging')
+@transform(contsub_dirty_image_target, regex(r'contsub_dirty_image\.(.+)\.done'), r'clean_image.\1.done', r'\1')
+def clean_image_target(infile,outfile,target):
+    run_casa_script('clean_image', outfile, target)
+
+@merge(clean_image_target, 'clean_image.done')
+def clean_image(infiles,outfile):
+    touch(outfile)
+    stage_completed('clean_image')
+
+@jobs_limit(imaging_workers, 'imaging')
+@transform(clean_image_target, regex(r'clean_image\.(.+)\.done'), r'moment_zero.\1.done', r'\1')
+def moment_zero_target(infile,outfile,target):
+    run_casa_script('moment_zero', outfile, target)
+
+@merge(moment_zero_target, 'moment_zero.done')
+def moment_zero(infiles,outfile):
+    touch(outfile)
+    stage_completed('moment_zero')
+
 @transform(moment_zero, suffix('moment_zero.done'.format(cgatcore_params['project'])), 'cleanup.done'.format(cgatcore_params['project']))
 def cleanup(infile,outfile):
-    statement = 'casa --nologger -c cleanup.py {} && touch cleanup.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_casa_script('cleanup', outfile)
     
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
-    P.main(argv)
+    if argv[1:3] == ['cache', 'stats']:
+        if artifact_cache == '':
+            print('The artifact cache is not enabled (set artifact_cache in hi_segmented_pipeline.yml).')
+        else:
+            print('\n'.join(ac.stats(artifact_cache, artifact_cache_size)))
+        return 0
+    if casa_workers > 0 and 'make' in argv:
+        start_casa_workers()
+        atexit.register(stop_casa_workers)
+    return P.main(argv)
 
 if __name__ == "__main__":
-    sys.exit(P.main(sys.argv))
+    sys.exit(main(sys.argv))
@@ -1,6 +1,10 @@
-import imp, os, glob, collections
+import imp, os, sys, glob, json, collections
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
+imp.load_source('ms_metadata','ms_metadata.py')
+import ms_metadata as mm
+imp.load_source('plot_queue','plot_queue.py')
+import plot_queue as pq
 
 
 def import_data(data_files, msfile, config, config_raw, logger):
@@ -17,11 +21,76 @@ def import_data(data_files, msfile, config, config_raw, logger):
     cf.rmdir(msfile,logger)
     logger.info('Input files: {}'.format(data_files))
     logger.info('Output msfile: {}'.format(msfile))
-    command = "importvla(archivefiles = {0}, vis = '{1}')".format(data_files, msfile)
+    nproc = 1
+    if config_raw.has_option('importdata','nproc'):
+        nproc = config['importdata']['nproc']
+    if nproc > 1 and len(data_files) > 1:
+        import_parts(data_files, msfile, nproc, config, config_raw, logger)
+    else:
+        command = "importvla(archivefiles = {0}, vis = '{1}')".format(data_files, msfile)
+        logger.info('Executing command: '+command)
+        exec(command)
+        cf.check_casalog(config,config_raw,logger,casalog)
+    logger.info('Completed import vla data')
+
+def import_parts(data_files, msfile, nproc, config, config_raw, logger):
+    """
+    Imports each VLA archive file into its own MS, as jobs run by parallel CASA processes (see plot_queue.py), and combines them into a single MS.
+    The parts are kept in "<MS>.parts" and a part is only imported again if its archive file has changed (the state of the
+    archive file each part was imported from is recorded in "<MS>.parts/parts.json").
+    With the 'virtual' combine mode the parts are moved into a multi-MS instead of being copied.
+    
+    Input:
+    data_files = Paths to the VLA archive files. (List/Array of Strings)
+    msfile = Path where the MS will be created. (String)
+    nproc = Maximum number of files imported at once. (Integer)
+    """
+    part_dir = msfile+'.parts/'
+    cf.makedir(part_dir,logger)
+    keys_file = part_dir+'parts.json'
+    keys = {}
+    if os.path.exists(keys_file):
+        keys_in = open(keys_file,'r')
+        keys = mm.to_str(json.load(keys_in))
+        keys_in.close()
+    pq.start_plot_queue(min(nproc,len(data_files)),logger)
+    parts = []
+    jobs = {}
+    for data_file in data_files:
+        part = part_dir+os.path.basename(data_file.rstrip('/'))+'.ms'
+        parts.append(part)
+        key = pq.input_key(data_file)
+        if keys.get(part) == key and os.path.isdir(part):
+            logger.info('{0} was already imported to {1}, skipping.'.format(data_file,part))
+            continue
+        cf.rmdir(part,logger)
+        keys.pop(part,None)
+        logger.info('Queued import of {0} to {1}.'.format(data_file,part))
+        jobs[pq.submit_job('importvla',{'archivefiles': [data_file], 'vis': part},part,logger,prefix='import')] = (part,key)
+    failed = pq.wait_for_jobs(list(jobs.keys()),logger)
+    pq.stop_workers(logger)
+    for job,(part,key) in jobs.items():
+        if job not in failed:
+            keys[part] = key
+    keys_out = open(keys_file,'w')
+    json.dump(keys,keys_out,indent=1)
+    keys_out.close()
+    missing = [part for part in parts if not os.path.isdir(part)]
+    if len(failed) > 0 or len(missing) > 0:
+        logger.critical('Not all of the archive files could be imported.')
+        sys.exit(-1)
+    combine = 'concat'
+    if config_raw.has_option('importdata','combine'):
+        combine = config['importdata']['combine']
+    if combine == 'virtual':
+        command = "virtualconcat(vis = {0}, concatvis = '{1}', keepcopy = False)".format(parts, msfile)
+    else:
+        command = "concat(vis = {0}, concatvis = '{1}')".format(parts, msfile)
     logger.info('Executing command: '+command)
     exec(command)
     cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed import vla data')
+    if combine == 'virtual':
+        cf.rmdir(part_dir,logger)
     
 def obs_dates(msfile, config, logger):
     """
@@ -32,12 +101,10 @@ def obs_dates(msfile, config, logger):
     """
     logger.info('Starting archive file summary.')
     logger.info('To find the exact files imported here search the VLA archive (https://archive.nrao.edu/archive/advquery.jsp) for:')
-    tb.open(msfile+'/OBSERVATION')
-    times = tb.getcol('TIME_RANGE')
-    tb.close()
-    for i in range(len(times[0])):
-        start_time = qa.time({'value':times[0][i],'unit':'s'},form='fits')[0]
-        end_time = qa.time({'value':times[1][i],'unit':'s'},form='fits')[0]
+    times = mm.get_metadata(msfile,msmd,tb,logger)['obs_time_ranges']
+    for i in range(len(times)):
+        start_time = qa.time({'value':times[i][0],'unit':'s'},form='fits')[0]
+        end_time = qa.time({'value':times[i][1],'unit':'s'},form='fits')[0]
         start_time = start_time.replace('T',' ')
         end_time = end_time.replace('T',' ')
         logger.info('Project: {0}\tStart Time: {1}\tEnd Time: {2}'.format(config['global']['project_name'],start_time,end_time))
@@ -60,12 +127,12 @@ def listobs_sum(msfile, config, config_raw, logger):
     cf.check_casalog(config,config_raw,logger,casalog)
     logger.info('Completed listobs summary.')
 
-def get_obsfreq(msfile):
+def get_obsfreq(meta):
     """ 
     Returns freq of first and last channels, channel resolution and number of channels (first spw) in GHz.
     
     Input:
-    msfile = Path to the MS. (String)
+    meta = The metadata snapshot of the MS. (Dictionary)
     
     Output:
     freq_ini = Start frequency. (Float)
@@ -73,46 +140,40 @@ def get_obsfreq(msfile):
     chan_res = Channel width. (Float)
     nchan = Number of channels. (Integer)
     """
-    msmd.open(msfile)
-    nspw = msmd.nspw()
-    freq_ini = msmd.chanfreqs(0)[0]/1e9
-    freq_end = msmd.chanfreqs(nspw-1)[-1]/1e9
-    chan_res = msmd.chanwidths(0)[0]/1e9
-    nchan = len(msmd.chanwidths(0))
-    msmd.done()
+    nspw = meta['nspw']
+    freq_ini = meta['chan_freqs'][0][0]/1e9
+    freq_end = meta['chan_freqs'][nspw-1][-1]/1e9
+    chan_res = meta['chan_widths'][0][0]/1e9
+    nchan = len(meta['chan_widths'][0])
     return freq_ini, freq_end, chan_res, nchan
 
-def find_mssources(msfile,logger):
+def find_mssources(msfile,meta,logger):
     """
     Extract source names from msfile metadata.
     Output format is a comma-separated string.
     
     Input:
     msfile = Path to the MS. (String)
+    meta = The metadata snapshot of the MS. (Dictionary)
     
     Output:
     mssources = All the fields observed in the MS separated by ','. (String)
     """
-    msmd.open(msfile)
-    mssources = ','.join(np.sort(msmd.fieldnames()))
-    msmd.done()
+    mssources = ','.join(sorted(meta['fields']))
     logger.info('Sources in MS {0}: {1}'.format(msfile, mssources))
     return mssources
 
-def get_project(msfile):
+def get_project(meta):
     """
     Extract project code from msfile metadata.
     
     Input:
-    msfile = Path to the MS. (String)
+    meta = The metadata snapshot of the MS. (Dictionary)
     
     Output:
     Project identifier. (String)
     """
-    tb.open(msfile+'/OBSERVATION')
-    project = tb.getcol('PROJECT')
-    tb.close()
-    return project[0]
+    return meta['project'][0]
 
 def get_msinfo(msfile,logger):
     """
@@ -125,16 +186,17 @@ def get_msinfo(msfile,logger):
     msinfo = Summary of the the observations. (Ordered dictionary)
     """
     logger.info('Reading ms file information for MS: {0}'.format(msfile))
+    meta = mm.get_metadata(msfile,msmd,tb,logger)
     msinfo = collections.OrderedDict()
     msinfo['msfile'] = msfile
-    msinfo['project'] = get_project(msfile)
-    msinfo['mssources'] = find_mssources(msfile,logger)
-    freq_ini, freq_end, chan_res, nchan = get_obsfreq(msfile)
+    msinfo['project'] = get_project(meta)
+    msinfo['mssources'] = find_mssources(msfile,meta,logger)
+    freq_ini, freq_end, chan_res, nchan = get_obsfreq(meta)
     msinfo['freq_ini'] = freq_ini
     msinfo['freq_end'] = freq_end
     msinfo['chan_res'] = chan_res
     msinfo['nchan'] = nchan
-    msinfo['num_spw'] = len(vishead(msfile, mode = 'list', listitems = ['spw_name'])['spw_name'][0])
+    msinfo['num_spw'] = len(meta['spw_names'])
 
     # Print summary
     logger.info('> Sources ({0}): {1}'.format(len(msinfo['mssources'].split(',')),
@@ -242,6 +304,8 @@ def transform_data(msfile,config,config_raw,config_file,logger):
         configfile.close()
         cf.rmdir(msfile+'.flagversions',logger)
         cf.makedir(msfile+'.flagversions',logger)
+        cf.rmdir(msfile+'.flagstore',logger)
+        cf.rmdir(msfile+'.viscache',logger)
         cf.rmdir(msfile,logger)
         cf.mvdir(msfile+'_1',msfile,logger)
         logger.info('Completed data transformation.')
@@ -267,10 +331,42 @@ def hanning_smooth(msfile,config,config_raw,config_file,logger):
     cf.check_casalog(config,config_raw,logger,casalog)
     cf.rmdir(msfile+'.flagversions',logger)
     cf.makedir(msfile+'.flagversions',logger)
+    cf.rmdir(msfile+'.flagstore',logger)
+    cf.rmdir(msfile+'.viscache',logger)
     cf.rmdir(msfile,logger)
     cf.mvdir(msfile+'_1',msfile,logger)
     logger.info('Completed Hanning smoothing.')
 
+def partition_ms(msfile,config,config_raw,logger):
+    """
+    Partitions the MS into a multi-MS (MMS) by scan or SPW, so that the CASA tasks of the later steps can process the partitions in parallel when run with mpicasa.
+    The MMS replaces the original MS.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    axis = cf.partition_axis(config,config_raw)
+    if axis == 'none':
+        logger.info('MS will not be partitioned.')
+        return
+    nsubms = 'auto'
+    if config_raw.has_option('importdata','nsubms'):
+        nsubms = config['importdata']['nsubms']
+    logger.info('Partitioning the MS by {}.'.format(axis))
+    command = "partition(vis='{0}', outputvis='{0}_1', separationaxis='{1}', numsubms={2!r}, flagbackup=False)".format(msfile,axis,nsubms)
+    logger.info('Executing command: '+command)
+    exec(command)
+    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.rmdir(msfile+'.flagversions',logger)
+    cf.makedir(msfile+'.flagversions',logger)
+    cf.rmdir(msfile+'.flagstore',logger)
+    cf.rmdir(msfile+'.viscache',logger)
+    cf.rmdir(msfile,logger)
+    cf.mvdir(msfile+'_1',msfile,logger)
+    logger.info('Completed partitioning.')
+
 # Read configuration file with parameters
 config_file = sys.argv[-1]
 config,config_raw = cf.read_config(config_file)
@@ -286,10 +382,13 @@ msfile = '{0}.ms'.format(config['global']['project_name'])
 
 # Import data, write listobs to file, and plot positions and elevation
 cf.check_casaversion(logger)
+cf.start_casalog_watchdog(config,config_raw,logger,casalog)
 cf.rmdir('summary',logger)
 cf.rmdir('plots',logger)
 cf.rmdir(msfile,logger)
 cf.rmdir(msfile+'.flagversions',logger)
+cf.rmdir(msfile+'.flagstore',logger)
+cf.rmdir(msfile+'.viscache',logger)
 data_path = config['importdata']['data_path']
 if not config['importdata']['jvla']:
     data_files = glob.glob(os.path.join(data_path, '*'))
@@ -303,6 +402,7 @@ transform_data(msfile,config,config_raw,config_file,logger)
 if config_raw.has_option('importdata','hanning') and not config['importdata']['mstransform']:
     if config['importdata']['hanning']:
         hanning_smooth(msfile,config,config_raw,config_file,logger)
+partition_ms(msfile,config,config_raw,logger)
 msinfo = get_msinfo(msfile,logger)
 plot_elevation(msfile,config,logger)
 plot_ants(msfile,logger)
@@ -0,0 +1,116 @@
+import numpy
+import imp
+imp.load_source('cube_io','cube_io.py')
+import cube_io
+imp.load_source('noise','noise.py')
+import noise
+
+
+def smooth_xy(data,fwhm):
+    """
+    Smooths each channel of a cube with a circular Gaussian by FFT convolution (zero padded to avoid wrapping at the edges).
+
+    Input:
+    data = Cube with the shape (channels, y, x). (Array)
+    fwhm = FWHM of the Gaussian in pixels, 0 for no smoothing. (Float)
+
+    Output:
+    The smoothed cube. (Array)
+    """
+    if fwhm <= 0:
+        return data
+    sigma = fwhm/(2.*numpy.sqrt(2.*numpy.log(2.)))
+    pad = int(numpy.ceil(4.*sigma))
+    ny,nx = data.shape[1:]
+    shape = (ny+pad,nx+pad)
+    u = numpy.fft.fftfreq(shape[0])[:,None]
+    v = numpy.fft.rfftfreq(shape[1])[None,:]
+    transfer = numpy.exp(-2.*numpy.pi**2*sigma**2*(u**2+v**2))
+    return numpy.fft.irfft2(numpy.fft.rfft2(data,s=shape)*transfer,s=shape)[:,:ny,:nx]
+
+def smooth_z(data,width):
+    """
+    Smooths the spectrum of each pixel of a cube with a boxcar by FFT convolution (zero padded at the ends of the band).
+
+    Input:
+    data = Cube with the shape (channels, y, x). (Array)
+    width = Width of the boxcar in channels (rounded up to an odd number), 0 or 1 for no smoothing. (Integer)
+
+    Output:
+    The smoothed cube. (Array)
+    """
+    if width <= 1:
+        return data
+    width = int(width) | 1
+    n = data.shape[0]+width
+    transfer = numpy.fft.rfft(numpy.ones(width)/width,n=n)[:,None,None]
+    return numpy.fft.irfft(numpy.fft.rfft(data,n=n,axis=0)*transfer,n=n,axis=0)[width//2:width//2+data.shape[0]]
+
+def smooth_clip(data,core,kernels_xy,kernels_z,thresh):
+    """
+    Makes the mask of a chunk of channels, which is the union of the pixels above the threshold in the cube smoothed with each combination of kernels.
+    The threshold is relative to the rms noise of each channel of each smoothed cube.
+
+    Input:
+    data = Cube with the shape (channels, y, x), NaN for blank pixels. (Array)
+    core = The channels to make the mask for (the others only pad the spectral smoothing). (Slice)
+    kernels_xy = FWHM of the spatial Gaussian kernels in pixels. (List of Floats)
+    kernels_z = Widths of the spectral boxcar kernels in channels. (List of Integers)
+    thresh = Threshold in multiples of the rms noise. (Float)
+
+    Output:
+    mask = True for pixels of the core channels in the mask. (Array)
+    """
+    blank = ~numpy.isfinite(data)
+    data = numpy.where(blank,0.,data)
+    mask = numpy.zeros(data[core].shape,dtype=bool)
+    for width in kernels_z:
+        smoothed_z = smooth_z(data,width)
+        for fwhm in kernels_xy:
+            smoothed = numpy.where(blank[core],numpy.nan,smooth_xy(smoothed_z[core],fwhm))
+            rms,npix = noise.channel_rms(smoothed)
+            with numpy.errstate(invalid='ignore'):
+                mask |= smoothed > thresh*rms[:,None,None]
+    return mask
+
+def smooth_clip_mask(imagename,maskname,ia,logger,kernels_xy=[0,3,6],kernels_z=[0,3,7],thresh=4.0,max_bytes=2**26):
+    """
+    Makes a source mask (1 inside, 0 outside) of a CASA image cube by smoothing it with several spatial and spectral kernels and clipping each smoothed cube.
+    The cube is processed in chunks of channels (overlapping by half the widest spectral kernel) so that the memory use is bounded.
+
+    Input:
+    imagename = Path to the CASA image (e.g. the dirty cube). (String)
+    maskname = Path of the CASA image to write the mask to. (String)
+    ia = The ia tool of the calling script.
+    kernels_xy = FWHM of the spatial Gaussian kernels in pixels, 0 for no smoothing. (List of Floats)
+    kernels_z = Widths of the spectral boxcar kernels in channels, 0 for no smoothing. (List of Integers)
+    thresh = Threshold in multiples of the rms noise. (Float)
+    max_bytes = Approximate size of a chunk in bytes. (Integer)
+
+    Output:
+    fraction = Fraction of the pixels in the mask. (Float)
+    """
+    logger.info('Making smooth and clip mask of {0} with spatial kernels {1} pixels, spectral kernels {2} channels and threshold {3}.'.format(imagename,kernels_xy,kernels_z,thresh))
+    ia.open(imagename)
+    try:
+        info = cube_io.casa_image_info(ia)
+        coords = ia.coordsys()
+        mask_image = ia.newimagefromshape(outfile=maskname,shape=info['shape'],csys=coords.torecord(),overwrite=True)
+        coords.done()
+        nchan = info['shape'][info['spec_axis']]
+        halo = max([int(width) | 1 for width in kernels_z if width > 1] or [1])//2
+        step = cube_io.chunk_channels(info['shape'][0],info['shape'][1],max_bytes)
+        npix = 0
+        for start in range(0,nchan,step):
+            end = min(nchan,start+step)
+            first = max(0,start-halo)
+            data = cube_io.get_casa_channels(ia,info,first,min(nchan,end+halo))
+            mask = smooth_clip(data,slice(start-first,end-first),kernels_xy,kernels_z,thresh)
+            cube_io.put_casa_channels(mask_image,info,start,mask.astype('float64'))
+            npix += numpy.sum(mask)
+        mask_image.done()
+    finally:
+        ia.close()
+    fraction = float(npix)/(nchan*info['shape'][0]*info['shape'][1])
+    logger.info('Mask saved as {0} ({1:.2%} of pixels).'.format(maskname,fraction))
+    return fraction
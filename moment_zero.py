@@ -1,71 +1,26 @@
-import imp, numpy, glob, shutil
+import imp, os, numpy, glob, shutil
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
+imp.load_source('noise','noise.py')
+import noise
+imp.load_source('moments','moments.py')
+import moments
 
 
-def noise_est(config,logger):
-    """
-    Makes an estimate of the theortically expected noise level for each science target.
-    
-    Input:
-    config = The parameters read from the configuration file. (Ordered dictionary)
-    
-    Output:
-    noise = Estimate of the theortical noise in Jy/beam. (List of Floats)
-    """
-    logger.info('Starting making noise estimation.')
-    targets = config['calibration']['target_names'][:]
-    calib = config['calibration']
-    if calib['mosaic']:
-        targets = list(set(calib['target_names']))
-    cln_param = config['clean']
-    src_dir = config['global']['src_dir']+'/'
-    noise = []
-    for target in targets:
-        msmd.open(src_dir+target+'.split.contsub')
-        N = msmd.nantennas()
-        t_int = msmd.effexposuretime()['value']
-        t_unit = msmd.effexposuretime()['unit']
-        if t_unit != 's' and 'sec' not in t_unit:
-            logger.warning('Integration time units are not in seconds. Estimated noise may be incorrect.')
-        ch_wid = numpy.mean(msmd.chanwidths(0))
-        #Note: The above line may cause issues if different spectral windows
-        #have very difference frequency resolutions
-        corr_eff = cln_param['corr_eff']
-        SEFD = cln_param['sefd']
-        N_pol = 2.
-        f_smo = 1.
-        if config_raw.has_option('importdata','hanning'):
-            if config['importdata']['hanning']:
-                if not config['importdata']['mstransform']:
-                    f_smo = 8./3.
-                else:
-                    if not config_raw.has_option('importdata','chanavg'):
-                        f_smo = 8./3.
-                    else:
-                        Nchan = float(config['importdata']['chanavg'])
-                        if Nchan > 1.:
-                            f_smo = Nchan/((Nchan-2.) + 2.*(9./16.) + 2.*(1./16.))
-                        else:
-                            f_smo = 8./3.
-        noise.append(SEFD/(corr_eff*numpy.sqrt(f_smo*N_pol*N*(N-1.)*t_int*ch_wid)))
-        logger.info('Effective integration time for {0}: {1} {2}'.format(target,int(t_int),msmd.effexposuretime()['unit']))
-        logger.info('Expected rms noise for {0}: {1} Jy/beam'.format(target,SEFD/(corr_eff*numpy.sqrt(N_pol*N*(N-1.)*t_int*ch_wid))))
-        msmd.close()
-    logger.info('Completed making noise estimation.')
-    return noise
-
-
-def moment0(config,config_raw,config_file,logger):
+def moment0(config,config_raw,config_file,logger,selection=None):
     """
     Generates a moment zero map of each science target.
+    If 'engine' is 'numpy' the moment 0, 1 and 2 and peak maps are made in a single pass over the FITS cube of each target (see moments.py),
+    otherwise the moment zero map is made with immoments.
+    If the smooth and clip mask was used for CLEANing then the same mask is used for the moments instead of clipping at 'mom_thresh'.
     
     Input:
     config = The parameters read from the configuration file. (Ordered dictionary)
     config_raw = The instance of the parser.
     config_file = Path to configuration file. (String)
+    selection = Names of the targets to process, None for all. (List of Strings)
     """
-    noises = noise_est(config,logger)
+    noises = noise.noise_est(config,config_raw,logger,ia,msmd,tb,selection)
     cln_param = config['clean']
     calib = config['calibration']
     if config_raw.has_option('clean','noise'):
@@ -117,16 +72,44 @@ def moment0(config,config_raw,config_file,logger):
         
     logger.info('Starting generation of moment map(s).')
     
+    engine = 'immoments'
+    if config_raw.has_option('moment','engine'):
+        engine = moment['engine']
+    todo = [i for i in range(len(targets)) if cf.target_selected(targets[i],selection)]
+    use_mask = config_raw.has_option('clean','mask_engine') and cln_param['mask_engine'] == 'smooth_clip'
+    if engine == 'numpy':
+        nproc = 1
+        if config_raw.has_option('moment','nproc'):
+            nproc = moment['nproc']
+        jobs = []
+        for i in todo[:]:
+            fitsfile = img_dir+targets[i]+'_HI.fits'
+            if not os.path.exists(fitsfile):
+                logger.warning('{0} not found. The moment zero map of {1} will be made with immoments instead.'.format(fitsfile,targets[i]))
+                continue
+            maskfile = img_dir+targets[i]+'_HI.mask.fits'
+            if not use_mask or not os.path.exists(maskfile):
+                maskfile = None
+            jobs.append((targets[i],fitsfile,mom_dir,noises[i],thresh,chans[i],maskfile))
+            todo.remove(i)
+        logger.info('Making moment maps of {0} target(s) with up to {1} process(es).'.format(len(jobs),nproc))
+        for target,outfiles in moments.run_moment_jobs(jobs,nproc):
+            logger.info('Moment maps of {0} saved as: {1}'.format(target,outfiles))
+    
     J2000 = False
     img_list = glob.glob(img_dir+'*.image.J2000')
     if len(img_list) > 0:
         J2000 = True
-    for i in range(len(targets)):
+    for i in todo:
         if J2000:
             imagename = targets[i]+'.image.J2000'
         else:
             imagename = targets[i]+'.image'
-        command = "immoments(imagename='{0}{1}',includepix=[{2},{3}],chans='{4}',outfile='{5}{6}.mom0')".format(img_dir,imagename,thresh*noises[i],thresh*1E6*noises[i],chans[i],mom_dir,targets[i])
+        maskname = img_dir+targets[i]+'.sc.mask.regrid'
+        if use_mask and os.path.isdir(maskname):
+            command = "immoments(imagename='{0}{1}',mask='\"{2}\">0.5',chans='{3}',outfile='{4}{5}.mom0')".format(img_dir,imagename,maskname,chans[i],mom_dir,targets[i])
+        else:
+            command = "immoments(imagename='{0}{1}',includepix=[{2},{3}],chans='{4}',outfile='{5}{6}.mom0')".format(img_dir,imagename,thresh*noises[i],thresh*1E6*noises[i],chans[i],mom_dir,targets[i])
         logger.info('Executing command: '+command)
         exec(command)
         cf.check_casalog(config,config_raw,logger,casalog)
@@ -151,20 +134,26 @@ logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['projec
 # Define MS file name
 msfile = '{0}.ms'.format(config['global']['project_name'])    
     
+# Targets to process (all unless run as a per-target job)
+selection = cf.get_target_selection(logger)
+
 #Remove previous moment files
 cf.check_casaversion(logger)
+cf.start_casalog_watchdog(config,config_raw,logger,casalog)
 targets = config['calibration']['target_names']
 mom_path = config['global']['mom_dir']+'/'
 logger.info('Deleting any existing moment(s).')
 for target in targets:
-    del_list = glob.glob(mom_path+'*.mom0')
+    if not cf.target_selected(target,selection):
+        continue
+    del_list = glob.glob(mom_path+target+'.mom0')
     if len(del_list) > 0:
         for file_path in del_list:
             try:
                 shutil.rmtree(file_path)
             except OSError:
                 pass
-    del_list = glob.glob(mom_path+'*.mom0.fits')
+    del_list = glob.glob(mom_path+target+'.mom[012].fits')+glob.glob(mom_path+target+'.peak.fits')
     for file_path in del_list:
         try:
             os.remove(file_path)
@@ -172,4 +161,4 @@ for target in targets:
             pass
 
 #Make moment maps
-moment0(config,config_raw,config_file,logger)
+moment0(config,config_raw,config_file,logger,selection)
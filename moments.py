@@ -0,0 +1,200 @@
+import collections
+import multiprocessing
+import numpy
+import imp
+imp.load_source('cube_io','cube_io.py')
+import cube_io
+
+
+# Speed of light in km/s
+c = 299792.458
+
+# Header keywords copied from the cube to the moment maps
+map_keys = ['CTYPE1','CRVAL1','CDELT1','CRPIX1','CUNIT1','CTYPE2','CRVAL2','CDELT2','CRPIX2','CUNIT2',
+            'PC1_1','PC1_2','PC2_1','PC2_2','LONPOLE','LATPOLE','EQUINOX','RADESYS','BMAJ','BMIN','BPA',
+            'OBJECT','TELESCOP','OBSERVER','DATE-OBS','RESTFRQ','SPECSYS']
+
+
+def parse_chans(chans,nchan):
+    """
+    Converts a channel selection (e.g. '0:10~50;60~70', an empty string for all channels) to a channel mask.
+
+    Input:
+    chans = Channel selection. (String)
+    nchan = Number of channels in the cube. (Integer)
+
+    Output:
+    select = True for the selected channels. (Array)
+    """
+    select = numpy.zeros(nchan,dtype=bool)
+    chans = chans.strip()
+    if ':' in chans:
+        chans = chans.split(':',1)[1]
+    if chans == '':
+        select[:] = True
+        return select
+    for chan_range in chans.replace(',',';').split(';'):
+        chan_range = chan_range.strip()
+        if chan_range == '':
+            continue
+        if '~' in chan_range:
+            start,end = chan_range.split('~')
+            select[int(start):int(end)+1] = True
+        else:
+            select[int(chan_range)] = True
+    return select
+
+def channel_velocities(header,nchan):
+    """
+    Returns the radio velocity of each channel of a cube from its FITS header.
+
+    Input:
+    header = The keywords and values of the header. (Ordered dictionary)
+    nchan = Number of channels. (Integer)
+
+    Output:
+    Velocities in km/s. (Array)
+    """
+    values = header['CRVAL3']+(numpy.arange(nchan)+1.-header['CRPIX3'])*header['CDELT3']
+    if header['CTYPE3'].upper().startswith('FREQ'):
+        rest_freq = header.get('RESTFRQ',header.get('RESTFREQ'))
+        return c*(1.-values/rest_freq)
+    if header.get('CUNIT3','m/s').strip().lower() == 'km/s':
+        return values
+    return values/1000.
+
+def compute_moments(fitsfile,noise,thresh,chans,maskfile=None,max_bytes=2**26):
+    """
+    Computes the moment 0, 1 and 2 maps and the peak map of a FITS cube in a single pass over chunks of channels.
+    Only pixels above thresh*noise in the selected channels contribute (as for the includepix parameter of immoments),
+    or if a mask cube is given only the pixels inside the mask.
+
+    Input:
+    fitsfile = Path to the FITS cube (spectral axis in velocity or frequency). (String)
+    noise = The rms noise of the cube in Jy/beam. (Float)
+    thresh = Clipping threshold in multiples of the noise. (Float)
+    chans = Channel selection, empty for all channels. (String)
+    maskfile = Path to a FITS mask cube on the same grid (non-zero inside the mask), None to clip at thresh*noise. (String)
+    max_bytes = Maximum size of a chunk in bytes. (Integer)
+
+    Output:
+    maps = The mom0 (Jy/beam.km/s), mom1 (km/s), mom2 (km/s) and peak (Jy/beam) maps. (Ordered dictionary)
+    header = The header of the cube. (Ordered dictionary)
+    """
+    header,data = cube_io.read_fits_cube(fitsfile)
+    nchan,ny,nx = data.shape
+    if maskfile is not None:
+        mask_header,mask_data = cube_io.read_fits_cube(maskfile)
+        if mask_data.shape != data.shape:
+            raise ValueError('The mask {0} does not have the same shape as {1}.'.format(maskfile,fitsfile))
+    select = parse_chans(chans,nchan)
+    vel = channel_velocities(header,nchan)
+    dv = abs(numpy.diff(channel_velocities(header,2))[0])
+    # Velocities relative to the centre of the band, to avoid cancellation errors in the second moment
+    v_ref = numpy.mean(vel)
+    sum0 = numpy.zeros((ny,nx))
+    sum1 = numpy.zeros((ny,nx))
+    sum2 = numpy.zeros((ny,nx))
+    peak = numpy.full((ny,nx),-numpy.inf)
+    npix = numpy.zeros((ny,nx),dtype=int)
+    for start,chunk in cube_io.fits_chunks(data,header,max_bytes):
+        chunk_select = select[start:start+len(chunk)]
+        if not numpy.any(chunk_select):
+            continue
+        chunk = chunk[chunk_select]
+        v = (vel[start:start+len(chunk_select)][chunk_select]-v_ref)[:,None,None]
+        if maskfile is not None:
+            mask = (mask_data[start:start+len(chunk_select)][chunk_select] > 0.5) & numpy.isfinite(chunk)
+        else:
+            with numpy.errstate(invalid='ignore'):
+                mask = chunk >= thresh*noise
+        vals = numpy.where(mask,chunk,0.)
+        sum0 += numpy.sum(vals,axis=0)
+        sum1 += numpy.sum(vals*v,axis=0)
+        sum2 += numpy.sum(vals*v**2,axis=0)
+        peak = numpy.maximum(peak,numpy.max(numpy.where(mask,chunk,-numpy.inf),axis=0))
+        npix += numpy.sum(mask,axis=0)
+    blank = npix == 0
+    sum0[blank] = numpy.nan
+    mom1 = sum1/sum0
+    maps = collections.OrderedDict()
+    maps['mom0'] = sum0*dv
+    maps['mom1'] = mom1+v_ref
+    maps['mom2'] = numpy.sqrt(numpy.maximum(sum2/sum0-mom1**2,0.))
+    peak[blank] = numpy.nan
+    maps['peak'] = peak
+    return maps,header
+
+def map_header(header,bunit):
+    """
+    Returns the header of a moment map made from a cube.
+
+    Input:
+    header = The header of the cube. (Ordered dictionary)
+    bunit = Units of the map. (String)
+
+    Output:
+    The header of the map. (Ordered dictionary)
+    """
+    out = collections.OrderedDict()
+    for key in map_keys:
+        if key in header:
+            out[key] = header[key]
+    out['BUNIT'] = bunit
+    return out
+
+def write_moments(target,fitsfile,mom_dir,noise,thresh,chans,maskfile=None,max_bytes=2**26):
+    """
+    Computes the moment maps of a target and writes them as '<mom_dir><target>.<moment>.fits'.
+
+    Input:
+    target = Name of the target. (String)
+    fitsfile = Path to the FITS cube of the target. (String)
+    mom_dir = Directory to write the maps to (ending in '/'). (String)
+    noise = The rms noise of the cube in Jy/beam. (Float)
+    thresh = Clipping threshold in multiples of the noise. (Float)
+    chans = Channel selection, empty for all channels. (String)
+    maskfile = Path to a FITS mask cube on the same grid, None to clip at thresh*noise. (String)
+    max_bytes = Maximum size of a chunk in bytes. (Integer)
+
+    Output:
+    target = Name of the target. (String)
+    outfiles = Paths of the maps written. (List of Strings)
+    """
+    maps,header = compute_moments(fitsfile,noise,thresh,chans,maskfile,max_bytes)
+    bunit = header.get('BUNIT','Jy/beam')
+    units = {'mom0': bunit+'.km/s', 'mom1': 'km/s', 'mom2': 'km/s', 'peak': bunit}
+    outfiles = []
+    for name in maps.keys():
+        outfile = '{0}{1}.{2}.fits'.format(mom_dir,target,name)
+        cube_io.write_fits_image(outfile,maps[name],map_header(header,units[name]))
+        outfiles.append(outfile)
+    return target,outfiles
+
+def moment_job(job):
+    """
+    Runs write_moments for one target (arguments as a tuple so it can be used with a process pool).
+    """
+    return write_moments(*job)
+
+def run_moment_jobs(jobs,nproc=1):
+    """
+    Makes the moment maps of several targets, in parallel if more than one process is allowed.
+
+    Input:
+    jobs = Arguments of write_moments for each target. (List of Tuples)
+    nproc = Maximum number of processes to use. (Integer)
+
+    Output:
+    results = Name of each target and the maps written. (List of Tuples)
+    """
+    nproc = min(nproc,len(jobs))
+    if nproc <= 1:
+        return [moment_job(job) for job in jobs]
+    pool = multiprocessing.Pool(nproc)
+    try:
+        results = pool.map(moment_job,jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return results
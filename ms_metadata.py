@@ -0,0 +1,276 @@
+import os
+import json
+import datetime
+import numpy
+
+
+# Version of the snapshot layout, increase when the contents change so that old snapshots are rebuilt
+snapshot_version = 1
+
+# Tables whose modification times identify the state of an MS
+key_tables = ['', 'ANTENNA', 'FIELD', 'SPECTRAL_WINDOW', 'DATA_DESCRIPTION', 'OBSERVATION', 'POLARIZATION']
+
+# Snapshots already read by this process
+loaded_snapshots = {}
+
+
+def snapshot_file(msfile):
+    """
+    Returns the path of the metadata snapshot of an MS.
+
+    Input:
+    msfile = Path to the MS. (String)
+
+    Output:
+    Path to the snapshot file. (String)
+    """
+    return msfile.rstrip('/')+'.metadata.json'
+
+def snapshot_key(msfile):
+    """
+    Returns the modification times of the main table and key subtables of an MS.
+
+    Input:
+    msfile = Path to the MS. (String)
+
+    Output:
+    key = Modification time of each table. (Dictionary)
+    """
+    key = {'version': snapshot_version}
+    for table in key_tables:
+        table_file = os.path.join(msfile,table,'table.dat')
+        if os.path.exists(table_file):
+            key[table or 'MAIN'] = os.path.getmtime(table_file)
+    return key
+
+def build_snapshot(msfile,msmd,tb,logger):
+    """
+    Reads all the metadata used by the pipeline from an MS.
+
+    Input:
+    msfile = Path to the MS. (String)
+    msmd = The msmd tool of the calling script.
+    tb = The tb tool of the calling script.
+
+    Output:
+    meta = The metadata of the MS. (Dictionary)
+    """
+    logger.info('Reading metadata of {}.'.format(msfile))
+    meta = {}
+    tb.open(msfile+'/OBSERVATION')
+    meta['project'] = list(tb.getcol('PROJECT'))
+    meta['observer'] = list(tb.getcol('OBSERVER'))
+    meta['telescope'] = list(tb.getcol('TELESCOPE_NAME'))
+    meta['obs_time_ranges'] = numpy.transpose(tb.getcol('TIME_RANGE')).tolist()
+    tb.close()
+    tb.open(msfile+'/FIELD')
+    phase_dir = tb.getcol('PHASE_DIR')
+    tb.close()
+    tb.open(msfile+'/SPECTRAL_WINDOW')
+    meta['spw_names'] = list(tb.getcol('NAME'))
+    meta['spw_doppler_ids'] = tb.getcol('DOPPLER_ID').tolist()
+    meta['spw_freq_groups'] = tb.getcol('FREQ_GROUP').tolist()
+    meta['spw_ref_freqs'] = tb.getcol('REF_FREQUENCY').tolist()
+    tb.close()
+    tb.open(msfile+'/ANTENNA')
+    meta['antennas'] = list(tb.getcol('NAME'))
+    meta['stations'] = list(tb.getcol('STATION'))
+    positions = numpy.transpose(tb.getcol('POSITION'))
+    ant_flagged = tb.getcol('FLAG_ROW')
+    tb.close()
+    baselines = []
+    for i in range(len(positions)):
+        for j in range(i+1,len(positions)):
+            if ant_flagged[i] or ant_flagged[j]:
+                continue
+            length = numpy.sqrt(numpy.sum((positions[i]-positions[j])**2))
+            baselines.append(['{0}-{1}'.format(meta['antennas'][i],meta['antennas'][j]),float(length)])
+    meta['baselines'] = sorted(baselines,key=lambda baseline: baseline[1])
+    msmd.open(msfile)
+    meta['nobs'] = msmd.nobservations()
+    meta['fields'] = list(msmd.fieldnames())
+    meta['field_dirs'] = [[float(phase_dir[0][0][i]),float(phase_dir[1][0][i])] for i in range(len(meta['fields']))]
+    meta['nspw'] = msmd.nspw()
+    meta['chan_freqs'] = [msmd.chanfreqs(spw).tolist() for spw in range(meta['nspw'])]
+    meta['chan_widths'] = [msmd.chanwidths(spw).tolist() for spw in range(meta['nspw'])]
+    meta['spws_for_field'] = {}
+    for field in meta['fields']:
+        meta['spws_for_field'][field] = sorted(int(spw) for spw in msmd.spwsforfield(field))
+    meta['fields_for_spw'] = {}
+    for spw in range(meta['nspw']):
+        meta['fields_for_spw'][str(spw)] = list(msmd.fieldsforspw(spw,asnames=True))
+    exposure = msmd.effexposuretime()
+    meta['exposure'] = {'value': float(exposure['value']), 'unit': exposure['unit']}
+    meta['scans'] = []
+    for obs in range(meta['nobs']):
+        for scan in msmd.scannumbers(obsid=obs):
+            times = msmd.timesforscan(scan,obsid=obs)
+            meta['scans'].append({'obs': obs, 'scan': int(scan),
+                                  'start': float(numpy.min(times)), 'end': float(numpy.max(times)),
+                                  'fields': [meta['fields'][field] for field in msmd.fieldsforscan(scan,obsid=obs)],
+                                  'spws': sorted(int(spw) for spw in msmd.spwsforscan(scan,obsid=obs))})
+    msmd.close()
+    return meta
+
+def to_str(obj):
+    """
+    Converts the unicode strings read from a JSON file back to plain strings (as returned by the CASA tools).
+    """
+    if isinstance(obj,dict):
+        return dict((to_str(key),to_str(value)) for key,value in obj.items())
+    if isinstance(obj,list):
+        return [to_str(item) for item in obj]
+    if isinstance(obj,type(u'')) and not isinstance(obj,str):
+        return str(obj)
+    return obj
+
+def get_metadata(msfile,msmd,tb,logger):
+    """
+    Returns the metadata snapshot of an MS, building it (and saving it next to the MS) if it does not exist or the MS has changed.
+
+    Input:
+    msfile = Path to the MS. (String)
+    msmd = The msmd tool of the calling script.
+    tb = The tb tool of the calling script.
+
+    Output:
+    meta = The metadata of the MS. (Dictionary)
+    """
+    key = snapshot_key(msfile)
+    if msfile in loaded_snapshots and loaded_snapshots[msfile]['key'] == key:
+        return loaded_snapshots[msfile]
+    meta = None
+    if os.path.exists(snapshot_file(msfile)):
+        try:
+            snapshot = open(snapshot_file(msfile),'r')
+            meta = to_str(json.load(snapshot))
+            snapshot.close()
+        except ValueError:
+            meta = None
+        if meta is not None and meta['key'] != key:
+            logger.info('{} has changed since its metadata snapshot was made.'.format(msfile))
+            meta = None
+    if meta is None:
+        meta = build_snapshot(msfile,msmd,tb,logger)
+        meta['key'] = key
+        tmp_file = snapshot_file(msfile)+'.tmp{}'.format(os.getpid())
+        snapshot = open(tmp_file,'w')
+        json.dump(meta,snapshot)
+        snapshot.close()
+        os.rename(tmp_file,snapshot_file(msfile))
+        logger.info('Metadata snapshot saved to: {}'.format(snapshot_file(msfile)))
+    loaded_snapshots[msfile] = meta
+    return meta
+
+def spws_for_field(meta,field):
+    """
+    Returns the SPWs in which a field (name or ID) was observed.
+
+    Input:
+    meta = The metadata of the MS. (Dictionary)
+    field = Name or ID of the field. (String)
+
+    Output:
+    SPW IDs. (List of Integers)
+    """
+    field = str(field)
+    if field not in meta['spws_for_field'] and field.isdigit():
+        field = meta['fields'][int(field)]
+    return list(meta['spws_for_field'][field])
+
+def fields_for_spw(meta,spw):
+    """
+    Returns the names of the fields observed in a SPW.
+
+    Input:
+    meta = The metadata of the MS. (Dictionary)
+    spw = SPW ID. (Integer)
+
+    Output:
+    Field names. (List of Strings)
+    """
+    return list(meta['fields_for_spw'][str(spw)])
+
+def names_for_spws(meta,spws):
+    """
+    Returns the names of a list of SPWs.
+
+    Input:
+    meta = The metadata of the MS. (Dictionary)
+    spws = SPW IDs. (List of Integers)
+
+    Output:
+    SPW names. (List of Strings)
+    """
+    return [meta['spw_names'][spw] for spw in spws]
+
+def format_time(mjd_sec):
+    """
+    Converts a time in MJD seconds to a date string.
+    """
+    time = datetime.datetime(1858,11,17)+datetime.timedelta(seconds=mjd_sec)
+    return time.strftime('%d-%b-%Y/%H:%M:%S.')+'{:01d}'.format(time.microsecond//100000)
+
+def format_angle(angle,hours=False):
+    """
+    Converts an angle in radians to a sexagesimal string (hours for RA, degrees for Dec).
+    """
+    value = numpy.degrees(angle)
+    if hours:
+        value = (value % 360.)/15.
+    sign = '-' if value < 0 else '+'
+    value = abs(value)
+    units = int(value)
+    minutes = int((value-units)*60.)
+    seconds = ((value-units)*60.-minutes)*60.
+    if hours:
+        return '{0:02d}:{1:02d}:{2:07.4f}'.format(units,minutes,seconds)
+    return '{0}{1:02d}.{2:02d}.{3:06.3f}'.format(sign,units,minutes,seconds)
+
+def write_summary(msfile,meta,summary_file,logger):
+    """
+    Writes a listobs-style summary of an MS from its metadata snapshot.
+
+    Input:
+    msfile = Path to the MS. (String)
+    meta = The metadata of the MS. (Dictionary)
+    summary_file = Path of the summary file to write. (String)
+    """
+    lines = []
+    lines.append('           MeasurementSet Name:  {}'.format(os.path.abspath(msfile)))
+    lines.append('   (Summary written by the pipeline from the metadata snapshot: {})'.format(snapshot_file(msfile)))
+    lines.append('================================================================================')
+    for i in range(len(meta['obs_time_ranges'])):
+        lines.append('   Observer: {0}     Project: {1}  '.format(meta['observer'][i],meta['project'][i]))
+        lines.append('Observation: {0}({1})'.format(meta['telescope'][i],i))
+        lines.append('   Observed from   {0}   to   {1} (UTC)'.format(format_time(meta['obs_time_ranges'][i][0]),format_time(meta['obs_time_ranges'][i][1])))
+    lines.append('Effective exposure time: {0:.1f} {1}'.format(meta['exposure']['value'],meta['exposure']['unit']))
+    lines.append('')
+    lines.append('  ObservationID  Timerange (UTC)                                   Scan  FldName              SpwIds')
+    for scan in meta['scans']:
+        lines.append('  {0:<13d}  {1} - {2}  {3:>5d}  {4:<20s} {5}'.format(scan['obs'],format_time(scan['start']),format_time(scan['end']),
+                                                                       scan['scan'],','.join(scan['fields']),scan['spws']))
+    lines.append('Fields: {}'.format(len(meta['fields'])))
+    lines.append('  ID   Name                 RA               Decl           SpwIds')
+    for i in range(len(meta['fields'])):
+        field = meta['fields'][i]
+        lines.append('  {0:<4d} {1:<20s} {2:<16s} {3:<14s} {4}'.format(i,field,format_angle(meta['field_dirs'][i][0],hours=True),
+                                                                     format_angle(meta['field_dirs'][i][1]),meta['spws_for_field'][field]))
+    lines.append('Spectral Windows: ({} unique spectral windows)'.format(meta['nspw']))
+    lines.append('  SpwID  Name           #Chans   Ch0(MHz)  ChanWid(kHz)  TotBW(kHz)  CtrFreq(MHz)')
+    for spw in range(meta['nspw']):
+        freqs = numpy.array(meta['chan_freqs'][spw])
+        wids = numpy.array(meta['chan_widths'][spw])
+        lines.append('  {0:<6d} {1:<14s} {2:>6d} {3:>10.3f} {4:>13.3f} {5:>11.1f} {6:>13.4f}'.format(spw,meta['spw_names'][spw],len(freqs),freqs[0]/1.E6,
+                                                                                                   numpy.mean(wids)/1.E3,numpy.sum(numpy.abs(wids))/1.E3,
+                                                                                                   numpy.mean(freqs)/1.E6))
+    lines.append('Antennas: {}:'.format(len(meta['antennas'])))
+    lines.append('  ID   Name  Station')
+    for i in range(len(meta['antennas'])):
+        lines.append('  {0:<4d} {1:<5s} {2}'.format(i,meta['antennas'][i],meta['stations'][i]))
+    if len(meta['baselines']) > 0:
+        lines.append('Baseline lengths: {0:.1f} m ({1}) to {2:.1f} m ({3})'.format(meta['baselines'][0][1],meta['baselines'][0][0],
+                                                                                 meta['baselines'][-1][1],meta['baselines'][-1][0]))
+    summary = open(summary_file,'w')
+    summary.write('\n'.join(lines)+'\n')
+    summary.close()
@@ -0,0 +1,160 @@
+import os
+import numpy
+import imp
+imp.load_source('common_functions','common_functions.py')
+import common_functions as cf
+imp.load_source('cube_io','cube_io.py')
+import cube_io
+imp.load_source('ms_metadata','ms_metadata.py')
+import ms_metadata as mm
+
+
+def channel_rms(data,clip=3.0,iterations=5):
+    """
+    Measures the rms noise of each channel of a cube with the median absolute deviation, iteratively clipping outliers (e.g. emission).
+
+    Input:
+    data = Cube with the shape (channels, y, x), NaN for masked pixels. (Array)
+    clip = Clipping threshold in multiples of the rms. (Float)
+    iterations = Maximum number of clipping iterations. (Integer)
+
+    Output:
+    rms = Noise level of each channel. (Array)
+    npix = Number of pixels used for each channel. (Array)
+    """
+    vals = data.reshape(data.shape[0],-1).copy()
+    for i in range(iterations+1):
+        med = numpy.nanmedian(vals,axis=1)[:,None]
+        rms = 1.4826*numpy.nanmedian(numpy.abs(vals-med),axis=1)
+        if i == iterations:
+            break
+        with numpy.errstate(invalid='ignore'):
+            outliers = numpy.abs(vals-med) > clip*rms[:,None]
+        if not numpy.any(outliers):
+            break
+        vals[outliers] = numpy.nan
+    npix = numpy.sum(numpy.isfinite(vals),axis=1)
+    return rms,npix
+
+def measure_noise(imagename,ia,logger,clip=3.0):
+    """
+    Measures the rms noise in each channel of a CASA image cube, reading it in chunks of channels.
+    The results are cached in '<image>.noise.txt' and reused until the image changes.
+
+    Input:
+    imagename = Path to the CASA image. (String)
+    ia = The ia tool of the calling script.
+    clip = Clipping threshold in multiples of the rms. (Float)
+
+    Output:
+    rms = Noise level of each channel in the units of the image. (Array)
+    """
+    cache_file = imagename.rstrip('/')+'.noise.txt'
+    mtime = cube_io.image_mtime(imagename)
+    if os.path.exists(cache_file):
+        table = open(cache_file,'r')
+        header = table.readline().split()
+        table.close()
+        if len(header) == 4 and header[1] == 'mtime' and float(header[2]) == mtime and float(header[3]) == clip:
+            logger.info('Reading per-channel noise of {0} from {1}.'.format(imagename,cache_file))
+            return numpy.atleast_1d(numpy.loadtxt(cache_file,usecols=(1,)))
+    logger.info('Measuring per-channel noise of {}.'.format(imagename))
+    rms = []
+    npix = []
+    for start,data in cube_io.casa_image_chunks(imagename,ia):
+        chunk_rms,chunk_npix = channel_rms(data,clip)
+        rms.extend(chunk_rms)
+        npix.extend(chunk_npix)
+    rms = numpy.array(rms)
+    table = open(cache_file,'w')
+    table.write('# mtime {0!r} {1!r}\n'.format(mtime,clip))
+    table.write('# channel rms npix\n')
+    for chan in range(len(rms)):
+        table.write('{0} {1!r} {2}\n'.format(chan,rms[chan],npix[chan]))
+    table.close()
+    logger.info('Per-channel noise saved to: {}'.format(cache_file))
+    return rms
+
+def theoretical_noise(msfile,config,config_raw,logger,msmd,tb):
+    """
+    Estimates the theoretically expected rms noise of a target from the radiometer equation.
+
+    Input:
+    msfile = Path to the (continuum subtracted) MS of the target. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+
+    Output:
+    Estimate of the theoretical noise in Jy/beam. (Float)
+    """
+    cln_param = config['clean']
+    meta = mm.get_metadata(msfile,msmd,tb,logger)
+    N = len(meta['antennas'])
+    t_int = meta['exposure']['value']
+    t_unit = meta['exposure']['unit']
+    if t_unit != 's' and 'sec' not in t_unit:
+        logger.warning('Integration time units are not in seconds. Estimated noise may be incorrect.')
+    ch_wid = numpy.mean(meta['chan_widths'][0])
+    #Note: The above line may cause issues if different spectral windows
+    #have very difference frequency resolutions
+    corr_eff = cln_param['corr_eff']
+    SEFD = cln_param['sefd']
+    N_pol = 2.
+    f_smo = 1.
+    if config_raw.has_option('importdata','hanning'):
+        if config['importdata']['hanning']:
+            if not config['importdata']['mstransform']:
+                f_smo = 8./3.
+            else:
+                if not config_raw.has_option('importdata','chanavg'):
+                    f_smo = 8./3.
+                else:
+                    Nchan = float(config['importdata']['chanavg'])
+                    if Nchan > 1.:
+                        f_smo = Nchan/((Nchan-2.) + 2.*(9./16.) + 2.*(1./16.))
+                    else:
+                        f_smo = 8./3.
+    logger.info('Effective integration time for {0}: {1} {2}'.format(msfile,int(t_int),t_unit))
+    return SEFD/(corr_eff*numpy.sqrt(f_smo*N_pol*N*(N-1.)*t_int*ch_wid))
+
+def noise_est(config,config_raw,logger,ia,msmd,tb,selection=None):
+    """
+    Estimates the rms noise level for each science target.
+    If 'noise_method' is 'measured' the noise is measured from the dirty cube of each target (median of the per-channel values),
+    otherwise (or if the dirty cube is not available) the theoretically expected noise is used.
+
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    selection = Names of the targets to process, None for all. (List of Strings)
+
+    Output:
+    noise = Estimate of the noise in Jy/beam, None for unselected targets. (List of Floats)
+    """
+    logger.info('Starting making noise estimation.')
+    targets = config['calibration']['target_names'][:]
+    calib = config['calibration']
+    if calib['mosaic']:
+        targets = list(set(calib['target_names']))
+    src_dir = config['global']['src_dir']+'/'
+    img_dir = config['global']['img_dir']+'/'
+    method = 'theoretical'
+    if config_raw.has_option('clean','noise_method'):
+        method = config['clean']['noise_method']
+    noise = []
+    for target in targets:
+        if not cf.target_selected(target,selection):
+            noise.append(None)
+            continue
+        dirty_cube = img_dir+target+'.dirty.image'
+        if method == 'measured' and os.path.isdir(dirty_cube):
+            rms = measure_noise(dirty_cube,ia,logger)
+            noise.append(float(numpy.nanmedian(rms)))
+            logger.info('Measured rms noise for {0}: {1} Jy/beam (median of channels, range {2} - {3} Jy/beam)'.format(target,noise[-1],numpy.nanmin(rms),numpy.nanmax(rms)))
+        else:
+            if method == 'measured':
+                logger.warning('No dirty cube found for {}. Using the theoretical noise estimate instead.'.format(target))
+            noise.append(theoretical_noise(src_dir+target+'.split.contsub',config,config_raw,logger,msmd,tb))
+            logger.info('Expected rms noise for {0}: {1} Jy/beam'.format(target,noise[-1]))
+    logger.info('Completed making noise estimation.')
+    return noise
@@ -0,0 +1,265 @@
+import os
+import time
+import json
+import glob
+import shutil
+import hashlib
+import subprocess
+
+
+# Files or directories up to this size are identified by their contents, larger ones by the sizes and modification times of their files
+content_hash_limit = 2**26
+
+# State of the plot queue of this process
+queue = {'dir': None, 'log_dir': None, 'nworkers': 0, 'workers': [], 'nstarted': 0, 'jobs': [], 'njobs': 0}
+
+
+def input_key(path):
+    """
+    Returns a string identifying the current state of an input (file or directory) of a plot.
+
+    Input:
+    path = Path to the input. (String)
+
+    Output:
+    SHA1 hash of the input. (String)
+    """
+    files = []
+    if os.path.isdir(path):
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                files.append(os.path.join(root,name))
+    elif os.path.exists(path):
+        files.append(path)
+    sha = hashlib.sha1(path.encode('utf-8'))
+    by_content = sum(os.path.getsize(name) for name in files) <= content_hash_limit
+    for name in files:
+        sha.update(os.path.relpath(name,path).encode('utf-8'))
+        if by_content:
+            source = open(name,'rb')
+            for block in iter(lambda: source.read(2**20), b''):
+                sha.update(block)
+            source.close()
+        else:
+            sha.update('{0} {1!r}'.format(os.path.getsize(name),os.path.getmtime(name)).encode('utf-8'))
+    return sha.hexdigest()
+
+def plot_key(task,params,inputs):
+    """
+    Returns the hash of a plot request: the task, its parameters and the state of its inputs.
+    """
+    sha = hashlib.sha1(json.dumps([task,params],sort_keys=True).encode('utf-8'))
+    for path in inputs:
+        sha.update(input_key(path).encode('utf-8'))
+    return sha.hexdigest()
+
+def output_file(params):
+    """
+    Returns the plot file of a plotms or plotants request.
+    """
+    if 'plotfile' in params:
+        return params['plotfile']
+    return params['figfile']
+
+def hash_file(output):
+    """
+    Returns the path of the file recording the hash of the request that made a plot.
+    """
+    return output+'.hash'
+
+def up_to_date(output,key):
+    """
+    Checks if a plot was already made by an identical request.
+    Plots iterated over an axis are written to several files with suffixes, so any file starting with the plot name and '_' counts.
+    """
+    if not os.path.exists(hash_file(output)):
+        return False
+    recorded = open(hash_file(output),'r')
+    previous = recorded.read().strip()
+    recorded.close()
+    root,ext = os.path.splitext(output)
+    return previous == key and len(glob.glob(output)+glob.glob(root+'_*'+ext)) > 0
+
+def record_plot(output,key):
+    """
+    Records the hash of the request that made a plot.
+    """
+    recorded = open(hash_file(output),'w')
+    recorded.write(key+'\n')
+    recorded.close()
+
+def start_plot_queue(nworkers,logger):
+    """
+    Sets up the plot queue of this process. The worker processes are only started when the first plot is queued.
+
+    Input:
+    nworkers = Number of CASA processes making plots, 0 to make the plots in this process as they are requested. (Integer)
+    """
+    queue['nworkers'] = nworkers
+    queue['dir'] = os.path.abspath('plot_queue.{}'.format(os.getpid()))
+    # The logs of the workers and the reports of failed jobs are kept after the queue is removed
+    queue['log_dir'] = os.path.abspath('plot_queue.{}.logs'.format(os.getpid()))
+    if nworkers > 0:
+        logger.info('Queued plots and jobs will be run by {0} background CASA process(es) using the queue {1} (logs in {2}).'.format(nworkers,queue['dir'],queue['log_dir']))
+
+def start_workers(logger):
+    """
+    Starts the CASA processes that run the queued plots (see plot_worker.py).
+    """
+    if os.path.isdir(queue['dir']):
+        shutil.rmtree(queue['dir'])
+    os.makedirs(queue['dir'])
+    if not os.path.isdir(queue['log_dir']):
+        os.makedirs(queue['log_dir'])
+    for i in range(queue['nworkers']):
+        # The workers are numbered over the whole step, as they are started again after each wait_for_plots
+        worker_log = open(os.path.join(queue['log_dir'],'worker.{}.out'.format(queue['nstarted'])),'w')
+        queue['workers'].append(subprocess.Popen(['casa','--nologger','--nogui','-c','plot_worker.py',queue['dir'],queue['log_dir'],str(os.getpid())],
+                                                 stdout=worker_log,stderr=subprocess.STDOUT))
+        worker_log.close()
+        queue['nstarted'] += 1
+    logger.info('Started {} plotting process(es).'.format(queue['nworkers']))
+
+def queue_plot(task,params,inputs,logger,namespace,output=None):
+    """
+    Requests a plot. It is skipped if an identical request (same parameters and unchanged inputs) already made it,
+    otherwise it is added to the queue, or made immediately if there are no plotting processes.
+    Other CASA tasks can be queued in the same way by giving the file or MS that they write.
+
+    Input:
+    task = Name of the CASA task (e.g. 'plotms'). (String)
+    params = Parameters of the task, including the plot file. (Dictionary)
+    inputs = Paths of the MS, calibration tables or other files that the plot depends on. (List of Strings)
+    namespace = The globals of the calling script (to run the task immediately). (Dictionary)
+    output = The file written by the task, None for the plot file in the parameters. (String)
+    """
+    if output is None:
+        output = output_file(params)
+    key = plot_key(task,params,inputs)
+    if up_to_date(output,key):
+        logger.info('{} is up to date, skipping.'.format(output))
+        return
+    if queue['nworkers'] == 0:
+        logger.info('Making plot: {}'.format(output))
+        if namespace[task](**params) is not False:
+            record_plot(output,key)
+        else:
+            logger.warning('{0} failed to make {1}.'.format(task,output))
+        return
+    submit_job(task,params,output,logger,key)
+    logger.info('Queued plot: {}'.format(output))
+
+def submit_job(task,params,output,logger,key=None,prefix='plot'):
+    """
+    Adds a task to the queue of the CASA processes (starting them if needed), without checking if it is up to date.
+
+    Input:
+    task = Name of the CASA task. (String)
+    params = Parameters of the task. (Dictionary)
+    output = Name of the file written by the task, to identify it in the log of the workers. (String)
+    key = Hash of the request to record next to the output, None to record nothing. (String)
+    prefix = Prefix of the job name. Jobs are claimed in order of their names, so 'calib' jobs are run before 'plot' jobs. (String)
+
+    Output:
+    job = Name of the job (see job_state). (String)
+    """
+    if len(queue['workers']) == 0:
+        start_workers(logger)
+    job = '{0}{1:05d}'.format(prefix,queue['njobs'])
+    job_file = os.path.join(queue['dir'],job+'.job')
+    tmp_file = job_file+'.tmp'
+    job_out = open(tmp_file,'w')
+    json.dump({'task': task, 'params': params, 'output': output, 'key': key},job_out)
+    job_out.close()
+    os.rename(tmp_file,job_file)
+    queue['jobs'].append(job)
+    queue['njobs'] += 1
+    return job
+
+def job_state(job):
+    """
+    Returns the state of a queued job: 'done', 'failed' (including if all the CASA processes have stopped), or 'queued'.
+    """
+    if os.path.exists(os.path.join(queue['dir'],job+'.done')):
+        return 'done'
+    if os.path.exists(os.path.join(queue['log_dir'],job+'.failed')):
+        return 'failed'
+    if len([worker for worker in queue['workers'] if worker.poll() is None]) == 0:
+        return 'failed'
+    return 'queued'
+
+def job_report(job):
+    """
+    Returns the error report of a failed job (empty if there is none).
+    """
+    failed_file = os.path.join(queue['log_dir'],job+'.failed')
+    if not os.path.exists(failed_file):
+        return ''
+    report = open(failed_file,'r')
+    try:
+        return report.read()
+    finally:
+        report.close()
+
+def wait_for_jobs(jobs,logger,poll=0.5):
+    """
+    Waits until some of the queued jobs have finished (without stopping the CASA processes) and writes the report of any
+    that failed to the log. The jobs are then no longer counted by wait_for_plots.
+
+    Input:
+    jobs = Names of the jobs (from submit_job). (List of Strings)
+    poll = Interval between checks of the jobs in seconds. (Float)
+
+    Output:
+    failed = Names of the jobs that failed. (List of Strings)
+    """
+    while len([job for job in jobs if job_state(job) == 'queued']) > 0:
+        time.sleep(poll)
+    failed = [job for job in jobs if job_state(job) == 'failed']
+    for job in failed:
+        logger.warning('Job {0} failed:\n{1}'.format(job,job_report(job)))
+    queue['jobs'] = [job for job in queue['jobs'] if job not in jobs]
+    return failed
+
+def stop_workers(logger):
+    """
+    Stops the CASA processes once they have run all the queued jobs, and removes the queue directory.
+    The logs of the workers and the reports of failed jobs are left in the log directory.
+    Job names are not reused in the same step, so the reports of earlier jobs are not overwritten.
+    """
+    if len(queue['workers']) == 0:
+        return
+    open(os.path.join(queue['dir'],'stop'),'w').close()
+    for worker in queue['workers']:
+        worker.wait()
+    shutil.rmtree(queue['dir'])
+    queue['workers'] = []
+    queue['jobs'] = []
+
+def wait_for_plots(logger):
+    """
+    Waits until all the queued plots have been made and stops the plotting processes.
+    This must be called before the inputs of queued plots are modified and at the end of a step.
+
+    Output:
+    failed = Number of plots that failed. (Integer)
+    """
+    if len(queue['workers']) == 0:
+        return 0
+    logger.info('Waiting for {} queued job(s) to finish.'.format(len(queue['jobs'])))
+    open(os.path.join(queue['dir'],'stop'),'w').close()
+    for worker in queue['workers']:
+        worker.wait()
+    failed = 0
+    for job in queue['jobs']:
+        if os.path.exists(os.path.join(queue['dir'],job+'.done')):
+            continue
+        failed += 1
+        if os.path.exists(os.path.join(queue['log_dir'],job+'.failed')):
+            logger.warning('Job {0} failed:\n{1}'.format(job,job_report(job)))
+        else:
+            logger.warning('Job {} was not run.'.format(job))
+    logger.info('Completed {0} queued job(s) ({1} failed).'.format(len(queue['jobs'])-failed,failed))
+    stop_workers(logger)
+    return failed
@@ -0,0 +1,92 @@
+import os, sys, time, glob, json, traceback
+import imp
+imp.load_source('ms_metadata','ms_metadata.py')
+import ms_metadata as mm
+imp.load_source('common_functions','common_functions.py')
+import common_functions as cf
+
+# CASA process that makes the plots queued by plot_queue.py.
+# Started as: casa --nologger --nogui -c plot_worker.py <queue directory> <log directory> <pid of the pipeline script>
+# Each job is a JSON file "<job>.job": {"task": "plotms", "params": {...}, "output": "plots/x.png", "key": "<hash>"}
+# (the key is null for jobs that are not plots, e.g. calibration solves) that is claimed by renaming it,
+# and is marked as "<job>.done" when finished, or removed with its error report written to "<job>.failed" in the log directory.
+# Jobs are claimed in order of their names.
+# Each worker writes its own casa log in the log directory, and a job that writes SEVERE lines to it has failed
+# (CASA tasks such as gaincal usually log their errors and return None rather than raising or returning False).
+
+def owner_alive(pid):
+    """
+    Checks if the pipeline script that started this worker is still running.
+    """
+    try:
+        os.kill(pid,0)
+    except OSError:
+        return False
+    return True
+
+def claim_job(queue_dir):
+    """
+    Claims the first unclaimed job in the queue (by name).
+
+    Input:
+    queue_dir = The queue directory. (String)
+
+    Output:
+    claimed = Path to the claimed job file, None if there are no jobs. (String)
+    """
+    for job_file in sorted(glob.glob(os.path.join(queue_dir,'*.job'))):
+        claimed = job_file+'.{}'.format(os.getpid())
+        try:
+            os.rename(job_file,claimed)
+        except OSError:
+            continue
+        return claimed
+    return None
+
+def run_job(claimed,log_dir):
+    """
+    Makes a queued plot and records the hash of the request next to it.
+    The job fails if the task raises, returns False or writes SEVERE lines to the casa log.
+
+    Input:
+    claimed = Path to the claimed job file. (String)
+    log_dir = Directory of the error reports. (String)
+    """
+    job_root = claimed[:claimed.rindex('.job')]
+    job_in = open(claimed,'r')
+    job = mm.to_str(json.load(job_in))
+    job_in.close()
+    try:
+        print('Running {0}: {1}'.format(job['task'],job['output']))
+        cf.scan_casalog(casalog)
+        nsevere = len(cf.casalog_index['severe'])
+        if globals()[job['task']](**job['params']) is False:
+            raise RuntimeError('{0} returned False for {1}.'.format(job['task'],job['output']))
+        cf.scan_casalog(casalog)
+        severe = cf.casalog_index['severe'][nsevere:]
+        if len(severe) > 0:
+            raise RuntimeError('{0} wrote severe errors to the CASA log for {1}:\n{2}'.format(job['task'],job['output'],'\n'.join(severe)))
+        if job['key'] is not None:
+            recorded = open(job['output']+'.hash','w')
+            recorded.write(job['key']+'\n')
+            recorded.close()
+        os.rename(claimed,job_root+'.done')
+    except Exception:
+        report = open(os.path.join(log_dir,os.path.basename(job_root)+'.failed'),'w')
+        report.write(traceback.format_exc())
+        report.close()
+        os.remove(claimed)
+
+
+queue_dir = sys.argv[-3]
+log_dir = sys.argv[-2]
+owner = int(sys.argv[-1])
+casalog.setlogfile(os.path.join(log_dir,'worker.{}.casa.log'.format(os.getpid())))
+while True:
+    claimed = claim_job(queue_dir)
+    if claimed is not None:
+        run_job(claimed,log_dir)
+    elif os.path.exists(os.path.join(queue_dir,'stop')) or not owner_alive(owner):
+        break
+    else:
+        time.sleep(0.5)
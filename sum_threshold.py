@@ -0,0 +1,173 @@
+import time
+import warnings
+import multiprocessing
+import numpy
+
+
+# Window lengths (in samples) of the SumThreshold passes
+windows = [1,2,4,8,16,32,64]
+
+# Factor by which the threshold is lowered each time the window length doubles
+rho = 1.5
+
+# Number of times the background and noise are estimated again (without the new flags) and the planes flagged again
+niter = 2
+
+# Columns that identify the chunks of rows (one scan of a field)
+chunk_cols = ['OBSERVATION_ID','ARRAY_ID','SCAN_NUMBER','FIELD_ID']
+
+
+def normalise(amp,flags):
+    """
+    Subtracts the background from the time-frequency planes of a baseline (the median spectrum over the scan, which removes
+    the bandpass and the source) and divides them by a robust estimate of the noise (from the median absolute deviation).
+    Flagged samples are ignored.
+
+    Input:
+    amp = Amplitudes (correlation, channel, time). (Float array)
+    flags = Flags (correlation, channel, time). (Boolean array)
+
+    Output:
+    norm = The residual amplitudes in units of the noise of each correlation (0 where flagged). (Float array)
+    """
+    masked = numpy.where(flags,numpy.nan,amp)
+    with warnings.catch_warnings():
+        # All-flagged channels and times give NaN medians
+        warnings.simplefilter('ignore',RuntimeWarning)
+        res = masked-numpy.nanmedian(masked,axis=2)[:,:,numpy.newaxis]
+        sigma = 1.4826*numpy.nanmedian(numpy.abs(res).reshape(len(res),-1),axis=1)
+    sigma = numpy.where(numpy.isfinite(sigma) & (sigma > 0),sigma,numpy.inf)
+    return numpy.nan_to_num(res/sigma[:,numpy.newaxis,numpy.newaxis])
+
+def window_hits(values,length,threshold,axis):
+    """
+    Finds the samples that are in a window (of consecutive samples along an axis) whose mean is above a threshold.
+
+    Input:
+    values = Time-frequency planes. (Float array)
+    length = Number of samples in each window. (Integer)
+    threshold = Threshold of the mean of a window. (Float)
+    axis = Axis along which the windows are taken. (Integer)
+
+    Output:
+    hits = Samples in at least one window above the threshold. (Boolean array)
+    """
+    nsamp = values.shape[axis]
+    if length > nsamp:
+        return numpy.zeros(values.shape,dtype=bool)
+    values = numpy.moveaxis(values,axis,-1)
+    pad = numpy.zeros(values.shape[:-1]+(1,))
+    csum = numpy.concatenate([pad,numpy.cumsum(values,axis=-1)],axis=-1)
+    # Windows are indexed by their first sample
+    above = (csum[...,length:]-csum[...,:-length]) > threshold*length
+    # A sample is hit if any of the windows starting up to length-1 samples before it is above the threshold
+    above = numpy.concatenate([above,numpy.zeros(values.shape[:-1]+(length-1,),dtype=bool)],axis=-1)
+    count = numpy.concatenate([numpy.zeros(values.shape[:-1]+(length,),dtype=int),numpy.cumsum(above,axis=-1)],axis=-1)
+    hits = (count[...,length:length+nsamp]-count[...,:nsamp]) > 0
+    return numpy.moveaxis(hits,-1,axis)
+
+def flag_plane(amp,flags,base_threshold):
+    """
+    Flags RFI in the time-frequency planes of a baseline with the SumThreshold method (Offringa et al. 2010, MNRAS 405, 155).
+    Windows of 1 to 64 samples along time and then along frequency are flagged if their mean is above a threshold that is
+    lowered by a factor rho each time the window length doubles. Samples that are already flagged count as being at the threshold.
+
+    Input:
+    amp = Amplitudes (correlation, channel, time). (Float array)
+    flags = Flags (correlation, channel, time). (Boolean array)
+    base_threshold = Threshold for single samples, in units of the noise. (Float)
+
+    Output:
+    flags = The new flags, including the existing ones. (Boolean array)
+    """
+    flags = flags.copy()
+    for iteration in range(niter):
+        norm = normalise(amp,flags)
+        for length in windows:
+            threshold = base_threshold/rho**numpy.log2(length)
+            for axis in [2,1]:
+                flags |= window_hits(numpy.where(flags,threshold,norm),length,threshold,axis)
+    return flags
+
+def flag_baseline(job):
+    """
+    Runs flag_plane for one baseline (arguments as a tuple so it can be used with a process pool).
+    """
+    return flag_plane(*job)
+
+def flag_ms(msfile,datacolumn,base_threshold,nproc,tb,logger):
+    """
+    Flags RFI in an MS with SumThreshold (see flag_plane), on the time-frequency plane of each baseline and correlation in each scan.
+    The data are read one scan of each data description at a time, and the baselines can be flagged in parallel by a process pool.
+    Autocorrelations are not flagged.
+
+    Input:
+    msfile = Path to the MS. (String)
+    datacolumn = Column of visibilities to flag on. (String)
+    base_threshold = Threshold for single samples, in units of the noise. (Float)
+    nproc = Number of processes in the pool, 1 to flag in this process. (Integer)
+    tb = The tb tool of the calling script.
+
+    Output:
+    nadded = Number of flags added. (Integer)
+    """
+    logger.info('Flagging {0} with SumThreshold on the {1} column (threshold {2} sigma, {3} process(es)).'.format(msfile,datacolumn,base_threshold,nproc))
+    t0 = time.time()
+    pool = None
+    if nproc > 1:
+        # Fork the pool before any table is opened, so the workers do not inherit the open (and writable) MS of the CASA process
+        pool = multiprocessing.Pool(nproc)
+    try:
+        tb.open(msfile+'/DATA_DESCRIPTION')
+        nddid = tb.nrows()
+        tb.close()
+        tb.open(msfile+'/ANTENNA')
+        nant = tb.nrows()
+        tb.close()
+        nadded = 0
+        nchunks = 0
+        tb.open(msfile,nomodify=False)
+        for ddid in range(nddid):
+            sub = tb.query('DATA_DESC_ID=={}'.format(ddid),columns=','.join(chunk_cols))
+            try:
+                if sub.nrows() == 0:
+                    continue
+                keys = sorted(set(zip(*[sub.getcol(col) for col in chunk_cols])))
+            finally:
+                sub.close()
+            for key in keys:
+                selection = ' && '.join(['{0}=={1}'.format(col,value) for col,value in zip(chunk_cols,key)])
+                chunk = tb.query('DATA_DESC_ID=={0} && {1}'.format(ddid,selection))
+                try:
+                    flags = chunk.getcol('FLAG')
+                    amp = numpy.abs(chunk.getcol(datacolumn)).astype('float32')
+                    ant1 = chunk.getcol('ANTENNA1')
+                    ant2 = chunk.getcol('ANTENNA2')
+                    baseline = ant1*nant+ant2
+                    order = numpy.lexsort((chunk.getcol('TIME'),baseline))
+                    bounds = numpy.flatnonzero(numpy.r_[True,baseline[order][1:] != baseline[order][:-1],True])
+                    rows = [order[bounds[i]:bounds[i+1]] for i in range(len(bounds)-1)]
+                    rows = [bl_rows for bl_rows in rows if ant1[bl_rows[0]] != ant2[bl_rows[0]]]
+                    jobs = [(amp[:,:,bl_rows],flags[:,:,bl_rows],base_threshold) for bl_rows in rows]
+                    if pool is None:
+                        results = [flag_baseline(job) for job in jobs]
+                    else:
+                        results = pool.map(flag_baseline,jobs)
+                    nflagged = numpy.count_nonzero(flags)
+                    for bl_rows,bl_flags in zip(rows,results):
+                        flags[:,:,bl_rows] = bl_flags
+                    added = numpy.count_nonzero(flags)-nflagged
+                    if added > 0:
+                        chunk.putcol('FLAG',flags)
+                        nadded += added
+                finally:
+                    chunk.close()
+                nchunks += 1
+        tb.flush()
+    finally:
+        tb.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info('SumThreshold added {0} flags in {1} scans in {2:.1f} s.'.format(nadded,nchunks,time.time()-t0))
+    return nadded
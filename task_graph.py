@@ -0,0 +1,119 @@
+import time
+import imp
+imp.load_source('plot_queue','plot_queue.py')
+import plot_queue as pq
+
+
+def new_graph():
+    """
+    Returns an empty graph of CASA tasks.
+
+    Output:
+    graph = The nodes (in the order they were added), and the return values of the nodes run in this process. (Dictionary)
+    """
+    return {'order': [], 'nodes': {}, 'results': {}}
+
+def add_node(graph,name,task,params,deps=[],kind='solve',inputs=[],local=False):
+    """
+    Adds a task to a graph. Nodes must be added after the nodes they depend on.
+
+    Input:
+    graph = The graph (from new_graph). (Dictionary)
+    name = Name of the node. (String)
+    task = Name of the CASA task. (String)
+    params = Parameters of the task. (Dictionary)
+    deps = Names of the nodes that must finish first. (List of Strings)
+    kind = 'solve' for tasks that later nodes or steps depend on, 'plot' for plots (which are handed to the plot queue). (String)
+    inputs = Paths of the files a plot depends on (see plot_queue.queue_plot). (List of Strings)
+    local = Run the task in this process (e.g. if its return value is needed). (Boolean)
+    """
+    for dep in deps:
+        if dep not in graph['nodes']:
+            raise ValueError('Node {0} depends on unknown node {1}.'.format(name,dep))
+    graph['order'].append(name)
+    graph['nodes'][name] = {'task': task, 'params': params, 'deps': list(deps), 'kind': kind, 'inputs': list(inputs), 'local': local}
+
+def log_graph(graph,logger):
+    """
+    Writes the nodes of a graph and their dependencies to the log.
+    """
+    logger.info('Task graph ({} nodes):'.format(len(graph['order'])))
+    for name in graph['order']:
+        node = graph['nodes'][name]
+        deps = ', '.join(node['deps'])
+        if deps == '':
+            deps = 'none'
+        logger.info('  {0} ({1} {2}) <- {3}'.format(name,node['kind'],node['task'],deps))
+
+def run_graph(graph,logger,namespace,check=None,poll=0.2):
+    """
+    Runs the nodes of a graph as soon as the nodes they depend on have finished. Solves are run by the CASA processes of
+    the plot queue, several at once (in this process, in order, if there are none or the node is local), and plots are
+    handed to the plot queue. A solve fails if it raises, returns False or (in the CASA processes) writes SEVERE lines
+    to the casa log. Nodes whose dependencies failed are skipped. The timing of each node is written to the log.
+
+    Input:
+    graph = The graph (from new_graph). (Dictionary)
+    namespace = The globals of the calling script (to run tasks in this process). (Dictionary)
+    check = Function called after each task run in this process (e.g. to check the CASA log). (Function)
+    poll = Interval between checks of the running nodes in seconds. (Float)
+
+    Output:
+    failed = Names of the nodes that failed or were skipped. (List of Strings)
+    """
+    log_graph(graph,logger)
+    pending = list(graph['order'])
+    running = {}
+    state = {}
+    timing = {}
+    t0 = time.time()
+    while len(pending) > 0 or len(running) > 0:
+        progress = False
+        for name in list(running.keys()):
+            job_state = pq.job_state(running[name])
+            if job_state == 'queued':
+                continue
+            state[name] = job_state
+            timing[name][1] = time.time()-t0
+            logger.info('Node {0} {1} after {2:.1f} s.'.format(name,job_state,timing[name][1]-timing[name][0]))
+            if job_state == 'failed':
+                logger.warning('Node {0} failed:\n{1}'.format(name,pq.job_report(running[name])))
+            del running[name]
+            progress = True
+        for name in list(pending):
+            node = graph['nodes'][name]
+            if len([dep for dep in node['deps'] if state.get(dep) in ['failed','skipped']]) > 0:
+                logger.warning('Skipping node {} as a node it depends on failed.'.format(name))
+                state[name] = 'skipped'
+            elif len([dep for dep in node['deps'] if state.get(dep) != 'done']) > 0:
+                continue
+            elif node['kind'] == 'plot':
+                timing[name] = [time.time()-t0,None]
+                pq.queue_plot(node['task'],node['params'],node['inputs'],logger,namespace)
+                timing[name][1] = time.time()-t0
+                state[name] = 'done'
+            elif node['local'] or pq.queue['nworkers'] == 0:
+                timing[name] = [time.time()-t0,None]
+                logger.info('Running node {0}: {1}({2})'.format(name,node['task'],node['params']))
+                result = namespace[node['task']](**node['params'])
+                graph['results'][name] = result
+                if check is not None:
+                    check()
+                state[name] = 'failed' if result is False else 'done'
+                timing[name][1] = time.time()-t0
+                logger.info('Node {0} {1} after {2:.1f} s.'.format(name,state[name],timing[name][1]-timing[name][0]))
+            else:
+                timing[name] = [time.time()-t0,None]
+                logger.info('Queued node {0}: {1}({2})'.format(name,node['task'],node['params']))
+                running[name] = pq.submit_job(node['task'],node['params'],name,logger,prefix='calib')
+            pending.remove(name)
+            progress = True
+        if not progress:
+            time.sleep(poll)
+    logger.info('Task graph finished in {:.1f} s:'.format(time.time()-t0))
+    for name in graph['order']:
+        if name in timing:
+            logger.info('  {0}: {1}, started at {2:.1f} s, took {3:.1f} s'.format(name,state[name],timing[name][0],timing[name][1]-timing[name][0]))
+        else:
+            logger.info('  {0}: {1}'.format(name,state[name]))
+    return [name for name in graph['order'] if state[name] != 'done']
@@ -0,0 +1,141 @@
+import os
+import sys
+import numpy
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+
+# In-memory stand-in for the parts of the CASA table tool (tb) used by the NumPy kernels of the pipeline, so they can be
+# tested without CASA. Tables are dictionaries of columns (the row axis last) registered under a path.
+
+tables = {}
+
+
+def make_ms(msfile,ddids,nant=4,seed=0):
+    """
+    Registers a small MS with random flags.
+
+    Input:
+    msfile = Path of the MS. (String)
+    ddids = Number of rows, polarizations and channels of each data description. (List of Tuples)
+    nant = Number of antennas. (Integer)
+    seed = Seed of the random flags. (Integer)
+
+    Output:
+    main = The columns of the main table. (Dictionary)
+    """
+    rng = numpy.random.RandomState(seed)
+    main = {'DATA_DESC_ID': [], 'FLAG_ROW': [], 'ANTENNA1': [], 'ANTENNA2': [], 'FLAG': []}
+    for ddid,(nrow,npol,nchan) in enumerate(ddids):
+        main['DATA_DESC_ID'].append(numpy.full(nrow,ddid,dtype=int))
+        main['FLAG_ROW'].append(rng.rand(nrow) < 0.1)
+        main['ANTENNA1'].append(rng.randint(0,nant,nrow))
+        main['ANTENNA2'].append(rng.randint(0,nant,nrow))
+        main['FLAG'].append(rng.rand(npol,nchan,nrow) < 0.3)
+    # The FLAG cells of different data descriptions have different shapes, so they are kept per row
+    main['FLAG'] = [flags[:,:,row] for flags in main['FLAG'] for row in range(flags.shape[2])]
+    for col in ['DATA_DESC_ID','FLAG_ROW','ANTENNA1','ANTENNA2']:
+        main[col] = numpy.concatenate(main[col])
+    tables[msfile] = main
+    tables[msfile+'/DATA_DESCRIPTION'] = {'SPECTRAL_WINDOW_ID': numpy.arange(len(ddids))}
+    tables[msfile+'/ANTENNA'] = {'NAME': numpy.array(['ea{:02d}'.format(i) for i in range(nant)])}
+    return main
+
+def table_rows(table):
+    """
+    Returns the number of rows of a table.
+    """
+    values = list(table.values())[0]
+    if isinstance(values,list):
+        return len(values)
+    return values.shape[-1]
+
+def column(table,col,rows):
+    """
+    Returns a column of some rows of a table as CASA does (cells stacked along the last axis).
+    """
+    values = table[col]
+    if isinstance(values,list):
+        return numpy.stack([values[row] for row in rows],axis=-1)
+    return values[...,rows].copy()
+
+
+class Selection(object):
+    """
+    The rows of a table selected by a query (or all of them).
+    """
+
+    def __init__(self,table,rows):
+        self.table = table
+        self.rows = rows
+
+    def nrows(self):
+        return len(self.rows)
+
+    def getcol(self,col,startrow=0,nrow=-1):
+        if nrow < 0:
+            nrow = len(self.rows)-startrow
+        return column(self.table,col,self.rows[startrow:startrow+nrow])
+
+    def getcell(self,col,row):
+        return column(self.table,col,self.rows[row:row+1])[...,0]
+
+    def putcol(self,col,value,startrow=0,nrow=-1):
+        if nrow < 0:
+            nrow = len(self.rows)-startrow
+        rows = self.rows[startrow:startrow+nrow]
+        if isinstance(self.table[col],list):
+            for i,row in enumerate(rows):
+                self.table[col][row] = numpy.array(value[...,i])
+        else:
+            self.table[col][...,rows] = value
+
+    def close(self):
+        pass
+
+
+class TableTool(Selection):
+    """
+    The table tool: open, query, close and flush, with the methods of a selection for the open table.
+    Queries are conjunctions of 'COLUMN==value' terms joined by '&&'.
+    """
+
+    def __init__(self):
+        self.table = None
+        self.rows = None
+        self.path = None
+
+    def open(self,path,nomodify=True):
+        self.path = path
+        self.table = tables[path]
+        self.rows = numpy.arange(table_rows(self.table))
+
+    def query(self,expression,columns=''):
+        keep = numpy.ones(len(self.rows),dtype=bool)
+        for term in expression.split('&&'):
+            col,value = term.split('==')
+            keep &= column(self.table,col.strip(),self.rows) == float(value)
+        return Selection(self.table,self.rows[keep])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.table = None
+        self.rows = None
+        self.path = None
+
+
+class Logger(object):
+    """
+    Logger that keeps the messages.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self,message):
+        self.messages.append(('info',message))
+
+    def warning(self,message):
+        self.messages.append(('warning',message))
@@ -0,0 +1,58 @@
+import unittest
+import casa_tables  # Adds the pipeline scripts to the path
+import applycal_plan as ap
+
+
+class ApplycalPlanTest(unittest.TestCase):
+
+    def selected(self,calls):
+        """
+        Returns the tables applied to each (field, SPW) by a list of calls, checking that none is selected twice.
+        """
+        applied = {}
+        for call in calls:
+            for field in call['field'].split(','):
+                for spw in call['spw'].split(','):
+                    self.assertNotIn((field,int(spw)),applied)
+                    applied[(field,int(spw))] = (call['gaintable'],call['gainfield'])
+        return applied
+
+    def test_same_tables_share_a_call(self):
+        plan = ap.new_plan()
+        ap.request(plan,'3C286',[0,1],['a.tbl','b.tbl'],['','3C286'])
+        ap.request(plan,'J1331',[0,1],['a.tbl','b.tbl'],['','3C286'])
+        ap.request(plan,'HCG16',[0,1],['a.tbl','c.tbl'],['','J0238'])
+        ap.request(plan,'HCG31',[0,1],['a.tbl','c.tbl'],['','J0238'])
+        calls = ap.calls(plan)
+        self.assertEqual(plan['requests'],4)
+        self.assertEqual(len(calls),2)
+        self.assertEqual(calls[0],{'field': '3C286,J1331', 'spw': '0,1', 'gaintable': ['a.tbl','b.tbl'], 'gainfield': ['','3C286']})
+        self.assertEqual(calls[1],{'field': 'HCG16,HCG31', 'spw': '0,1', 'gaintable': ['a.tbl','c.tbl'], 'gainfield': ['','J0238']})
+
+    def test_different_solution_fields_are_kept_apart(self):
+        plan = ap.new_plan()
+        ap.request(plan,'HCG16',[0],['a.tbl'],['J0238'])
+        ap.request(plan,'HCG31',[0],['a.tbl'],['J0423'])
+        applied = self.selected(ap.calls(plan))
+        self.assertEqual(applied[('HCG16',0)],(['a.tbl'],['J0238']))
+        self.assertEqual(applied[('HCG31',0)],(['a.tbl'],['J0423']))
+
+    def test_fields_in_different_spws(self):
+        plan = ap.new_plan()
+        ap.request(plan,'HCG16',[0,1],['a.tbl'],[''])
+        ap.request(plan,'HCG31',[1],['a.tbl'],[''])
+        calls = ap.calls(plan)
+        self.assertEqual(len(calls),2)
+        self.assertEqual(sorted(self.selected(calls).keys()),[('HCG16',0),('HCG16',1),('HCG31',1)])
+
+    def test_later_request_replaces_earlier(self):
+        plan = ap.new_plan()
+        ap.request(plan,'3C286',[0,1],['a.tbl'],[''])
+        ap.request(plan,'3C286',[1],['a.tbl','flux.tbl'],['','3C286'])
+        applied = self.selected(ap.calls(plan))
+        self.assertEqual(applied[('3C286',0)],(['a.tbl'],['']))
+        self.assertEqual(applied[('3C286',1)],(['a.tbl','flux.tbl'],['','3C286']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import numpy
+import casa_tables
+import flag_stats as fs
+
+
+class FlagStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.msfile = 'flag_stats_test.ms'
+        self.main = casa_tables.make_ms(self.msfile,[(40,2,8),(30,4,3)],nant=5,seed=6)
+        rng = numpy.random.RandomState(7)
+        nrow = len(self.main['FLAG'])
+        self.main['FIELD_ID'] = rng.randint(0,3,nrow)
+        self.main['SCAN_NUMBER'] = rng.choice([2,5,9],nrow)
+        self.t_start = 5.E9
+        self.main['TIME'] = self.t_start+rng.uniform(0.,2000.,nrow)
+        # The second data description is SPW 2 (SPW 1 has no data)
+        casa_tables.tables[self.msfile+'/DATA_DESCRIPTION'] = {'SPECTRAL_WINDOW_ID': numpy.array([0,2])}
+        self.meta = {'antennas': ['ea{:02d}'.format(i) for i in range(5)], 'nspw': 3, 'fields': ['3C286','J0238','HCG16'],
+                     'scans': [{'scan': 9},{'scan': 2},{'scan': 5},{'scan': 2}],
+                     'obs_time_ranges': [[self.t_start,self.t_start+1000.],[self.t_start+1000.,self.t_start+2000.]]}
+        self.chunk_bytes = fs.chunk_bytes
+        fs.chunk_bytes = 50
+
+    def tearDown(self):
+        fs.chunk_bytes = self.chunk_bytes
+
+    def test_counts(self):
+        stats = fs.flag_stats(self.msfile,self.meta,casa_tables.TableTool(),casa_tables.Logger())
+        spws = [0,2]
+        expected = dict((key,numpy.zeros(shape)) for key,shape in [('antenna',5),('baseline',(5,5)),('spw',3),('field',3),
+                                                                   ('scan',3),('time',4)])
+        expected_total = dict((key,numpy.zeros(array.shape)) for key,array in expected.items())
+        scans = [2,5,9]
+        for row in range(len(self.main['FLAG'])):
+            flagged = numpy.sum(self.main['FLAG'][row])
+            total = self.main['FLAG'][row].size
+            ant1 = self.main['ANTENNA1'][row]
+            ant2 = self.main['ANTENNA2'][row]
+            for counts,value in [(expected,flagged),(expected_total,total)]:
+                counts['antenna'][ant1] += value
+                counts['antenna'][ant2] += value
+                counts['baseline'][ant1,ant2] += value
+                counts['spw'][spws[self.main['DATA_DESC_ID'][row]]] += value
+                counts['field'][self.main['FIELD_ID'][row]] += value
+                counts['scan'][scans.index(self.main['SCAN_NUMBER'][row])] += value
+                counts['time'][int((self.main['TIME'][row]-self.t_start)//fs.time_bin)] += value
+        for axis in expected:
+            numpy.testing.assert_array_equal(stats[axis+'_flagged'],expected[axis])
+            numpy.testing.assert_array_equal(stats[axis+'_total'],expected_total[axis])
+        numpy.testing.assert_array_equal(stats['scan_numbers'],scans)
+        numpy.testing.assert_array_equal(stats['time_starts'],self.t_start+fs.time_bin*numpy.arange(4))
+        self.assertEqual(numpy.sum(stats['spw_total']),sum(flags.size for flags in self.main['FLAG']))
+
+    def test_fraction(self):
+        numpy.testing.assert_array_equal(fs.fraction([0.,3.,2.],[0.,4.,2.]),[0.,0.75,1.])
+
+
+if __name__ == '__main__':
+    unittest.main()
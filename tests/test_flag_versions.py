@@ -0,0 +1,154 @@
+import shutil
+import tempfile
+import unittest
+import numpy
+import casa_tables
+import flag_versions as fv
+
+
+class EncodeChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        self.flags = rng.rand(2,16,50) < 0.3
+        self.flag_row = rng.rand(50) < 0.1
+
+    def test_full_without_parent(self):
+        packed,arrays = fv.encode_chunk(self.flags,self.flag_row,None)
+        self.assertEqual(sorted(arrays.keys()),['full','row'])
+        numpy.testing.assert_array_equal(numpy.unpackbits(arrays['full'])[:self.flags.size].astype(bool),self.flags.ravel())
+        numpy.testing.assert_array_equal(numpy.unpackbits(arrays['row'])[:len(self.flag_row)].astype(bool),self.flag_row)
+
+    def test_sparse_change_is_a_delta(self):
+        parent = fv.encode_chunk(self.flags,self.flag_row,None)[0]
+        flags = self.flags.copy()
+        flags[0,3,7] = not flags[0,3,7]
+        flags[1,:,20] = True
+        packed,arrays = fv.encode_chunk(flags,self.flag_row,parent)
+        self.assertNotIn('full',arrays)
+        rebuilt = parent.copy()
+        rebuilt[arrays['idx']] ^= arrays['val']
+        numpy.testing.assert_array_equal(rebuilt,packed)
+        numpy.testing.assert_array_equal(numpy.unpackbits(rebuilt)[:flags.size].astype(bool),flags.ravel())
+
+    def test_dense_change_is_stored_in_full(self):
+        parent = fv.encode_chunk(self.flags,self.flag_row,None)[0]
+        packed,arrays = fv.encode_chunk(~self.flags,self.flag_row,parent)
+        self.assertIn('full',arrays)
+        numpy.testing.assert_array_equal(arrays['full'],packed)
+
+
+class FlagStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.msfile = self.tmp_dir+'/test.ms'
+        # Two data descriptions of different shapes, each split into several chunks
+        self.main = casa_tables.make_ms(self.msfile,[(37,2,8),(23,4,3)])
+        self.chunk_flags = fv.chunk_flags
+        fv.chunk_flags = 64
+        self.tb = casa_tables.TableTool()
+        self.logger = casa_tables.Logger()
+        self.rng = numpy.random.RandomState(2)
+
+    def tearDown(self):
+        fv.chunk_flags = self.chunk_flags
+        shutil.rmtree(self.tmp_dir)
+
+    def current(self):
+        return [flags.copy() for flags in self.main['FLAG']],self.main['FLAG_ROW'].copy()
+
+    def change(self,nflags):
+        """
+        Flags some more random visibilities and rows.
+        """
+        for row in self.rng.randint(0,len(self.main['FLAG']),nflags):
+            flags = self.main['FLAG'][row]
+            flags[self.rng.randint(flags.shape[0]),self.rng.randint(flags.shape[1])] = True
+        self.main['FLAG_ROW'][self.rng.randint(0,len(self.main['FLAG_ROW']))] = True
+
+    def clear(self):
+        for flags in self.main['FLAG']:
+            flags[...] = False
+        self.main['FLAG_ROW'][...] = False
+
+    def assert_flags(self,expected):
+        for flags,expected_flags in zip(self.main['FLAG'],expected[0]):
+            numpy.testing.assert_array_equal(flags,expected_flags)
+        numpy.testing.assert_array_equal(self.main['FLAG_ROW'],expected[1])
+
+    def save(self,name):
+        fv.save_version(self.msfile,name,self.tb,self.logger)
+        return self.current()
+
+    def restore(self,name):
+        self.clear()
+        fv.restore_version(self.msfile,name,self.tb,self.logger)
+
+    def test_round_trip(self):
+        original = self.save('Original')
+        self.change(10)
+        initial = self.save('initial')
+        self.assertEqual(fv.read_index(self.msfile)['versions']['initial']['parent'],'Original')
+        self.restore('Original')
+        self.assert_flags(original)
+        self.restore('initial')
+        self.assert_flags(initial)
+
+    def test_delta_against_restored_version(self):
+        original = self.save('Original')
+        self.change(10)
+        self.save('initial')
+        self.restore('Original')
+        self.change(5)
+        rflag = self.save('rflag')
+        self.assertEqual(fv.read_index(self.msfile)['versions']['rflag']['parent'],'Original')
+        self.restore('rflag')
+        self.assert_flags(rflag)
+        self.restore('Original')
+        self.assert_flags(original)
+
+    def test_remove_folds_deltas_into_children(self):
+        original = self.save('Original')
+        self.change(10)
+        self.save('initial')
+        self.change(10)
+        extended = self.save('extended')
+        fv.remove_version(self.msfile,'initial',self.logger)
+        index = fv.read_index(self.msfile)
+        self.assertNotIn('initial',index['versions'])
+        self.assertEqual(index['versions']['extended']['parent'],'Original')
+        self.restore('extended')
+        self.assert_flags(extended)
+        self.restore('Original')
+        self.assert_flags(original)
+
+    def test_remove_current_version(self):
+        self.save('Original')
+        self.change(10)
+        self.save('initial')
+        fv.remove_version(self.msfile,'initial',self.logger)
+        self.assertEqual(fv.read_index(self.msfile)['current'],'Original')
+        self.change(10)
+        final = self.save('final')
+        self.restore('final')
+        self.assert_flags(final)
+
+    def test_save_replaces_version(self):
+        self.save('Original')
+        self.change(10)
+        self.save('initial')
+        self.change(10)
+        initial = self.save('initial')
+        self.assertEqual(sorted(fv.read_index(self.msfile)['versions'].keys()),['Original','initial'])
+        self.restore('initial')
+        self.assert_flags(initial)
+
+    def test_restore_after_shape_change(self):
+        self.save('Original')
+        casa_tables.make_ms(self.msfile,[(40,2,8),(23,4,3)])
+        self.assertRaises(ValueError,fv.restore_version,self.msfile,'Original',self.tb,self.logger)
+
+
+if __name__ == '__main__':
+    unittest.main()
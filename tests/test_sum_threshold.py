@@ -0,0 +1,121 @@
+import itertools
+import unittest
+import numpy
+import casa_tables
+import sum_threshold as st
+
+
+def noise_plane(rng,npol=2,nchan=64,ntime=80):
+    """
+    Returns the amplitudes of a time-frequency plane of complex noise around a bandpass shape.
+    """
+    bandpass = 10.+numpy.sin(numpy.linspace(0.,3.,nchan))[numpy.newaxis,:,numpy.newaxis]
+    noise = rng.normal(size=(npol,nchan,ntime))+1j*rng.normal(size=(npol,nchan,ntime))
+    return numpy.abs(bandpass+noise)
+
+
+class WindowHitsTest(unittest.TestCase):
+
+    def test_brute_force(self):
+        rng = numpy.random.RandomState(3)
+        for trial in range(50):
+            values = rng.normal(size=(2,5,rng.randint(1,30)))
+            length = rng.randint(1,10)
+            threshold = rng.uniform(-0.5,1.5)
+            axis = rng.randint(1,3)
+            expected = numpy.zeros(values.shape,dtype=bool)
+            moved = numpy.moveaxis(values,axis,-1)
+            hits = numpy.moveaxis(expected,axis,-1)
+            for start in range(moved.shape[-1]-length+1):
+                above = moved[...,start:start+length].mean(axis=-1) > threshold
+                hits[...,start:start+length] |= above[...,numpy.newaxis]
+            numpy.testing.assert_array_equal(st.window_hits(values,length,threshold,axis),expected)
+
+
+class FlagPlaneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(4)
+        self.amp = noise_plane(self.rng)
+        self.flags = numpy.zeros(self.amp.shape,dtype=bool)
+
+    def test_clean_noise(self):
+        flags = st.flag_plane(self.amp,self.flags,6.0)
+        self.assertLess(numpy.mean(flags),0.001)
+
+    def test_faint_line(self):
+        # A narrowband line at 2 sigma in every sample is well below the single sample threshold
+        self.amp[:,20,10:60] += 2.*numpy.sqrt(2.)
+        flags = st.flag_plane(self.amp,self.flags,6.0)
+        self.assertTrue(numpy.all(flags[:,20,10:60]))
+        self.assertLess(numpy.mean(numpy.delete(flags,20,axis=1)),0.001)
+
+    def test_broadband_burst(self):
+        self.amp[:,:,30:32] += 3.*numpy.sqrt(2.)
+        flags = st.flag_plane(self.amp,self.flags,6.0)
+        self.assertTrue(numpy.all(flags[:,:,30:32]))
+        self.assertLess(numpy.mean(numpy.delete(flags,[30,31],axis=2)),0.001)
+
+    def test_spike(self):
+        self.amp[0,40,5] += 50.
+        flags = st.flag_plane(self.amp,self.flags,6.0)
+        self.assertTrue(flags[0,40,5])
+        self.assertFalse(flags[1,40,5])
+
+    def test_existing_flags_kept(self):
+        self.flags[1,:10,:] = True
+        flags = st.flag_plane(self.amp,self.flags,6.0)
+        self.assertTrue(numpy.all(flags[1,:10,:]))
+        self.assertFalse(numpy.any(self.flags[0]))
+
+
+class FlagMSTest(unittest.TestCase):
+
+    def setUp(self):
+        self.msfile = 'sumthreshold_test.ms'
+        rng = numpy.random.RandomState(5)
+        nant = 4
+        ntime = 60
+        baselines = list(itertools.combinations_with_replacement(range(nant),2))
+        rows = [(scan,t,ant1,ant2) for scan in [1,2] for t in range(ntime) for ant1,ant2 in baselines]
+        # Rows in time order, as in an MS
+        scan,times,ant1,ant2 = [numpy.array(col) for col in zip(*rows)]
+        nrow = len(rows)
+        amp = noise_plane(rng,nchan=32,ntime=nrow)
+        # RFI line for part of the second scan (a line that lasts a whole scan is taken as part of the spectrum)
+        line = (scan == 2) & (times >= 10) & (times < 25)
+        amp[:,12,line] += 3.*numpy.sqrt(2.)
+        self.line = line
+        self.main = {'DATA': amp.astype('complex64'), 'FLAG': numpy.zeros(amp.shape,dtype=bool),
+                     'DATA_DESC_ID': numpy.zeros(nrow,dtype=int), 'OBSERVATION_ID': numpy.zeros(nrow,dtype=int),
+                     'ARRAY_ID': numpy.zeros(nrow,dtype=int), 'SCAN_NUMBER': scan, 'FIELD_ID': numpy.zeros(nrow,dtype=int),
+                     'TIME': times+1.E9+1000.*scan, 'ANTENNA1': ant1, 'ANTENNA2': ant2}
+        self.main['FLAG'][:,:2,:] = True
+        casa_tables.tables[self.msfile] = self.main
+        casa_tables.tables[self.msfile+'/DATA_DESCRIPTION'] = {'SPECTRAL_WINDOW_ID': numpy.zeros(1,dtype=int)}
+        casa_tables.tables[self.msfile+'/ANTENNA'] = {'NAME': numpy.arange(nant)}
+        self.auto = ant1 == ant2
+
+    def flag(self,nproc):
+        initial = self.main['FLAG'].copy()
+        nadded = st.flag_ms(self.msfile,'DATA',6.0,nproc,casa_tables.TableTool(),casa_tables.Logger())
+        self.assertEqual(nadded,numpy.count_nonzero(self.main['FLAG'])-numpy.count_nonzero(initial))
+        self.assertTrue(numpy.all(self.main['FLAG'][initial]))
+        return self.main['FLAG'].copy()
+
+    def test_flags_line_in_cross_correlations(self):
+        flags = self.flag(1)
+        cross = ~self.auto
+        self.assertTrue(numpy.all(flags[:,12,cross & self.line]))
+        self.assertLess(numpy.mean(flags[:,12,cross & ~self.line]),0.01)
+        # Autocorrelations are not flagged
+        numpy.testing.assert_array_equal(flags[:,2:,self.auto],False)
+
+    def test_pool_matches_serial(self):
+        serial = self.flag(1)
+        self.main['FLAG'][:,2:,:] = False
+        numpy.testing.assert_array_equal(self.flag(3),serial)
+
+
+if __name__ == '__main__':
+    unittest.main()
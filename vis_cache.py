@@ -0,0 +1,316 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy
+
+
+# Version of the cache layout, increase when the contents change so that old caches are rebuilt
+cache_version = 1
+
+# Width of the time bins of the cached time series in seconds
+time_bin = 60.
+
+# Approximate number of visibilities read at once
+chunk_vis = 2**23
+
+# Names of the CASA correlation types
+corr_names = {5: 'RR', 6: 'RL', 7: 'LR', 8: 'LL', 9: 'XX', 10: 'XY', 11: 'YX', 12: 'YY'}
+
+
+def cache_dir(msfile,column):
+    """
+    Returns the directory of the visibility cache of a data column of an MS.
+    """
+    return os.path.join(msfile.rstrip('/')+'.viscache',column.lower())
+
+def ms_state(msfile):
+    """
+    Returns a hash of the sizes and modification times of the files of the main table of an MS, which change when the data or flags are written.
+
+    Input:
+    msfile = Path to the MS. (String)
+
+    Output:
+    SHA1 hash of the state of the MS. (String)
+    """
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(msfile)):
+        path = os.path.join(msfile,name)
+        if name == 'table.lock' or os.path.isdir(path):
+            continue
+        sha.update('{0} {1} {2!r}'.format(name,os.path.getsize(path),os.path.getmtime(path)).encode('utf-8'))
+    return sha.hexdigest()
+
+def data_column(msfile,tb,column='CORRECTED_DATA'):
+    """
+    Returns the data column to use, falling back to DATA if the MS has no such column (as plotms does).
+    """
+    tb.open(msfile)
+    columns = tb.colnames()
+    tb.close()
+    if column in columns:
+        return column
+    return 'DATA'
+
+def entries_for(msfile,column,index,fields=None,spws=None):
+    """
+    Reads the cache entries of a set of fields and SPWs (all observations).
+
+    Input:
+    msfile = Path to the MS. (String)
+    column = The data column. (String)
+    index = The index of the cache (see build_cache). (Dictionary)
+    fields = Field names, None for all. (List of Strings)
+    spws = SPW IDs, None for all. (List of Integers)
+
+    Output:
+    entries = Pairs of ((observation, field, SPW), entry). (List of Tuples)
+    """
+    entries = []
+    for obs,field,spw,name in index['entries']:
+        if (fields is None or field in fields) and (spws is None or spw in spws):
+            entries.append(((obs,field,spw),load_entry(msfile,column,obs,field,spw)))
+    return entries
+
+def read_index(msfile,column):
+    """
+    Reads the index of a visibility cache (the state of the MS it was made from and the list of entries).
+
+    Output:
+    index = The index, None if there is no cache. (Dictionary)
+    """
+    index_file = os.path.join(cache_dir(msfile,column),'index.json')
+    if not os.path.exists(index_file):
+        return None
+    index = open(index_file,'r')
+    try:
+        return json.load(index)
+    except ValueError:
+        return None
+    finally:
+        index.close()
+
+def entry_file(msfile,column,obs,field,spw):
+    """
+    Returns the path of the cache entry of one observation, field and SPW.
+    """
+    return os.path.join(cache_dir(msfile,column),'o{0}_f{1}_s{2}.npz'.format(obs,field,spw))
+
+def new_entry(nbl,npol,nchan,ntime):
+    """
+    Returns empty accumulators for one observation, field and SPW.
+    Sums of the unflagged ('good') and flagged ('bad') visibilities are kept separately, with the number of unflagged visibilities and of rows.
+    """
+    return {'spec_good': numpy.zeros((npol,nchan,nbl),dtype='complex64'),
+            'spec_bad': numpy.zeros((npol,nchan,nbl),dtype='complex64'),
+            'spec_ngood': numpy.zeros((npol,nchan,nbl),dtype='float32'),
+            'spec_nrows': numpy.zeros(nbl),
+            'ts_good': numpy.zeros((npol,nbl*ntime),dtype='complex64'),
+            'ts_bad': numpy.zeros((npol,nbl*ntime),dtype='complex64'),
+            'ts_ngood': numpy.zeros((npol,nbl*ntime),dtype='float32'),
+            'ts_nrows': numpy.zeros(nbl*ntime)}
+
+def accumulate(entry,vis,flag,blc,tbin,ntime):
+    """
+    Adds a chunk of rows to the time-averaged spectra and channel-averaged time series of each baseline.
+
+    Input:
+    entry = The accumulators (see new_entry). (Dictionary)
+    vis = Visibilities of the rows. (Complex array, polarization x channel x row)
+    flag = Flags of the rows. (Boolean array, polarization x channel x row)
+    blc = Baseline index of each row. (Integer array)
+    tbin = Time bin of each row. (Integer array)
+    ntime = Number of time bins. (Integer)
+    """
+    good = numpy.where(flag,0,vis)
+    bad = numpy.where(flag,vis,0)
+    ngood = numpy.logical_not(flag).astype('float32')
+    order = numpy.argsort(blc,kind='mergesort')
+    bls,starts = numpy.unique(blc[order],return_index=True)
+    for name,values in [('spec_good',good),('spec_bad',bad),('spec_ngood',ngood)]:
+        entry[name][:,:,bls] += numpy.add.reduceat(values[:,:,order],starts,axis=2)
+    entry['spec_nrows'] += numpy.bincount(blc,minlength=len(entry['spec_nrows']))
+    cell = blc*ntime+tbin
+    ncell = len(entry['ts_nrows'])
+    for pol in range(vis.shape[0]):
+        for name,values in [('ts_good',good),('ts_bad',bad)]:
+            chan_sum = values[pol].sum(axis=0)
+            entry[name][pol] += numpy.bincount(cell,weights=chan_sum.real,minlength=ncell)+1j*numpy.bincount(cell,weights=chan_sum.imag,minlength=ncell)
+        entry['ts_ngood'][pol] += numpy.bincount(cell,weights=ngood[pol].sum(axis=0),minlength=ncell)
+    entry['ts_nrows'] += numpy.bincount(cell,minlength=ncell)
+
+def save_entry(entry,entry_path,nant,ntime,t_start,time_scans,freqs,corrs,antennas):
+    """
+    Saves the baselines and time bins of an entry that contain data.
+    """
+    npol = entry['spec_good'].shape[0]
+    nbl = len(entry['spec_nrows'])
+    used = numpy.flatnonzero(entry['spec_nrows'])
+    ts_nrows = entry['ts_nrows'].reshape(nbl,ntime)[used]
+    times = numpy.flatnonzero(ts_nrows.sum(axis=0))
+    arrays = {'baselines': numpy.transpose([used//nant,used % nant]),
+              'times': t_start+time_bin*(times+0.5),
+              'scans': time_scans[times],
+              'freqs': freqs,
+              'corrs': numpy.array(corrs),
+              'antennas': numpy.array(antennas),
+              'spec_nrows': entry['spec_nrows'][used],
+              'ts_nrows': ts_nrows[:,times]}
+    for name in ['spec_good','spec_bad','spec_ngood']:
+        arrays[name] = entry[name][:,:,used]
+    for name in ['ts_good','ts_bad','ts_ngood']:
+        arrays[name] = entry[name].reshape(npol,nbl,ntime)[:,used][:,:,times]
+    numpy.savez_compressed(entry_path,**arrays)
+
+def build_cache(msfile,column,meta,tb,logger,fields=None):
+    """
+    Reduces the visibilities of an MS to time-averaged spectra and channel-averaged time series (in bins of time_bin seconds)
+    of each baseline and correlation, for each observation, field and SPW. The data column and FLAG are read once, in chunks of rows.
+    The cache is only rebuilt if the MS has changed (e.g. new flags or calibration) or it does not contain the requested fields.
+
+    Input:
+    msfile = Path to the MS. (String)
+    column = Data column to reduce ('DATA' or 'CORRECTED_DATA'). (String)
+    meta = The metadata of the MS (see ms_metadata.py). (Dictionary)
+    tb = The tb tool of the calling script.
+    fields = Names of the fields to reduce, None for all. (List of Strings)
+
+    Output:
+    index = The index of the cache. (Dictionary)
+    """
+    cdir = cache_dir(msfile,column)
+    state = ms_state(msfile)
+    field_ids = None
+    if fields is not None:
+        field_ids = sorted(set(meta['fields'].index(field) for field in fields))
+    index = read_index(msfile,column)
+    if (index is not None and index['version'] == cache_version and index['state'] == state and index['time_bin'] == time_bin
+        and (index['field_ids'] is None or (field_ids is not None and set(field_ids) <= set(index['field_ids'])))):
+        logger.info('Visibility cache {} is up to date.'.format(cdir))
+        return index
+    logger.info('Reducing the {0} column of {1} to the visibility cache {2}.'.format(column,msfile,cdir))
+    if os.path.isdir(cdir):
+        shutil.rmtree(cdir)
+    os.makedirs(cdir)
+    nant = len(meta['antennas'])
+    t_start = min(time_range[0] for time_range in meta['obs_time_ranges'])
+    t_end = max(time_range[1] for time_range in meta['obs_time_ranges'])
+    ntime = int((t_end-t_start)//time_bin)+1
+    time_scans = numpy.zeros(ntime,dtype=int)
+    for scan in meta['scans']:
+        time_scans[int((scan['start']-t_start)//time_bin):int((scan['end']-t_start)//time_bin)+1] = scan['scan']
+    tb.open(msfile+'/DATA_DESCRIPTION')
+    ddid_spws = tb.getcol('SPECTRAL_WINDOW_ID')
+    ddid_pols = tb.getcol('POLARIZATION_ID')
+    tb.close()
+    tb.open(msfile+'/POLARIZATION')
+    pol_corrs = [[corr_names.get(int(corr),str(corr)) for corr in tb.getcell('CORR_TYPE',i)] for i in range(tb.nrows())]
+    tb.close()
+    entries = []
+    tb.open(msfile)
+    try:
+        for ddid in range(len(ddid_spws)):
+            spw = int(ddid_spws[ddid])
+            for field_id in range(len(meta['fields'])):
+                if field_ids is not None and field_id not in field_ids:
+                    continue
+                # One field at a time keeps the accumulators small, each row is still only read once
+                sub = tb.query('DATA_DESC_ID=={0} && FIELD_ID=={1}'.format(ddid,field_id))
+                try:
+                    nrows = sub.nrows()
+                    if nrows == 0:
+                        continue
+                    npol,nchan = sub.getcell('FLAG',0).shape
+                    step = max(1,int(chunk_vis//(npol*nchan)))
+                    accumulators = {}
+                    for start in range(0,nrows,step):
+                        nrow = min(step,nrows-start)
+                        vis = sub.getcol(column,startrow=start,nrow=nrow)
+                        flag = sub.getcol('FLAG',startrow=start,nrow=nrow)
+                        blc = sub.getcol('ANTENNA1',startrow=start,nrow=nrow)*nant+sub.getcol('ANTENNA2',startrow=start,nrow=nrow)
+                        tbin = numpy.clip(((sub.getcol('TIME',startrow=start,nrow=nrow)-t_start)//time_bin).astype(int),0,ntime-1)
+                        obs_ids = sub.getcol('OBSERVATION_ID',startrow=start,nrow=nrow)
+                        for obs in numpy.unique(obs_ids):
+                            rows = numpy.flatnonzero(obs_ids == obs)
+                            if obs not in accumulators:
+                                accumulators[obs] = new_entry(nant*nant,npol,nchan,ntime)
+                            accumulate(accumulators[obs],vis[:,:,rows],flag[:,:,rows],blc[rows],tbin[rows],ntime)
+                    for obs in sorted(accumulators.keys()):
+                        entry_path = entry_file(msfile,column,obs,meta['fields'][field_id],spw)
+                        save_entry(accumulators[obs],entry_path,nant,ntime,t_start,time_scans,numpy.array(meta['chan_freqs'][spw]),
+                                   pol_corrs[ddid_pols[ddid]],meta['antennas'])
+                        entries.append([int(obs),meta['fields'][field_id],spw,os.path.basename(entry_path)])
+                finally:
+                    sub.close()
+    finally:
+        tb.close()
+    index = {'version': cache_version, 'state': state, 'time_bin': time_bin, 'column': column,
+             'field_ids': field_ids, 'entries': entries}
+    index_file = os.path.join(cdir,'index.json')
+    index_out = open(index_file+'.tmp','w')
+    json.dump(index,index_out,indent=1)
+    index_out.close()
+    os.rename(index_file+'.tmp',index_file)
+    logger.info('Completed the visibility cache ({} entries).'.format(len(entries)))
+    return index
+
+def load_entry(msfile,column,obs,field,spw):
+    """
+    Reads the cache entry of one observation, field and SPW.
+
+    Input:
+    msfile = Path to the MS. (String)
+    column = The data column. (String)
+    obs = Observation ID. (Integer)
+    field = Field name. (String)
+    spw = SPW ID. (Integer)
+
+    Output:
+    entry = The cached sums and counts, None if there are no data. (Dictionary)
+    """
+    entry_path = entry_file(msfile,column,obs,field,spw)
+    if not os.path.exists(entry_path):
+        return None
+    data = numpy.load(entry_path)
+    entry = dict((key,data[key]) for key in data.files)
+    data.close()
+    return entry
+
+def average(sums,counts):
+    """
+    Returns the averages of summed visibilities, NaN where there are none.
+    """
+    counts = numpy.asarray(counts,dtype='float64')
+    return numpy.where(counts > 0,sums/numpy.maximum(counts,1.),numpy.nan)
+
+def spectra(entry,flagged=False):
+    """
+    Returns the time-averaged spectrum of each baseline and correlation (vector averages).
+
+    Input:
+    entry = The cache entry. (Dictionary)
+    flagged = Average the flagged visibilities instead of the unflagged ones. (Boolean)
+
+    Output:
+    Average visibilities. (Complex array, polarization x channel x baseline)
+    """
+    if flagged:
+        return average(entry['spec_bad'],entry['spec_nrows'][numpy.newaxis,numpy.newaxis,:]-entry['spec_ngood'])
+    return average(entry['spec_good'],entry['spec_ngood'])
+
+def time_series(entry,flagged=False):
+    """
+    Returns the channel-averaged time series of each baseline and correlation (vector averages).
+
+    Input:
+    entry = The cache entry. (Dictionary)
+    flagged = Average the flagged visibilities instead of the unflagged ones. (Boolean)
+
+    Output:
+    Average visibilities. (Complex array, polarization x baseline x time bin)
+    """
+    if flagged:
+        nchan = len(entry['freqs'])
+        return average(entry['ts_bad'],nchan*entry['ts_nrows'][numpy.newaxis,:,:]-entry['ts_ngood'])
+    return average(entry['ts_good'],entry['ts_ngood'])
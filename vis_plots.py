@@ -0,0 +1,262 @@
+import datetime
+import multiprocessing
+import numpy
+import matplotlib.cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import imp
+imp.load_source('vis_cache','vis_cache.py')
+import vis_cache as vc
+
+
+# Speed of light in km/s
+c_kms = 299792.458
+
+
+def save_figure(fig,plot_file):
+    """
+    Writes a figure to a PNG file.
+    """
+    FigureCanvasAgg(fig)
+    fig.savefig(plot_file,dpi=100)
+
+def corr_indices(entry,corrs):
+    """
+    Returns the indices of the selected correlations of a cache entry.
+
+    Input:
+    entry = The cache entry. (Dictionary)
+    corrs = Names of the correlations, None for all. (List of Strings)
+    """
+    names = list(entry['corrs'])
+    if corrs is None:
+        return list(range(len(names)))
+    return [names.index(corr) for corr in corrs if corr in names]
+
+def hours(entry):
+    """
+    Returns the times of the time bins of a cache entry in hours since the start of the first bin, and the label of the time axis.
+    """
+    t0 = entry['times'][0]-vc.time_bin/2.
+    label = 'Time since {} UTC (hours)'.format(format_mjd(t0))
+    return (entry['times']-t0)/3600.,label
+
+def format_mjd(mjd_sec):
+    """
+    Converts a time in MJD seconds to a date string.
+    """
+    time = datetime.datetime(1858,11,17)+datetime.timedelta(seconds=float(mjd_sec))
+    return '{0:04d}/{1:02d}/{2:02d} {3:02d}:{4:02d}:{5:02d}'.format(time.year,time.month,time.day,time.hour,time.minute,time.second)
+
+def velocities(freqs,rest_freq):
+    """
+    Converts frequencies to velocities (optical definition) in km/s.
+
+    Input:
+    freqs = Frequencies in Hz. (Array)
+    rest_freq = Rest frequency in Hz. (Float)
+    """
+    return c_kms*(rest_freq/numpy.asarray(freqs,dtype='float64')-1.)
+
+def plot_flags_freq(entry,plot_file,title):
+    """
+    Plots the time-averaged amplitude spectrum of each baseline and correlation, with the flagged data in red.
+
+    Input:
+    entry = The cache entry. (Dictionary)
+    plot_file = Path of the PNG file to write. (String)
+    title = Title of the plot. (String)
+    """
+    fig = Figure(figsize=(10,6))
+    ax = fig.add_subplot(111)
+    freqs = numpy.tile(entry['freqs'][:,numpy.newaxis]/1.E9,(1,len(entry['baselines'])))
+    for flagged,colour in [(False,'b'),(True,'r')]:
+        amp = numpy.abs(vc.spectra(entry,flagged))
+        for pol in range(amp.shape[0]):
+            ax.plot(freqs.ravel(),amp[pol].ravel(),',',color=colour)
+    ax.set_xlabel('Frequency (GHz)')
+    ax.set_ylabel('Amplitude')
+    ax.set_title(title+' (unflagged: blue, flagged: red)')
+    save_figure(fig,plot_file)
+
+def plot_flags_time(entry,plot_file,title):
+    """
+    Plots the channel-averaged amplitude of each baseline and correlation against time, with the flagged data in red.
+
+    Input:
+    entry = The cache entry. (Dictionary)
+    plot_file = Path of the PNG file to write. (String)
+    title = Title of the plot. (String)
+    """
+    fig = Figure(figsize=(10,6))
+    ax = fig.add_subplot(111)
+    times,label = hours(entry)
+    times = numpy.tile(times,(len(entry['baselines']),1))
+    for flagged,colour in [(False,'b'),(True,'r')]:
+        amp = numpy.abs(vc.time_series(entry,flagged))
+        for pol in range(amp.shape[0]):
+            ax.plot(times.ravel(),amp[pol].ravel(),'.',color=colour,markersize=2)
+    ax.set_xlabel(label)
+    ax.set_ylabel('Amplitude')
+    ax.set_title(title+' (unflagged: blue, flagged: red)')
+    save_figure(fig,plot_file)
+
+def plot_spectrum(entries,plot_file,title,rest_freq=None,freqs=None):
+    """
+    Plots the time-averaged amplitude spectrum of each baseline and correlation (unflagged data only) against channel, or velocity if a rest frequency is given.
+
+    Input:
+    entries = The cache entries to include (e.g. all the observations of a target). (List of Dictionaries)
+    plot_file = Path of the PNG file to write. (String)
+    title = Title of the plot. (String)
+    rest_freq = Rest frequency in Hz, None to plot against channel. (Float)
+    freqs = Channel frequencies in Hz to convert to velocity, None to use those of the cache (the frame of the MS). (Array)
+    """
+    fig = Figure(figsize=(10,6))
+    ax = fig.add_subplot(111)
+    for entry in entries:
+        amp = numpy.abs(vc.spectra(entry))
+        if rest_freq is None:
+            x = numpy.arange(amp.shape[1])
+        elif freqs is None:
+            x = velocities(entry['freqs'],rest_freq)
+        else:
+            x = velocities(freqs,rest_freq)
+        x = numpy.tile(x[:,numpy.newaxis],(1,amp.shape[2]))
+        for pol in range(amp.shape[0]):
+            ax.plot(x.ravel(),amp[pol].ravel(),',',color='b')
+    if rest_freq is None:
+        ax.set_xlabel('Channel')
+    else:
+        ax.set_xlabel('Velocity (km/s, optical)')
+    ax.set_ylabel('Amplitude')
+    ax.set_title(title)
+    save_figure(fig,plot_file)
+
+def plot_antenna_spectra(entries,plot_file,title,antenna,yaxis='amp',corrs=None):
+    """
+    Plots the time-averaged amplitude or phase spectrum of each baseline to one antenna, coloured by the other antenna.
+
+    Input:
+    entries = The cache entries to include (e.g. all the bandpass calibrators). (List of Dictionaries)
+    plot_file = Path of the PNG file to write. (String)
+    title = Title of the plot. (String)
+    antenna = Name of the antenna (e.g. the reference antenna). (String)
+    yaxis = 'amp' or 'phase'. (String)
+    corrs = Names of the correlations to plot, None for all. (List of Strings)
+    """
+    fig = Figure(figsize=(10,6))
+    ax = fig.add_subplot(111)
+    for entry in entries:
+        names = list(entry['antennas'])
+        ant = names.index(antenna)
+        vis = vc.spectra(entry)
+        chans = numpy.arange(vis.shape[1])
+        colours = matplotlib.cm.jet(numpy.linspace(0.,1.,len(names)))
+        for i,baseline in enumerate(entry['baselines']):
+            if ant not in baseline or baseline[0] == baseline[1]:
+                continue
+            other = baseline[1] if baseline[0] == ant else baseline[0]
+            for pol in corr_indices(entry,corrs):
+                if yaxis == 'phase':
+                    y = numpy.degrees(numpy.angle(vis[pol,:,i]))
+                else:
+                    y = numpy.abs(vis[pol,:,i])
+                ax.plot(chans,y,'.',color=colours[other],markersize=2)
+    ax.set_xlabel('Channel')
+    if yaxis == 'phase':
+        ax.set_ylabel('Phase (deg)')
+    else:
+        ax.set_ylabel('Amplitude')
+    ax.set_title(title)
+    save_figure(fig,plot_file)
+
+def baseline_series(entries):
+    """
+    Collects the channel-averaged amplitudes of each baseline from several cache entries.
+
+    Input:
+    entries = The cache entries to include (e.g. all the fields). (List of Dictionaries)
+
+    Output:
+    series = (times, amplitudes, scans) of each entry for each (antenna1, antenna2). (Dictionary)
+    """
+    series = {}
+    for entry in entries:
+        amp = numpy.abs(vc.time_series(entry))
+        times = entry['times']
+        for i,baseline in enumerate(entry['baselines']):
+            key = (int(baseline[0]),int(baseline[1]))
+            if key not in series:
+                series[key] = []
+            series[key].append((times,amp[:,i],entry['scans']))
+    return series
+
+def plot_baseline_page(job):
+    """
+    Plots one page of baselines (see plot_baselines).
+
+    Input:
+    job = The page file, title, grid shape, time origin, scan numbers, and (name, series) of each baseline on the page. (Tuple)
+
+    Output:
+    plot_file = The file written. (String)
+    """
+    plot_file,title,gridrows,gridcols,t0,all_scans,panels = job
+    colours = matplotlib.cm.jet(numpy.linspace(0.,1.,max(1,len(all_scans))))
+    fig = Figure(figsize=(5*gridcols,4*gridrows))
+    for panel,(name,series) in enumerate(panels):
+        ax = fig.add_subplot(gridrows,gridcols,panel+1)
+        for times,amp,scans in series:
+            colour = colours[numpy.searchsorted(all_scans,scans)]
+            for pol in range(amp.shape[0]):
+                ax.scatter((times-t0)/3600.,amp[pol],c=colour,s=4,edgecolors='none')
+        ax.set_title(name)
+        ax.set_xlabel('Time since {} UTC (hours)'.format(format_mjd(t0)))
+        ax.set_ylabel('Amplitude')
+    fig.suptitle(title)
+    save_figure(fig,plot_file)
+    return plot_file
+
+def plot_baselines(entries,plot_root,title,gridrows=2,gridcols=2,nproc=1):
+    """
+    Plots the channel-averaged amplitude of each baseline against time (unflagged data only), coloured by scan, several baselines per page.
+    The pages are drawn in parallel if more than one process is allowed.
+
+    Input:
+    entries = The cache entries to include (e.g. all the fields). (List of Dictionaries)
+    plot_root = Root of the PNG files to write, the page number is appended. (String)
+    title = Title of the plots. (String)
+    gridrows, gridcols = Number of rows and columns of baselines on each page. (Integers)
+    nproc = Maximum number of processes to use. (Integer)
+
+    Output:
+    pages = The file written and the names of the baselines on each page. (List of Tuples)
+    """
+    series = baseline_series(entries)
+    if len(series) == 0:
+        return []
+    names = list(entries[0]['antennas'])
+    t0 = min(entry['times'][0] for entry in entries)-vc.time_bin/2.
+    all_scans = numpy.unique(numpy.concatenate([entry['scans'] for entry in entries]))
+    per_page = gridrows*gridcols
+    keys = sorted(series.keys())
+    jobs = []
+    pages = []
+    for page in range(0,len(keys),per_page):
+        plot_file = '{0}_{1}.png'.format(plot_root,page//per_page)
+        panels = [('{0}-{1}'.format(names[key[0]],names[key[1]]),series[key]) for key in keys[page:page+per_page]]
+        jobs.append((plot_file,title,gridrows,gridcols,t0,all_scans,panels))
+        pages.append((plot_file,[name for name,panel_series in panels]))
+    nproc = min(nproc,len(jobs))
+    if nproc <= 1:
+        for job in jobs:
+            plot_baseline_page(job)
+        return pages
+    pool = multiprocessing.Pool(nproc)
+    try:
+        pool.map(plot_baseline_page,jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return pages